@@ -1,21 +1,90 @@
-from fastapi import APIRouter, UploadFile, File, Request
+import asyncio
+import json
+
+from typing import Literal
+
+from fastapi import APIRouter, UploadFile, File, Request, Response, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+from backend.core.constants import SessionStatus, TERMINAL_SESSION_STATUSES
+from backend.core.rate_limit import rate_limit
+from backend.services.embedding_codec import EMBEDDING_MEDIA_TYPE
+from backend.services.session_events import session_event_broker, resolve_result_urls
 from backend.services.session_service import (
     create_session_service,
     start_generation_service,
     get_session_status_service,
-    # generate_embedding_service # Temporarily disable
+    compute_status_etag,
+    generate_embedding_service,
+    get_embedding_data_service,
+    predict_mask_service,
 )
 
 router = APIRouter(prefix="/v1", tags=["Sessions"])
 
+# Interval for SSE keep-alive comments, so proxies do not close idle streams.
+SSE_KEEPALIVE_SECONDS = 15
+
+class RleMask(BaseModel):
+    format: Literal["rle"]
+    size: list[int]
+    counts: str | list[int]
+
+class BitpackMask(BaseModel):
+    format: Literal["bitpack"]
+    size: list[int]
+    data: str
+
 class GenerateRequest(BaseModel):
-    mask: str
+    # A compact mask of the session image's size ([height, width]), or a base64 PNG (legacy).
+    mask: RleMask | BitpackMask | str
     wallpaper_url: str
 
+class MaskPoint(BaseModel):
+    x: float
+    y: float
+    # 1 includes the region at the point, 0 excludes it.
+    label: Literal[0, 1]
+
+class MaskRequest(BaseModel):
+    # Points in pixels of the session image, up to MAX_MASK_POINTS.
+    points: list[MaskPoint]
+
+class MaskResponse(BaseModel):
+    session_id: str
+    mask: RleMask
+    score: float
+
+class ResultVariant(BaseModel):
+    width: int
+    format: str
+    url: str
+
+class SessionStatusResponse(BaseModel):
+    status: SessionStatus
+    result_url: str | None = None
+    error: str | None = None
+    attempts_left: int | None = None
+    result_variants: list[ResultVariant] | None = None
+    result_thumbnail_url: str | None = None
+    # Unix timestamps of the current generation
+    queued_at: float | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Checks an If-None-Match header against an ETag using weak comparison."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in candidates
+
 @router.post("/sessions/create", status_code=201)
-async def create_session(file: UploadFile = File(...)):
+@rate_limit("RATE_LIMIT_COST_CREATE")
+async def create_session(request: Request, response: Response, file: UploadFile = File(...)):
     """
     Creates a new wallpaper generation session.
 
@@ -26,24 +95,59 @@ async def create_session(file: UploadFile = File(...)):
     return await create_session_service(file)
 
 
-# @router.post("/sessions/{session_id}/embed", status_code=202)
-# async def generate_embedding(session_id: str, request: Request):
-#     """
-#     Generates and saves the embedding for the session's image.
-#
-#     - **session_id**: The ID of the session.
-#     - **request**: The request object to access the embedding service.
-#
-#     Returns an acceptance message.
-#     """
-#     # TODO: This is temporarily disabled until the user provides the SAM model file.
-#     # embedding_service = request.app.state.embedding_service
-#     # return await generate_embedding_service(session_id, embedding_service)
-#     raise HTTPException(status_code=503, detail="Embedding generation is temporarily disabled. SAM model file is missing.")
+@router.post("/sessions/{session_id}/embed", status_code=202)
+@rate_limit("RATE_LIMIT_COST_EMBED")
+async def generate_embedding(session_id: str, request: Request, response: Response):
+    """
+    Queues the embedding generation for the session's image.
+
+    - **session_id**: The ID of the session.
+
+    Returns an acceptance message. The session status moves to 'embedding' and then
+    'embedding_completed', or 'embedding_failed' with an error (the embedding can be
+    requested again); follow it via the status or events endpoints.
+    """
+    return await generate_embedding_service(session_id)
+
+
+@router.get("/sessions/{session_id}/embedding")
+@rate_limit("RATE_LIMIT_COST_STATUS")
+async def download_embedding(session_id: str, request: Request,
+                             format: Literal["float32", "encoded"] = "float32"):
+    """
+    Downloads the session's image embedding.
+
+    - **session_id**: The ID of the session.
+    - **format**: 'float32' returns raw little-endian float32 values of shape 1x256x64x64,
+      ready to wrap in an ONNX Runtime tensor. 'encoded' returns the stored compact format.
+    """
+    data = await get_embedding_data_service(session_id, decode=(format == "float32"))
+    media_type = "application/octet-stream" if format == "float32" else EMBEDDING_MEDIA_TYPE
+    return Response(
+        content=data,
+        media_type=media_type,
+        headers={"Cache-Control": "private, max-age=3600"},
+    )
+
+
+@router.post("/sessions/{session_id}/mask", response_model=MaskResponse)
+@rate_limit("RATE_LIMIT_COST_MASK")
+async def predict_mask(session_id: str, payload: MaskRequest, request: Request, response: Response):
+    """
+    Predicts a mask for the session's image from positive and negative points.
+
+    - **session_id**: The ID of the session. Its embedding must have been generated.
+    - **payload**: A JSON object with the points, in pixels of the session image.
+
+    Returns the mask as a compact RLE payload that can be sent to the generate endpoint
+    as is, so clients do not need to run the SAM model themselves.
+    """
+    return await predict_mask_service(session_id, [point.model_dump() for point in payload.points])
 
 
 @router.post("/sessions/{session_id}/generate", status_code=202)
-async def generate_wallpaper(session_id: str, payload: GenerateRequest):
+@rate_limit("RATE_LIMIT_COST_GENERATE")
+async def generate_wallpaper(session_id: str, payload: GenerateRequest, request: Request, response: Response):
     """
     Starts the wallpaper generation task for a specific session.
 
@@ -52,17 +156,123 @@ async def generate_wallpaper(session_id: str, payload: GenerateRequest):
 
     Returns an acceptance message. The actual result must be polled via the status endpoint.
     """
-    return await start_generation_service(session_id, payload.mask, payload.wallpaper_url)
+    mask = payload.mask if isinstance(payload.mask, str) else payload.mask.model_dump()
+    return await start_generation_service(session_id, mask, payload.wallpaper_url)
 
 
-@router.get("/sessions/{session_id}/status")
-async def get_session_status(session_id: str):
+@router.get(
+    "/sessions/{session_id}/status",
+    response_model=SessionStatusResponse,
+    responses={304: {"description": "The status has not changed since the given ETag."}},
+)
+@rate_limit("RATE_LIMIT_COST_STATUS")
+async def get_session_status(session_id: str, request: Request, response: Response):
     """
     Retrieves the current status of a generation session.
 
     - **session_id**: The ID of the session to check.
 
-    Returns the session's status, which can be 'pending', 'generating', 'completed', or 'failed'.
+    Returns the session's status, which can be 'new', 'queued', 'generating', 'completed', or 'failed'.
     If completed, the result URL is also provided.
+    Send the previous response's ETag in `If-None-Match` to get a 304 when nothing changed.
     """
-    return await get_session_status_service(session_id)
+    status_data = await get_session_status_service(session_id)
+    # The ETag covers the stored fields, not the URLs: presigned URLs differ on every read.
+    etag = compute_status_etag(status_data)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    response.headers.update(headers)
+    return resolve_result_urls(status_data)
+
+
+
+@router.get("/sessions/{session_id}/events")
+@rate_limit("RATE_LIMIT_COST_STATUS")
+async def stream_session_events(session_id: str, request: Request):
+    """
+    Streams the status transitions of a session as Server-Sent Events.
+
+    - **session_id**: The ID of the session to follow.
+
+    The current status is sent first, followed by every transition
+    ('queued', 'generating', 'retrying', 'completed', 'failed').
+    The stream ends once the session reaches a terminal status.
+    """
+    # Subscribe before reading the snapshot so no transition is missed in between.
+    queue = session_event_broker.register(session_id)
+    try:
+        snapshot = resolve_result_urls(await get_session_status_service(session_id))
+    except BaseException:
+        session_event_broker.unregister(session_id, queue)
+        raise
+
+    async def event_stream():
+        try:
+            event = snapshot
+            while True:
+                if event is not None:
+                    yield f"event: status\ndata: {json.dumps(event)}\n\n"
+                    if event.get("status") in TERMINAL_SESSION_STATUSES:
+                        return
+                if await request.is_disconnected():
+                    return
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    event = None
+                    yield ": keep-alive\n\n"
+        finally:
+            session_event_broker.unregister(session_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _wait_for_disconnect(websocket: WebSocket):
+    """Consumes client messages until the WebSocket is disconnected."""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+
+@router.websocket("/sessions/{session_id}/events/ws")
+async def session_events_websocket(websocket: WebSocket, session_id: str):
+    """
+    WebSocket variant of the session events stream.
+    Sends the current status, then each transition as a JSON message,
+    and closes once the session reaches a terminal status.
+    """
+    await websocket.accept()
+    async with session_event_broker.subscribe(session_id) as queue:
+        try:
+            event = resolve_result_urls(await get_session_status_service(session_id))
+        except HTTPException:
+            await websocket.close(code=4404, reason="Session not found.")
+            return
+
+        # Wait for a client disconnect in the background so a silent client is detected.
+        disconnected = asyncio.create_task(_wait_for_disconnect(websocket))
+        try:
+            while True:
+                await websocket.send_json(event)
+                if event.get("status") in TERMINAL_SESSION_STATUSES:
+                    await websocket.close()
+                    return
+                next_event = asyncio.create_task(queue.get())
+                done, _ = await asyncio.wait(
+                    {next_event, disconnected}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if disconnected in done:
+                    next_event.cancel()
+                    return
+                event = next_event.result()
+        except WebSocketDisconnect:
+            return
+        finally:
+            disconnected.cancel()
@@ -0,0 +1,39 @@
+import json
+
+from fastapi import APIRouter, Request, HTTPException
+
+from backend.core.config import settings
+from backend.core.security import verify_replicate_webhook
+from backend.core.constants import TERMINAL_PREDICTION_STATUSES
+from backend.worker.celery_app import celery_app
+
+router = APIRouter(prefix="/v1/webhooks", tags=["Webhooks"])
+
+@router.post("/replicate")
+async def replicate_webhook(request: Request):
+    """
+    Receives prediction completion callbacks from Replicate.
+
+    The session is finalized by the 'finalize_prediction' worker task, so this
+    endpoint only verifies the payload and returns immediately. Without
+    REPLICATE_WEBHOOK_SECRET, callbacks cannot be verified and are refused.
+    """
+    if not settings.REPLICATE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Webhooks are not enabled.")
+    body = await request.body()
+    verify_replicate_webhook(request.headers, body, settings.REPLICATE_WEBHOOK_SECRET)
+
+    try:
+        prediction = json.loads(body)
+        prediction_id = prediction["id"]
+        status = prediction["status"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid webhook payload.")
+
+    if status in TERMINAL_PREDICTION_STATUSES:
+        celery_app.send_task(
+            "finalize_prediction",
+            args=[prediction_id, status, prediction.get("output"), prediction.get("error")]
+        )
+
+    return {"received": True}
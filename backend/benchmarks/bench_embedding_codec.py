@@ -0,0 +1,71 @@
+"""
+Compares the compact embedding format against the legacy base64 '.npy' storage.
+
+Usage:
+    python backend/benchmarks/bench_embedding_codec.py [--npy embedding.npy] [--repeat 20]
+
+Without --npy a synthetic 1x256x64x64 embedding is used. Random data compresses
+worse than real SAM embeddings, so pass a real one for representative zstd numbers.
+"""
+import argparse
+import base64
+import io
+import os
+import sys
+import time
+
+# Add project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import numpy as np
+
+from backend.services.embedding_codec import decode_embedding, encode_embedding
+
+def legacy_encode(embedding: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, embedding, allow_pickle=False)
+    return base64.b64encode(buffer.getvalue())
+
+def legacy_decode(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(base64.b64decode(data)), allow_pickle=False)
+
+def time_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+def run(embedding: np.ndarray, repeat: int):
+    variants = [("legacy npy+base64", legacy_encode, legacy_decode)]
+    for dtype in ("float32", "float16", "int8"):
+        for compression in ("none", "zstd"):
+            variants.append((
+                f"{dtype}+{compression}",
+                lambda e, d=dtype, c=compression: encode_embedding(e, dtype=d, compression=c),
+                decode_embedding,
+            ))
+
+    baseline_size = None
+    print(f"{'format':<20}{'bytes':>12}{'ratio':>8}{'encode ms':>12}{'decode ms':>12}{'max abs err':>14}")
+    for name, encode, decode in variants:
+        data = encode(embedding)
+        baseline_size = baseline_size or len(data)
+        error = float(np.abs(decode(data) - embedding).max())
+        encode_ms = time_ms(lambda: encode(embedding), repeat)
+        decode_ms = time_ms(lambda: decode(data), repeat)
+        print(f"{name:<20}{len(data):>12}{len(data) / baseline_size:>8.2f}"
+              f"{encode_ms:>12.2f}{decode_ms:>12.2f}{error:>14.6f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--npy", help="Path to a real embedding saved with np.save.")
+    parser.add_argument("--repeat", type=int, default=20, help="Timing repetitions per format.")
+    args = parser.parse_args()
+
+    if args.npy:
+        embedding = np.load(args.npy).astype(np.float32)
+    else:
+        embedding = (np.random.default_rng(0).standard_normal((1, 256, 64, 64)) * 0.1).astype(np.float32)
+    run(embedding, args.repeat)
@@ -0,0 +1,78 @@
+"""
+Compares the compact mask formats against the legacy base64 PNG payload.
+
+Usage:
+    python backend/benchmarks/bench_mask_codec.py [--png mask.png] [--repeat 20]
+
+Without --png a synthetic 2048x1536 wall mask is used: a wall polygon with a window
+and a furniture cut-out, the shape of a typical brush-painted mask.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+# Add project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from backend.services.mask_codec import (
+    decode_bitpack,
+    decode_png,
+    decode_rle,
+    encode_bitpack,
+    encode_png,
+    encode_rle,
+)
+
+def synthetic_mask(width: int = 2048, height: int = 1536) -> np.ndarray:
+    image = Image.new("L", (width, height), 0)
+    draw = ImageDraw.Draw(image)
+    draw.polygon([(120, 80), (1900, 40), (1950, 1150), (90, 1200)], fill=255)
+    draw.rectangle([700, 300, 1200, 750], fill=0)
+    draw.ellipse([1300, 900, 1800, 1400], fill=0)
+    return np.asarray(image) > 127
+
+def time_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings))
+
+def run(mask: np.ndarray, repeat: int):
+    variants = [
+        ("legacy png+base64", lambda m: base64.b64encode(encode_png(m)).decode("ascii"), decode_png),
+        ("rle (coco string)", lambda m: json.dumps(encode_rle(m)), lambda p: decode_rle(json.loads(p))),
+        ("bitpack+base64", lambda m: json.dumps(encode_bitpack(m)), lambda p: decode_bitpack(json.loads(p))),
+    ]
+
+    baseline_size = None
+    print(f"mask {mask.shape[1]}x{mask.shape[0]}, {mask.mean():.1%} masked")
+    print(f"{'format':<20}{'bytes':>12}{'ratio':>8}{'encode ms':>12}{'decode ms':>12}")
+    for name, encode, decode in variants:
+        payload = encode(mask)
+        assert (decode(payload) == mask).all(), name
+        baseline_size = baseline_size or len(payload)
+        encode_ms = time_ms(lambda: encode(mask), repeat)
+        decode_ms = time_ms(lambda: decode(payload), repeat)
+        print(f"{name:<20}{len(payload):>12}{len(payload) / baseline_size:>8.2f}"
+              f"{encode_ms:>12.2f}{decode_ms:>12.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--png", help="Path to a real mask PNG.")
+    parser.add_argument("--repeat", type=int, default=20, help="Timing repetitions per format.")
+    args = parser.parse_args()
+
+    if args.png:
+        with open(args.png, "rb") as f:
+            mask = decode_png(base64.b64encode(f.read()).decode("ascii"))
+    else:
+        mask = synthetic_mask()
+    run(mask, args.repeat)
@@ -0,0 +1,435 @@
+"""
+End-to-end load test of the session API: create -> generate -> status polling.
+
+The FastAPI app runs in-process. Redis is fakeredis, unless --redis-url points at a
+Redis server (use a scratch database: keys are written to it). Celery tasks run
+in-process on a thread pool standing in for the generation workers, and Replicate is
+replaced by a fake DiffusionClient with configurable latency. Wallpapers and results
+are served by a local HTTP server, so downloads and result persistence are exercised.
+
+Usage:
+    python backend/benchmarks/loadtest.py [--users 50] [--concurrency 10] [--workers 4]
+        [--latency 1.0] [--save baseline.json] [--compare baseline.json]
+
+Reports latency percentiles per route and per flow, throughput, request and response
+body bytes per route, and Redis memory growth. --save writes the results as JSON;
+--compare prints the change against saved results and exits with 1 if a p95 latency
+regressed by more than --max-regression percent.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+ROUTES = ("create", "generate", "status")
+
+def configure_environment(args, workdir: str):
+    """Points the settings at local stand-ins. Must run before backend modules are imported."""
+    os.environ.setdefault("REDIS_URL", args.redis_url or "redis://localhost:6379/15")
+    os.environ.setdefault("REPLICATE_API_TOKEN", "loadtest")
+    os.environ["DIFFUSION_COMPLETION_MODE"] = "blocking"
+    os.environ["BLOB_STORAGE_BACKEND"] = "local"
+    os.environ["BLOB_STORAGE_LOCAL_DIR"] = os.path.join(workdir, "blobs")
+    os.environ["WALLPAPER_CACHE_DIR"] = os.path.join(workdir, "wallpapers")
+    # Every virtual user shares one client address; only admission control may reject.
+    os.environ["RATE_LIMIT_STORAGE_URI"] = "memory://"
+    os.environ["RATE_LIMIT"] = "1000000/minute"
+
+def use_fakeredis():
+    """Replaces the shared Redis clients. Must run before the app starts."""
+    import fakeredis
+    from backend.services.redis_client import use_redis_clients
+
+    server = fakeredis.FakeServer()
+    use_redis_clients(
+        fakeredis.FakeAsyncRedis(server=server, decode_responses=True),
+        fakeredis.FakeRedis(server=server, decode_responses=True),
+        fakeredis.FakeAsyncRedis(server=server),
+        fakeredis.FakeRedis(server=server),
+    )
+
+# --------------------------------------------------------------------------
+# Stand-ins
+# --------------------------------------------------------------------------
+def synthetic_photo(width: int, height: int, seed: int) -> bytes:
+    """A JPEG with smooth shading and noise, which compresses like a real photo."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    noise = rng.integers(-12, 12, size=(height, width, 3))
+    pixels = np.clip(base + noise + seed * 37 % 64, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def synthetic_mask(width: int, height: int) -> np.ndarray:
+    """A wall polygon with a window cut out."""
+    image = Image.new("L", (width, height), 0)
+    draw = ImageDraw.Draw(image)
+    draw.polygon([(width * 0.05, height * 0.05), (width * 0.95, height * 0.03),
+                  (width * 0.97, height * 0.75), (width * 0.04, height * 0.8)], fill=255)
+    draw.rectangle([width * 0.35, height * 0.2, width * 0.6, height * 0.5], fill=0)
+    return np.asarray(image) > 127
+
+class AssetServer:
+    """
+    Serves wallpapers and generation results over HTTP and counts the bytes served.
+    Wallpapers carry an ETag and a matching If-None-Match is answered with 304, like a
+    catalog CDN, so the worker's wallpaper cache is revalidated instead of bypassed.
+    """
+    def __init__(self, wallpaper_count: int, result_size: int):
+        self.wallpapers = [synthetic_photo(512, 512, 1000 + i) for i in range(wallpaper_count)]
+        self.etags = [f'"{hashlib.sha256(body).hexdigest()[:32]}"' for body in self.wallpapers]
+        self.result_size = result_size
+        self.bytes_served = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+        assets = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                kind, _, name = self.path.strip("/").partition("/")
+                index = int(name.split(".")[0])
+                etag = None
+                if kind == "wallpaper":
+                    index %= len(assets.wallpapers)
+                    body, etag = assets.wallpapers[index], assets.etags[index]
+                    if self.headers.get("If-None-Match") == etag:
+                        with assets._lock:
+                            assets.not_modified += 1
+                        self.send_response(304)
+                        self.send_header("ETag", etag)
+                        self.end_headers()
+                        return
+                else:
+                    # Every generation produces a distinct result, as a real model would.
+                    body = synthetic_photo(assets.result_size, assets.result_size * 3 // 4, index)
+                with assets._lock:
+                    assets.bytes_served += len(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                if etag:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wallpaper_url(self, index: int) -> str:
+        return f"{self.base_url}/wallpaper/{index % len(self.wallpapers)}.jpg"
+
+    def close(self):
+        self.server.shutdown()
+
+class FakeDiffusionClient:
+    """Stands in for DiffusionClient: sleeps for the model latency and returns a result URL."""
+    def __init__(self, assets: AssetServer, latency: float, jitter: float):
+        self.assets = assets
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def generate_wallpaper(self, original_image, mask_image, wallpaper_image) -> str:
+        with self._lock:
+            self.calls += 1
+            index = self.calls
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        return f"{self.assets.base_url}/result/{index}.jpg"
+
+def run_tasks_in_process(celery_app, workers: int) -> ThreadPoolExecutor:
+    """Runs sent Celery tasks on a thread pool of the given size, like a worker with that concurrency."""
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="worker")
+    celery_app.conf.task_always_eager = True
+
+    def send_task(name, args=None, kwargs=None, **options):
+        return executor.submit(celery_app.tasks[name].apply, args=args, kwargs=kwargs)
+
+    celery_app.send_task = send_task
+    return executor
+
+# --------------------------------------------------------------------------
+# Measurements
+# --------------------------------------------------------------------------
+def redis_footprint(client) -> dict:
+    """Key count and memory of the Redis database (serialized size of all keys on fakeredis)."""
+    try:
+        return {"keys": client.dbsize(), "bytes": client.info("memory")["used_memory"]}
+    except Exception:
+        keys = 0
+        size = 0
+        for key in client.scan_iter(count=1000):
+            keys += 1
+            size += len(key) + len(client.dump(key) or b"")
+        return {"keys": keys, "bytes": size}
+
+def directory_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "count": len(values),
+        "p50_ms": round(p50 * 1000, 2),
+        "p95_ms": round(p95 * 1000, 2),
+        "p99_ms": round(p99 * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2),
+    }
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {route: [] for route in ROUTES}
+        self.request_bytes = {route: 0 for route in ROUTES}
+        self.response_bytes = {route: 0 for route in ROUTES}
+        self.statuses = {route: {} for route in ROUTES}
+        self.flows = []
+        self.outcomes = {}
+
+    async def send(self, client, route: str, method: str, url: str, **kwargs):
+        request = client.build_request(method, url, **kwargs)
+        body = request.read()
+        started = time.perf_counter()
+        response = await client.send(request)
+        self.latencies[route].append(time.perf_counter() - started)
+        self.request_bytes[route] += len(body)
+        self.response_bytes[route] += len(response.content)
+        codes = self.statuses[route]
+        codes[response.status_code] = codes.get(response.status_code, 0) + 1
+        return response
+
+    def outcome(self, name: str):
+        self.outcomes[name] = self.outcomes.get(name, 0) + 1
+
+async def user_flow(client, recorder: Recorder, photos: list[bytes], masks: dict,
+                    assets: AssetServer, index: int, poll_interval: float, timeout: float):
+    started = time.perf_counter()
+    response = await recorder.send(
+        client, "create", "POST", "/v1/sessions/create",
+        files={"file": ("room.jpg", photos[index % len(photos)], "image/jpeg")},
+    )
+    if response.status_code != 201:
+        return recorder.outcome(f"create_{response.status_code}")
+    session = response.json()
+
+    response = await recorder.send(
+        client, "generate", "POST", f"/v1/sessions/{session['session_id']}/generate",
+        json={"mask": masks[(session["width"], session["height"])], "wallpaper_url": assets.wallpaper_url(index)},
+    )
+    if response.status_code != 202:
+        return recorder.outcome(f"generate_{response.status_code}")
+
+    # Poll like the frontend, revalidating with the previous ETag.
+    etag = None
+    status = response.json()["status"]
+    while status not in ("completed", "failed"):
+        if time.perf_counter() - started > timeout:
+            return recorder.outcome("timeout")
+        await asyncio.sleep(poll_interval)
+        headers = {"If-None-Match": etag} if etag else {}
+        response = await recorder.send(
+            client, "status", "GET", f"/v1/sessions/{session['session_id']}/status", headers=headers
+        )
+        if response.status_code == 200:
+            etag = response.headers.get("etag")
+            status = response.json()["status"]
+        elif response.status_code != 304:
+            return recorder.outcome(f"status_{response.status_code}")
+
+    recorder.flows.append(time.perf_counter() - started)
+    recorder.outcome(status)
+
+async def drive(app, args, assets: AssetServer) -> tuple[Recorder, float]:
+    import httpx
+    from backend.services.mask_codec import encode_rle
+
+    photos = [synthetic_photo(args.image_width, args.image_height, i) for i in range(args.images)]
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        # Masks are encoded once per normalized image size, as the browser would send them.
+        response = await client.post(
+            "/v1/sessions/create", files={"file": ("room.jpg", photos[0], "image/jpeg")}
+        )
+        response.raise_for_status()
+        size = (response.json()["width"], response.json()["height"])
+        masks = {size: encode_rle(synthetic_mask(*size))}
+
+        async def limited(index: int):
+            async with semaphore:
+                await user_flow(client, recorder, photos, masks, assets, index,
+                                args.poll_interval, args.timeout)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+    return recorder, elapsed
+
+def summarize(recorder: Recorder, elapsed: float, redis_before: dict, redis_after: dict,
+              assets: AssetServer, blob_bytes: int, diffusion_calls: int) -> dict:
+    routes = {}
+    for route in ROUTES:
+        count = len(recorder.latencies[route])
+        routes[route] = {
+            **percentiles(recorder.latencies[route]),
+            "statuses": {str(code): n for code, n in sorted(recorder.statuses[route].items())},
+            "request_bytes_avg": round(recorder.request_bytes[route] / count) if count else 0,
+            "response_bytes_avg": round(recorder.response_bytes[route] / count) if count else 0,
+        }
+    requests = sum(len(values) for values in recorder.latencies.values())
+    sessions = max(len(recorder.latencies["create"]), 1)
+    return {
+        "routes": routes,
+        "flow": percentiles(recorder.flows),
+        "outcomes": dict(sorted(recorder.outcomes.items())),
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 2),
+        "flows_per_second": round(len(recorder.flows) / elapsed, 2),
+        "redis": {
+            "before": redis_before,
+            "after": redis_after,
+            "growth_bytes_per_session": round((redis_after["bytes"] - redis_before["bytes"]) / sessions),
+        },
+        "diffusion_calls": diffusion_calls,
+        "worker_download_bytes": assets.bytes_served,
+        "wallpaper_revalidations": assets.not_modified,
+        "blob_storage_bytes": blob_bytes,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def print_report(results: dict):
+    print(f"{'route':<10}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'req B':>10}{'resp B':>10}  statuses")
+    for route, stats in [*results["routes"].items(), ("flow", results["flow"])]:
+        print(f"{route:<10}{stats['count']:>7}{stats.get('p50_ms', 0):>10.1f}{stats.get('p95_ms', 0):>10.1f}"
+              f"{stats.get('p99_ms', 0):>10.1f}{stats.get('request_bytes_avg', 0):>10}"
+              f"{stats.get('response_bytes_avg', 0):>10}  {stats.get('statuses', '')}")
+    redis = results["redis"]
+    print(f"\noutcomes: {results['outcomes']}")
+    print(f"elapsed: {results['elapsed_seconds']} s, {results['requests_per_second']} req/s, "
+          f"{results['flows_per_second']} flows/s")
+    print(f"redis: {redis['before']['keys']} -> {redis['after']['keys']} keys, "
+          f"{redis['before']['bytes']} -> {redis['after']['bytes']} bytes "
+          f"({redis['growth_bytes_per_session']} bytes/session)")
+    print(f"diffusion calls: {results['diffusion_calls']}, worker downloads: {results['worker_download_bytes']} bytes "
+          f"({results['wallpaper_revalidations']} wallpapers not modified), blob storage: {results['blob_storage_bytes']} bytes, peak RSS: {results['peak_rss_mb']} MB")
+
+def compare(results: dict, baseline: dict, max_regression: float) -> bool:
+    """Prints the change of each latency against the baseline. Returns False on a p95 regression."""
+    ok = True
+    print(f"\n{'metric':<22}{'baseline':>12}{'current':>12}{'change':>10}")
+    rows = [(f"{route} {metric}", baseline["routes"].get(route, {}), stats, metric)
+            for route, stats in results["routes"].items() for metric in ("p50_ms", "p95_ms", "p99_ms")]
+    rows += [(f"flow {metric}", baseline["flow"], results["flow"], metric) for metric in ("p50_ms", "p95_ms")]
+    for name, before_stats, after_stats, metric in rows:
+        before, after = before_stats.get(metric), after_stats.get(metric)
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100
+        flag = ""
+        if metric == "p95_ms" and change > max_regression:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{name:<22}{before:>12.1f}{after:>12.1f}{change:>+9.1f}%{flag}")
+    for name in ("requests_per_second", "flows_per_second"):
+        before, after = baseline.get(name), results.get(name)
+        if before:
+            print(f"{name:<22}{before:>12.2f}{after:>12.2f}{(after - before) / before * 100:>+9.1f}%")
+    return ok
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    configure_environment(args, workdir)
+    if not args.redis_url:
+        use_fakeredis()
+
+    from backend.main import app
+    from backend.services.redis_client import get_sync_redis_binary_client
+    from backend.services.session_events import session_event_broker
+    from backend.worker.celery_app import celery_app
+    import backend.worker.worker as worker
+
+    logging.getLogger().setLevel(logging.WARNING)
+    assets = AssetServer(args.wallpapers, args.result_size)
+    diffusion_client = FakeDiffusionClient(assets, args.latency, args.jitter)
+    worker.get_diffusion_client = lambda: diffusion_client
+    executor = run_tasks_in_process(celery_app, args.workers)
+
+    redis_before = redis_footprint(get_sync_redis_binary_client())
+    try:
+        recorder, elapsed = asyncio.run(drive(app, args, assets))
+    finally:
+        executor.shutdown(wait=True)
+        asyncio.run(session_event_broker.close())
+        assets.close()
+    redis_after = redis_footprint(get_sync_redis_binary_client())
+
+    results = summarize(recorder, elapsed, redis_before, redis_after, assets,
+                        directory_bytes(os.environ["BLOB_STORAGE_LOCAL_DIR"]),
+                        diffusion_client.calls)
+    results["config"] = {name: value for name, value in vars(args).items()
+                         if name not in ("save", "compare", "max_regression")}
+    print_report(results)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("\nWarning: the baseline was recorded with different options.")
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50, help="Sessions to run end to end.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Sessions in progress at once.")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrency of the in-process generation worker.")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mean latency of the fake model in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Standard deviation of the model latency.")
+    parser.add_argument("--images", type=int, default=10, help="Distinct uploaded photos.")
+    parser.add_argument("--wallpapers", type=int, default=3, help="Distinct wallpaper URLs.")
+    parser.add_argument("--image-width", type=int, default=1600)
+    parser.add_argument("--image-height", type=int, default=1200)
+    parser.add_argument("--result-size", type=int, default=1024, help="Width of the generated results.")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Status polling interval in seconds.")
+    parser.add_argument("--timeout", type=float, default=300, help="Per-session timeout in seconds.")
+    parser.add_argument("--redis-url", help="Use this Redis server instead of fakeredis.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare against results saved with --save.")
+    parser.add_argument("--max-regression", type=float, default=10.0,
+                        help="Allowed p95 latency increase in percent for --compare.")
+    main(parser.parse_args())
@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -15,12 +18,149 @@ class Settings(BaseSettings):
     # CORS - can be a comma-separated list in the .env file
     CORS_ORIGINS: list[str] = ["http://localhost:3000"]
 
+    # Rate limiting: a per-client budget shared by all routes, stored in Redis
+    RATE_LIMIT_STORAGE_URI: str | None = None  # Defaults to REDIS_URL
+    RATE_LIMIT: str = "120/minute"
+    RATE_LIMIT_COST_CREATE: int = 10
+    RATE_LIMIT_COST_GENERATE: int = 20
+    RATE_LIMIT_COST_EMBED: int = 5
+    RATE_LIMIT_COST_STATUS: int = 1
+    RATE_LIMIT_COST_MASK: int = 2
+
+    # Session lifetime per state, refreshed on activity. Abandoned sessions expire
+    # quickly; finished ones stay around long enough to be revisited.
+    SESSION_TTL_NEW_SECONDS: int = 2 * 3600           # new, embedding, embedding_completed/failed
+    SESSION_TTL_ACTIVE_SECONDS: int = 24 * 3600       # queued, generating, retrying
+    SESSION_TTL_COMPLETED_SECONDS: int = 7 * 24 * 3600
+    SESSION_TTL_FAILED_SECONDS: int = 24 * 3600
+
+    # Housekeeping (Celery beat): unreferenced blobs older than the grace period are deleted
+    HOUSEKEEPING_INTERVAL_SECONDS: int = 3600
+    HOUSEKEEPING_BLOB_GRACE_SECONDS: int = 24 * 3600
+
+    # Admission control: new generations are rejected with 429 while too many are
+    # in flight or the generation queue is too deep
+    GENERATION_MAX_IN_FLIGHT: int = 50
+    GENERATION_MAX_QUEUE_DEPTH: int = 100
+    GENERATION_RETRY_AFTER_SECONDS: int = 30
+
+    # Prometheus exporter of Celery workers (0 disables it). The API serves /metrics itself.
+    WORKER_METRICS_PORT: int = 9808
+
     # Replicate API
     REPLICATE_API_TOKEN: str
+    # Using a model suitable for inpainting with a pattern (ControlNet Tile)
+    DIFFUSION_MODEL_VERSION: str = "diffusers/controlnet-tile-sdxl-1.0:69958813b3d86c8837a5b6b2334a3e5013a5a0c8a39528774a9404e8504634d8"
+    DIFFUSION_PROMPT: str = "Applying a new wallpaper pattern to the specified wall area"
+    # How generation tasks wait for Replicate: "blocking" (hold the worker slot),
+    # "webhook" (Replicate calls DIFFUSION_WEBHOOK_URL) or "poll" (short poller tasks)
+    DIFFUSION_COMPLETION_MODE: str = "blocking"
+    DIFFUSION_WEBHOOK_URL: str | None = None  # Public URL of /v1/webhooks/replicate
+    REPLICATE_WEBHOOK_SECRET: str | None = None  # "whsec_..." signing secret
+    DIFFUSION_POLL_INTERVAL_SECONDS: int = 5
+    # Predictions still running after the timeout are cancelled and failed. In webhook
+    # mode a single poll at the timeout settles predictions whose webhook was lost.
+    DIFFUSION_POLL_TIMEOUT_SECONDS: int = 900
 
     # SAM Model
     SAM_MODEL_TYPE: str = "vit_b"
     SAM_CHECKPOINT_PATH: str = "sam_vit_b_01ec64.pth"
+    # Embedding engine - "torch" (SAM checkpoint) or "onnx" (exported, optionally quantized encoder)
+    SAM_EMBEDDING_BACKEND: str = "torch"
+    SAM_ONNX_ENCODER_PATH: str = "sam_vit_b_encoder.quant.onnx"
+    SAM_ENCODER_THREADS: int = 0  # 0 uses the library default
+    SAM_EMBEDDING_BATCH_SIZE: int = 4
+    SAM_EMBEDDING_BATCH_WAIT_MS: int = 10
+    SAM_EMBEDDING_CACHE_SIZE: int = 32
+    # A session stays locked in 'embedding' for at most this long; a lost task then no
+    # longer blocks it, and housekeeping marks it embedding_failed
+    EMBEDDING_TIMEOUT_SECONDS: int = 600
+    # Server-side mask prediction (API) - exported prompt decoder, see scripts/export_sam_decoder.py
+    SAM_ONNX_DECODER_PATH: str = "sam_vit_b_decoder.onnx"
+    SAM_DECODER_THREADS: int = 0  # 0 uses the library default
+    # Queued prompts on the same image are coalesced into one decoder call
+    SAM_DECODER_BATCH_SIZE: int = 8
+    SAM_DECODER_BATCH_WAIT_MS: int = 2
+    SAM_DECODER_EMBEDDING_CACHE_SIZE: int = 16  # Decoded float32 embeddings, 4 MB each
+    # Stored embedding format - dtype "float32", "float16" or "int8"; compression "zstd" or "none"
+    EMBEDDING_STORAGE_DTYPE: str = "float16"
+    EMBEDDING_COMPRESSION: str = "zstd"
+
+    # Generation result cache. Entries expire after the TTL; with Redis'
+    # maxmemory-policy set to volatile-lru they are also evicted first under memory pressure.
+    # Results are keyed by the wallpaper URL, not its content: catalog URLs must be immutable
+    # (e.g. versioned file names). Change GENERATION_CACHE_VERSION to drop all cached results,
+    # e.g. after a pattern was replaced in place.
+    GENERATION_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    GENERATION_CACHE_VERSION: str = "1"
+    GENERATION_INFLIGHT_TTL_SECONDS: int = 1800
+
+    # Upload normalization
+    MAX_IMAGE_LONG_EDGE: int = 2048
+    PREVIEW_LONG_EDGE: int = 512
+    IMAGE_JPEG_QUALITY: int = 90
+    PREVIEW_JPEG_QUALITY: int = 80
+
+    # Wallpaper download cache (worker)
+    WALLPAPER_CACHE_DIR: str = "wallpaper_cache"
+    WALLPAPER_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    WALLPAPER_MAX_DOWNLOAD_BYTES: int = 20 * 1024 * 1024
+    WALLPAPER_DOWNLOAD_TIMEOUT_SECONDS: float = 15
+
+    # Worker inputs larger than this are spilled to a temporary file instead of kept in memory
+    WORKER_SPILL_THRESHOLD_BYTES: int = 32 * 1024 * 1024
+
+    # Blob Storage - "s3" (S3/MinIO) or "local" (filesystem, for tests)
+    BLOB_STORAGE_BACKEND: str = "s3"
+    BLOB_STORAGE_LOCAL_DIR: str = "blob_storage"
+    S3_BUCKET_NAME: str = "wallpaper-sessions"
+    S3_ENDPOINT_URL: str | None = None
+    S3_REGION_NAME: str | None = None
+    AWS_ACCESS_KEY_ID: str | None = None
+    AWS_SECRET_ACCESS_KEY: str | None = None
+    # Public (e.g. CDN) base URL of the bucket. Without it, presigned URLs are returned.
+    # Sessions and cached results store blob keys, and URLs are signed on every read.
+    BLOB_PUBLIC_BASE_URL: str | None = None
+    BLOB_URL_EXPIRES_SECONDS: int = 24 * 3600
+
+    # Generated results: derivative widths and formats stored next to the full-size image
+    RESULT_VARIANT_WIDTHS: list[int] = [480, 960, 1600]
+    RESULT_VARIANT_FORMATS: list[str] = ["webp", "avif"]
+    RESULT_THUMBNAIL_WIDTH: int = 256
+    RESULT_MAX_DOWNLOAD_BYTES: int = 50 * 1024 * 1024
+    # Connect/read timeout of result downloads from the diffusion provider's CDN. Results are
+    # larger than wallpapers and come from another host, so they have their own timeout.
+    RESULT_DOWNLOAD_TIMEOUT_SECONDS: float = 30
+
+    @model_validator(mode="after")
+    def _check_completion_mode(self):
+        if self.DIFFUSION_COMPLETION_MODE not in ("blocking", "webhook", "poll"):
+            raise ValueError(f"Unknown diffusion completion mode: {self.DIFFUSION_COMPLETION_MODE}")
+        # Unsigned callbacks would let anyone post a result URL for the worker to store.
+        if self.DIFFUSION_COMPLETION_MODE == "webhook" and not (
+                self.DIFFUSION_WEBHOOK_URL and self.REPLICATE_WEBHOOK_SECRET):
+            raise ValueError(
+                "Webhook completion mode requires DIFFUSION_WEBHOOK_URL and REPLICATE_WEBHOOK_SECRET."
+            )
+        return self
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """
+    Returns the process-wide settings, loading them on first use.
+    """
+    return Settings()
+
+class _LazySettings:
+    """
+    Stands in for the Settings instance and loads it on first attribute access,
+    so importing a module does not read the environment or the .env file.
+    """
+    def __getattr__(self, name: str):
+        return getattr(get_settings(), name)
+
+    def __repr__(self) -> str:
+        return repr(get_settings())
 
-# Create a single instance of the settings
-settings = Settings()
+# The single, lazily loaded instance of the settings
+settings = _LazySettings()
@@ -3,22 +3,115 @@ from enum import Enum
 # --- Session Statuses ---
 class SessionStatus(str, Enum):
     NEW = "new"
+    EMBEDDING = "embedding"
     EMBEDDING_COMPLETED = "embedding_completed"
+    # The embedding could not be computed; the session is still usable for generation.
+    EMBEDDING_FAILED = "embedding_failed"
     QUEUED = "queued"
     GENERATING = "generating"
+    RETRYING = "retrying"
     COMPLETED = "completed"
     FAILED = "failed"
 
+# Statuses after which a session emits no further events.
+TERMINAL_SESSION_STATUSES = {SessionStatus.COMPLETED.value, SessionStatus.FAILED.value}
+
+# Statuses during which a session has work in flight.
+BUSY_SESSION_STATUSES = {
+    SessionStatus.EMBEDDING.value,
+    SessionStatus.QUEUED.value,
+    SessionStatus.GENERATING.value,
+    SessionStatus.RETRYING.value,
+}
+
 # --- Redis Session Hash Fields ---
 # These are the keys used in the Redis hash for each session.
 SESSION_STATUS = "status"
 SESSION_ORIGINAL_FILENAME = "original_filename"
-SESSION_ORIGINAL_IMAGE_B64 = "original_image_b64"
-SESSION_EMBEDDING_B64 = "embedding_b64"
+SESSION_ORIGINAL_IMAGE_KEY = "original_image_key"
+SESSION_ORIGINAL_CONTENT_TYPE = "original_content_type"
+SESSION_IMAGE_WIDTH = "image_width"
+SESSION_IMAGE_HEIGHT = "image_height"
+SESSION_PREVIEW_IMAGE_KEY = "preview_image_key"
 SESSION_ATTEMPTS_LEFT = "attempts_left"
+# A persisted result is stored as blob keys; URLs are built when the session is read.
+# result_url is only stored if the result could not be persisted (the provider's URL).
 SESSION_RESULT_URL = "result_url"
+SESSION_RESULT_KEY = "result_key"
+SESSION_RESULT_VARIANTS = "result_variants"
+SESSION_RESULT_THUMBNAIL_KEY = "result_thumbnail_key"
+SESSION_RESULT_THUMBNAIL_URL = "result_thumbnail_url"
 SESSION_ERROR_MESSAGE = "error"
+SESSION_PREDICTION_ID = "prediction_id"
+SESSION_GENERATION_CACHE_KEY = "generation_cache_key"
+SESSION_MASK_KEY = "mask_key"
+# Set while a generation holds a reserved attempt of the session.
+SESSION_ATTEMPT_RESERVED = "attempt_reserved"
+# TTL in seconds of the session's current state; reapplied whenever the session is used.
+SESSION_TTL = "ttl"
+# Unix timestamps of the current generation: accepted, started by a worker, completed or failed.
+SESSION_QUEUED_AT = "queued_at"
+SESSION_STARTED_AT = "started_at"
+SESSION_FINISHED_AT = "finished_at"
+# Unix timestamp at which the current generation began submitting its prediction. Set
+# before the prediction is created, so a redelivered task never submits a second one.
+SESSION_SUBMITTED_AT = "submitted_at"
+# Unix timestamp after which a session still in 'embedding' is considered lost.
+SESSION_EMBEDDING_DEADLINE = "embedding_deadline"
+
+# Session fields that reference blobs, used to find unreferenced blobs.
+SESSION_BLOB_FIELDS = [
+    SESSION_ORIGINAL_IMAGE_KEY,
+    SESSION_PREVIEW_IMAGE_KEY,
+    SESSION_MASK_KEY,
+    SESSION_RESULT_KEY,
+]
+
+# Encoded embeddings are stored as raw bytes under their own key, outside the session hash.
+SESSION_EMBEDDING_KEY_PREFIX = "session_embedding:"
+
+# Maps an in-flight Replicate prediction ID to its session ID.
+PREDICTION_KEY_PREFIX = "prediction:"
+
+# Prefix of the generation result cache keys (results, in-flight markers, waiters).
+GENERATION_CACHE_KEY_PREFIX = "gencache:"
+
+# Replicate prediction statuses after which a prediction no longer changes.
+TERMINAL_PREDICTION_STATUSES = {"succeeded", "failed", "canceled"}
+
+# Fields read for the status endpoint. Large fields are never part of this projection.
+SESSION_STATUS_FIELDS = [
+    SESSION_STATUS,
+    SESSION_RESULT_URL,
+    SESSION_RESULT_KEY,
+    SESSION_ERROR_MESSAGE,
+    SESSION_ATTEMPTS_LEFT,
+    SESSION_RESULT_VARIANTS,
+    SESSION_RESULT_THUMBNAIL_KEY,
+    SESSION_QUEUED_AT,
+    SESSION_STARTED_AT,
+    SESSION_FINISHED_AT,
+]
+
+# Session fields stored as JSON strings in the session hash.
+JSON_SESSION_FIELDS = {SESSION_RESULT_VARIANTS}
 
 # --- File Validation ---
 ALLOWED_CONTENT_TYPES = ["image/jpeg", "image/png"]
 MAX_FILE_SIZE_MB = 10
+MAX_IMAGE_PIXELS = 50_000_000
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# --- Mask Prediction ---
+MAX_MASK_POINTS = 32
+
+# --- Blob Storage Prefixes ---
+BLOB_PREFIX_ORIGINALS = "originals"
+BLOB_PREFIX_PREVIEWS = "previews"
+BLOB_PREFIX_RESULTS = "results"
+BLOB_PREFIX_MASKS = "masks"
+
+# --- Celery Queues ---
+GENERATION_QUEUE = "generation"
+EMBEDDING_QUEUE = "embedding"
+HOUSEKEEPING_QUEUE = "housekeeping"
@@ -0,0 +1,112 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CollectorRegistry,
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+# --------------------------------------------------------------------------
+# Prometheus Metrics
+# --------------------------------------------------------------------------
+# Metrics are per process. With several uvicorn workers or a prefork Celery pool, set
+# PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the processes of one
+# deployment, so each scrape aggregates all of them.
+
+# Buckets from milliseconds (Redis, decoding) up to minutes (inference, queueing).
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    "wallpaper_stage_duration_seconds",
+    "Duration of a stage of an operation.",
+    ["operation", "stage"],
+    buckets=DURATION_BUCKETS,
+)
+
+# Per-session lifecycle, from the session timestamps (queued -> started -> finished).
+GENERATION_QUEUE_WAIT_SECONDS = Histogram(
+    "wallpaper_generation_queue_wait_seconds",
+    "Time from a generation being queued to a worker starting it.",
+    buckets=DURATION_BUCKETS,
+)
+GENERATION_SECONDS = Histogram(
+    "wallpaper_generation_duration_seconds",
+    "Time from a generation being queued to its session being finished.",
+    ["outcome"],
+    buckets=DURATION_BUCKETS,
+)
+
+GENERATION_ADMISSIONS = Counter(
+    "wallpaper_generation_admissions_total",
+    "Generation requests by admission outcome (hit, owner, waiter, busy).",
+    ["outcome"],
+)
+CACHE_REQUESTS = Counter(
+    "wallpaper_cache_requests_total",
+    "Lookups of in-process and on-disk caches.",
+    ["cache", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "wallpaper_cache_evictions_total",
+    "Entries evicted from on-disk caches to stay within their byte budget.",
+    ["cache"],
+)
+
+TASK_SECONDS = Histogram(
+    "wallpaper_task_duration_seconds",
+    "Duration of Celery task runs.",
+    ["task", "state"],
+    buckets=DURATION_BUCKETS,
+)
+TASK_RETRIES = Counter("wallpaper_task_retries_total", "Celery task retries.", ["task"])
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "wallpaper_http_request_duration_seconds",
+    "Duration of API requests.",
+    ["method", "route", "status"],
+    buckets=DURATION_BUCKETS,
+)
+
+@contextmanager
+def stage_timer(operation: str, stage: str):
+    """
+    Records the duration of a stage of an operation, e.g.:
+
+        with stage_timer("process_wallpaper", "fetch_wallpaper"):
+            ...
+
+    Works around awaits too; the wall-clock time of the block is recorded.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(operation, stage).observe(time.perf_counter() - started)
+
+def observe_since(histogram, since: str | float | None, *labels: str) -> None:
+    """Observes the seconds elapsed since a Unix timestamp, if it is known."""
+    if since is None:
+        return
+    elapsed = time.time() - float(since)
+    (histogram.labels(*labels) if labels else histogram).observe(max(elapsed, 0.0))
+
+def collector_registry() -> CollectorRegistry:
+    """
+    Returns the registry to expose: the aggregate of all processes in multiprocess
+    mode, or the default registry of this process.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+def render_latest(registry: CollectorRegistry | None = None) -> tuple[bytes, str]:
+    """Renders the metrics in the Prometheus text format. Returns the body and its content type."""
+    return generate_latest(registry or collector_registry()), CONTENT_TYPE_LATEST
@@ -0,0 +1,64 @@
+import functools
+import threading
+
+from slowapi import Limiter
+from slowapi.util import get_remote_address
+
+from backend.core.config import settings
+
+# --------------------------------------------------------------------------
+# Rate Limiting
+# --------------------------------------------------------------------------
+# Counters live in Redis, so every API process enforces the same limits. All routes
+# draw from one moving-window budget per client, with a cost per request that reflects
+# how expensive the route is (a generation costs far more than a status poll).
+# If Redis is unreachable, each process falls back to in-memory counters.
+_limiter: Limiter | None = None
+_limiter_lock = threading.Lock()
+
+def get_limiter() -> Limiter:
+    """
+    Returns the process-wide Limiter, created on first use rather than at import: its
+    storage URI comes from the settings. The API creates it in the lifespan hook.
+    """
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = Limiter(
+                    key_func=get_remote_address,
+                    storage_uri=settings.RATE_LIMIT_STORAGE_URI or settings.REDIS_URL,
+                    strategy="moving-window",
+                    key_prefix="ratelimit",
+                    headers_enabled=True,
+                    in_memory_fallback_enabled=True,
+                )
+    return _limiter
+
+# Scope of the budget shared by all client-facing routes.
+API_RATE_LIMIT_SCOPE = "api"
+
+def rate_limit(cost_setting: str):
+    """
+    Decorates a route so each request spends the number of units of the client's shared
+    budget held by the setting `cost_setting` (e.g. "RATE_LIMIT_COST_CREATE"). The limit
+    and the cost are read from the settings per request, not when the route is declared.
+    The route must be async and accept `request: Request` and, unless it returns a
+    Response, `response: Response`, so the rate limit headers can be added.
+    """
+    def decorator(func):
+        limited = None
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            # The limit is registered with the Limiter on the first request, once it exists.
+            nonlocal limited
+            if limited is None:
+                limited = get_limiter().shared_limit(
+                    lambda: settings.RATE_LIMIT,
+                    scope=API_RATE_LIMIT_SCOPE,
+                    cost=lambda request: getattr(settings, cost_setting),
+                )(func)
+            return await limited(*args, **kwargs)
+        return wrapper
+    return decorator
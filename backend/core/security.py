@@ -1,4 +1,8 @@
 import re
+import base64
+import hashlib
+import hmac
+import time
 from fastapi import HTTPException
 
 # Regex to validate a URL (simplified for this use case)
@@ -25,3 +29,39 @@ def validate_wallpaper_url(url: str):
     # to check Content-Type, but that would introduce a blocking network call.
     # For now, we rely on the regex and the worker to handle download errors.
     return True
+
+# Maximum age of a signed webhook, to limit replay attacks.
+WEBHOOK_TOLERANCE_SECONDS = 5 * 60
+
+def verify_replicate_webhook(headers, body: bytes, secret: str):
+    """
+    Verifies the signature of a Replicate webhook (Standard Webhooks scheme).
+    Raises HTTPException if the signature is missing, stale or invalid.
+
+    Args:
+        headers: The request headers.
+        body: The raw request body.
+        secret: The webhook signing secret ("whsec_...").
+    """
+    webhook_id = headers.get("webhook-id")
+    timestamp = headers.get("webhook-timestamp")
+    signatures = headers.get("webhook-signature")
+    if not webhook_id or not timestamp or not signatures:
+        raise HTTPException(status_code=401, detail="Missing webhook signature.")
+
+    try:
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE_SECONDS:
+            raise HTTPException(status_code=401, detail="Webhook timestamp is too old.")
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid webhook timestamp.")
+
+    key = base64.b64decode(secret.removeprefix("whsec_"))
+    signed_content = f"{webhook_id}.{timestamp}.".encode("utf-8") + body
+    expected = base64.b64encode(hmac.new(key, signed_content, hashlib.sha256).digest()).decode("utf-8")
+
+    # The header holds space-separated "v1,<signature>" entries.
+    for signature in signatures.split():
+        _, _, value = signature.partition(",")
+        if hmac.compare_digest(value, expected):
+            return True
+    raise HTTPException(status_code=401, detail="Invalid webhook signature.")
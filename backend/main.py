@@ -1,35 +1,51 @@
 import sys
 import os
+from contextlib import asynccontextmanager
 
 # Add project root to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from fastapi import FastAPI, Request
+import time
+
+from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
+from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 
-from backend.core.config import settings
+from backend.core.config import settings, get_settings
+from backend.core.rate_limit import get_limiter
+from backend.core.metrics import HTTP_REQUEST_SECONDS, render_latest
 from backend.api.v1.sessions import router as sessions_router
-from backend.services.embedding_service import EmbeddingService
+from backend.api.v1.webhooks import router as webhooks_router
+from backend.services.session_events import session_event_broker
+from backend.services.blob_storage import get_blob_storage
+from backend.services.redis_client import get_async_redis_client, get_async_redis_binary_client
 
 # --------------------------------------------------------------------------
 # Service Initialization
 # --------------------------------------------------------------------------
-# Load the SAM model on startup and attach it to the app state.
-# TODO: User needs to download the SAM model checkpoint file 'sam_vit_b_01ec64.pth'
-# embedding_service = EmbeddingService(
-#     checkpoint_path=settings.SAM_CHECKPOINT_PATH,
-#     model_type=settings.SAM_MODEL_TYPE
-# )
-embedding_service = None # Temporarily disable
+# Nothing is created at import: the settings, clients and the SAM embedding
+# engine are loaded on first use (see config.get_settings and
+# embedding_service.get_embedding_service). The settings and the clients every
+# request needs are loaded in the lifespan hook below, once per uvicorn worker,
+# so a misconfiguration stops the server at startup.
 
 # --------------------------------------------------------------------------
-# Rate Limiting Setup
+# Application Lifespan
 # --------------------------------------------------------------------------
-# Limits API requests to prevent abuse.
-limiter = Limiter(key_func=get_remote_address, default_limits=["100 per minute"])
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_settings()
+    get_async_redis_client()
+    get_async_redis_binary_client()
+    # Rate limits are declared per route (see core/rate_limit.py).
+    app.state.limiter = get_limiter()
+    # Create the blob storage client now, so the first request does not pay for it.
+    await run_in_threadpool(get_blob_storage().connect)
+    yield
+    # Stop the shared session events subscription on shutdown.
+    await session_event_broker.close()
 
 # --------------------------------------------------------------------------
 # FastAPI App Initialization
@@ -38,24 +54,44 @@ app = FastAPI(
     title="AI Wallpaper Generator API",
     description="API for creating and managing wallpaper generation sessions.",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
-app.state.limiter = limiter
-# app.state.embedding_service = embedding_service # Temporarily disable
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 # --------------------------------------------------------------------------
 # CORS (Cross-Origin Resource Sharing) Middleware
 # --------------------------------------------------------------------------
 # Allows the frontend application to communicate with this API.
+class _CORSMiddleware(CORSMiddleware):
+    """Reads the allowed origins when the app builds its middleware stack, not at import."""
+    def __init__(self, app, **kwargs):
+        super().__init__(app, allow_origins=settings.CORS_ORIGINS, **kwargs)
+
 app.add_middleware(
-    CORSMiddleware,
-    allow_origins=settings.CORS_ORIGINS,
+    _CORSMiddleware,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+# --------------------------------------------------------------------------
+# Request Metrics Middleware
+# --------------------------------------------------------------------------
+# Records the duration of every request, labelled with the route template
+# (e.g. /v1/sessions/{session_id}/status) so session IDs do not become labels.
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.labels(
+        request.method,
+        route.path if route is not None else "unmatched",
+        str(response.status_code),
+    ).observe(time.perf_counter() - started)
+    return response
+
 # --------------------------------------------------------------------------
 # Health Check Endpoint
 # --------------------------------------------------------------------------
@@ -66,8 +102,20 @@ async def health_check():
     """
     return {"status": "ok"}
 
+# --------------------------------------------------------------------------
+# Metrics Endpoint
+# --------------------------------------------------------------------------
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Exposes the API's Prometheus metrics (request durations, stage timings, cache hit rates).
+    """
+    body, content_type = render_latest()
+    return Response(content=body, media_type=content_type)
+
 # --------------------------------------------------------------------------
 # API Routers
 # --------------------------------------------------------------------------
 # Includes the routers for different parts of the API.
 app.include_router(sessions_router)
+app.include_router(webhooks_router)
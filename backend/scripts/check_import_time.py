@@ -0,0 +1,94 @@
+"""
+Checks that importing the API and the Celery task modules stays fast.
+
+Usage:
+    python backend/scripts/check_import_time.py [--runs 5] [--scale 1.0]
+
+Each entry point is imported in a fresh interpreter with `python -X importtime`.
+The check fails (exit code 1) if the fastest run exceeds the module's budget, if
+the import pulls in a heavy dependency that must only be loaded on first use
+(the SAM model runtimes, the Replicate and AWS SDKs), or if it loads the settings:
+they are loaded, and clients created, in the FastAPI lifespan and Celery
+worker_process_init hooks. Use --scale on slow machines, e.g. --scale 2 doubles
+every budget.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Dependencies no entry point may load at import time.
+DEFERRED_MODULES = ["torch", "segment_anything", "onnxruntime", "replicate", "boto3"]
+
+# Entry point -> (budget in milliseconds, extra modules it must not load).
+BUDGETS = {
+    "backend.main": (1200, []),
+    "backend.worker.worker": (900, ["fastapi"]),
+    "backend.worker.embedding_worker": (900, ["fastapi"]),
+    "backend.worker.housekeeping": (900, ["fastapi"]),
+}
+
+def measure(module: str) -> tuple[float, set[str], bool]:
+    """
+    Imports a module in a fresh interpreter. Returns its cumulative import time in ms,
+    sys.modules, and whether the import loaded the settings.
+    """
+    code = (
+        f"import sys, json, {module}; from backend.core.config import get_settings; "
+        f"print(json.dumps([sorted(sys.modules), get_settings.cache_info().currsize > 0]))"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [PROJECT_ROOT, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True, text=True, cwd=PROJECT_ROOT, env=env, check=False,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    # Lines look like "import time:   self [us] | cumulative | imported package".
+    cumulative_us = None
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            cumulative_us = int(cumulative)
+    if cumulative_us is None:
+        raise RuntimeError(f"No import time reported for {module}.")
+    modules, settings_loaded = json.loads(result.stdout)
+    return cumulative_us / 1000, set(modules), settings_loaded
+
+def check(runs: int, scale: float) -> bool:
+    ok = True
+    print(f"{'module':<36}{'ms':>10}{'budget':>10}  result")
+    for module, (budget_ms, extra_deferred) in BUDGETS.items():
+        timings = []
+        loaded = set()
+        settings_loaded = False
+        for _ in range(runs):
+            elapsed_ms, loaded, settings_loaded = measure(module)
+            timings.append(elapsed_ms)
+        fastest = min(timings)
+        budget = budget_ms * scale
+        problems = []
+        if fastest > budget:
+            problems.append("over budget")
+        eager = [name for name in DEFERRED_MODULES + extra_deferred if name in loaded]
+        if eager:
+            problems.append(f"loads {', '.join(eager)}")
+        if settings_loaded:
+            problems.append("loads the settings")
+        ok = ok and not problems
+        print(f"{module:<36}{fastest:>10.0f}{budget:>10.0f}  {'; '.join(problems) or 'ok'}")
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Imports per module; the fastest counts.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier applied to every budget.")
+    args = parser.parse_args()
+    sys.exit(0 if check(args.runs, args.scale) else 1)
@@ -0,0 +1,83 @@
+"""
+Exports the SAM prompt encoder and mask decoder to ONNX for server-side mask prediction.
+
+Usage:
+    python backend/scripts/export_sam_decoder.py --checkpoint sam_vit_b_01ec64.pth \
+        --model-type vit_b --output sam_vit_b_decoder.onnx
+
+The model takes an image embedding, point prompts and the original image size, and
+returns the upscaled mask logits. Unlike the browser export, the prompt axis is
+dynamic, so several prompts on the same image are decoded in one call.
+This writes the float32 model to --output and, unless --no-quantize is given,
+an int8 dynamically-quantized copy next to it ('<name>.quant.onnx').
+Point SAM_ONNX_DECODER_PATH at the file you want.
+"""
+import argparse
+import os
+import sys
+
+# Add project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+from segment_anything import sam_model_registry
+from segment_anything.utils.onnx import SamOnnxModel
+
+def export_decoder(checkpoint_path: str | None, model_type: str, output_path: str, opset: int):
+    sam = sam_model_registry[model_type](checkpoint=checkpoint_path)
+    sam.eval()
+    model = SamOnnxModel(sam, return_single_mask=True)
+
+    embed_dim = sam.prompt_encoder.embed_dim
+    embed_size = sam.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+    dummy_inputs = {
+        "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float32),
+        "point_coords": torch.randint(low=0, high=1024, size=(2, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=2, size=(2, 5), dtype=torch.float),
+        "mask_input": torch.zeros(1, 1, *mask_input_size, dtype=torch.float),
+        "has_mask_input": torch.tensor([0], dtype=torch.float),
+        "orig_im_size": torch.tensor([1536, 2048], dtype=torch.float),
+    }
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(dummy_inputs.values()),
+            output_path,
+            input_names=list(dummy_inputs.keys()),
+            output_names=["masks", "iou_predictions", "low_res_masks"],
+            # A dynamic prompt axis lets the mask decoder service decode coalesced prompts on one image in one call.
+            dynamic_axes={
+                "point_coords": {0: "prompts", 1: "num_points"},
+                "point_labels": {0: "prompts", 1: "num_points"},
+                "masks": {0: "prompts"},
+                "iou_predictions": {0: "prompts"},
+                "low_res_masks": {0: "prompts"},
+            },
+            opset_version=opset,
+            do_constant_folding=True,
+            dynamo=False,
+        )
+    print(f"Exported decoder to {output_path}")
+
+def quantize_decoder(input_path: str) -> str:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    root, ext = os.path.splitext(input_path)
+    output_path = f"{root}.quant{ext}"
+    quantize_dynamic(input_path, output_path, weight_type=QuantType.QUInt8)
+    print(f"Quantized decoder written to {output_path}")
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", required=True, help="Path to the SAM checkpoint (.pth).")
+    parser.add_argument("--model-type", default="vit_b", help="SAM model type (vit_b, vit_l, vit_h).")
+    parser.add_argument("--output", default="sam_vit_b_decoder.onnx", help="Output ONNX file.")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version.")
+    parser.add_argument("--no-quantize", action="store_true", help="Skip int8 quantization.")
+    args = parser.parse_args()
+
+    export_decoder(args.checkpoint, args.model_type, args.output, args.opset)
+    if not args.no_quantize:
+        quantize_decoder(args.output)
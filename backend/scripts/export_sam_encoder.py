@@ -0,0 +1,60 @@
+"""
+Exports the SAM image encoder to ONNX and quantizes it for the CPU embedding backend.
+
+Usage:
+    python backend/scripts/export_sam_encoder.py --checkpoint sam_vit_b_01ec64.pth \
+        --model-type vit_b --output sam_vit_b_encoder.onnx
+
+This writes the float32 model to --output and, unless --no-quantize is given,
+an int8 dynamically-quantized copy next to it ('<name>.quant.onnx').
+Point SAM_ONNX_ENCODER_PATH at the file you want and set SAM_EMBEDDING_BACKEND=onnx.
+"""
+import argparse
+import os
+import sys
+
+# Add project root to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+from segment_anything import sam_model_registry
+
+from backend.services.embedding_service import SAM_IMAGE_SIZE
+
+def export_encoder(checkpoint_path: str, model_type: str, output_path: str, opset: int):
+    sam = sam_model_registry[model_type](checkpoint=checkpoint_path)
+    sam.eval()
+    dummy_input = torch.zeros(1, 3, SAM_IMAGE_SIZE, SAM_IMAGE_SIZE, dtype=torch.float32)
+    torch.onnx.export(
+        sam.image_encoder,
+        dummy_input,
+        output_path,
+        input_names=["image"],
+        output_names=["image_embeddings"],
+        # A dynamic batch axis lets the embedding service encode micro-batches in one call.
+        dynamic_axes={"image": {0: "batch"}, "image_embeddings": {0: "batch"}},
+        opset_version=opset,
+    )
+    print(f"Exported encoder to {output_path}")
+
+def quantize_encoder(input_path: str) -> str:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    root, ext = os.path.splitext(input_path)
+    output_path = f"{root}.quant{ext}"
+    quantize_dynamic(input_path, output_path, weight_type=QuantType.QUInt8)
+    print(f"Quantized encoder written to {output_path}")
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", required=True, help="Path to the SAM checkpoint (.pth).")
+    parser.add_argument("--model-type", default="vit_b", help="SAM model type (vit_b, vit_l, vit_h).")
+    parser.add_argument("--output", default="sam_vit_b_encoder.onnx", help="Output ONNX file.")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version.")
+    parser.add_argument("--no-quantize", action="store_true", help="Skip int8 quantization.")
+    args = parser.parse_args()
+
+    export_encoder(args.checkpoint, args.model_type, args.output, args.opset)
+    if not args.no_quantize:
+        quantize_encoder(args.output)
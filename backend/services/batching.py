@@ -0,0 +1,78 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """
+    Groups concurrent requests into batches and runs them on a single background thread.
+
+    Callers submit items from any thread and get a Future back. The batch thread waits
+    for the first item, then collects more for up to `max_wait_ms` (or until
+    `max_batch_size` is reached) and passes the whole batch to `batch_fn`.
+    """
+    def __init__(self, batch_fn: Callable[[list[Any]], list[Any]], max_batch_size: int,
+                 max_wait_ms: float, name: str = "micro-batcher"):
+        """
+        Args:
+            batch_fn: Function that maps a list of items to a list of results of the same length.
+            max_batch_size: The maximum number of items passed to batch_fn at once.
+            max_wait_ms: How long to wait for more items once the first one arrived.
+            name: The name of the background thread.
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_seconds = max(0.0, max_wait_ms) / 1000
+        self.name = name
+        self._queue: queue.Queue[tuple[Any, Future]] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: Any) -> Future:
+        """Queues an item and returns a Future that resolves to its result."""
+        future: Future = Future()
+        self._ensure_started()
+        self._queue.put((item, future))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _collect_batch(self) -> list[tuple[Any, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            # Skip requests whose callers have already given up.
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self.batch_fn([item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"{self.name}: expected {len(batch)} results, got {len(results)}.")
+            except Exception as e:
+                logger.error(f"{self.name}: batch of {len(batch)} failed: {e}", exc_info=True)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,333 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from typing import BinaryIO, Iterator
+from urllib.parse import quote
+
+from botocore.exceptions import ClientError
+
+from backend.core.config import settings
+
+
+# Content-addressed blobs never change, so they can be cached indefinitely.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def digest_key(digest: str, prefix: str, extension: str = "") -> str:
+    """
+    Builds the key of a blob from its SHA-256 hex digest.
+
+    Returns:
+        A key of the form '<prefix>/<sha256[:2]>/<sha256><extension>'.
+    """
+    return f"{prefix}/{digest[:2]}/{digest}{extension}"
+
+def content_key(data: bytes, prefix: str, extension: str = "") -> str:
+    """
+    Builds a content-addressed key for a blob.
+
+    Args:
+        data: The blob contents.
+        prefix: The namespace of the blob (e.g. 'originals').
+        extension: An optional file extension, including the leading dot.
+
+    Returns:
+        A key of the form '<prefix>/<sha256[:2]>/<sha256><extension>'.
+    """
+    return digest_key(hashlib.sha256(data).hexdigest(), prefix, extension)
+
+
+class BlobStorage:
+    """
+    Base class for blob storage backends.
+    Sessions only keep the key of a blob; the bytes live in the backend.
+    """
+    # Content-addressed blobs older than this are rewritten instead of reused, so the
+    # housekeeping sweep never deletes a blob that was just reused (see has_recent).
+    refresh_after_seconds: float | None = None
+
+    def connect(self) -> None:
+        """
+        Creates the backend's client ahead of its first use. Clients are otherwise created
+        lazily, so they are never shared between the processes of a prefork worker.
+        """
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream",
+            cache_control: str | None = None) -> None:
+        raise NotImplementedError
+
+    def put_stream(self, key: str, stream: BinaryIO, content_type: str = "application/octet-stream",
+                   cache_control: str | None = None) -> None:
+        """Stores a blob from a binary stream without reading it into memory at once."""
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    def url(self, key: str) -> str:
+        """Returns a URL clients can use to download the blob."""
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def last_modified(self, key: str) -> float | None:
+        """Returns the blob's last modified timestamp, or None if it does not exist."""
+        raise NotImplementedError
+
+    def has_recent(self, key: str) -> bool:
+        """
+        Checks whether a blob exists and was written recently enough to be reused.
+        Housekeeping only deletes blobs older than its grace period, which is twice
+        refresh_after_seconds, so a reused blob stays safe until its next reference is seen.
+        """
+        if self.refresh_after_seconds is None:
+            return self.exists(key)
+        modified = self.last_modified(key)
+        return modified is not None and modified > time.time() - self.refresh_after_seconds
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def list(self, prefix: str) -> Iterator[tuple[str, float]]:
+        """Yields (key, last modified timestamp) for every blob whose key starts with prefix."""
+        raise NotImplementedError
+
+    def put_content_addressed(
+        self,
+        data: bytes,
+        prefix: str,
+        extension: str = "",
+        content_type: str = "application/octet-stream"
+    ) -> str:
+        """
+        Stores a blob under its content hash. Identical blobs are stored only once.
+
+        Args:
+            data: The blob contents.
+            prefix: The namespace of the blob (e.g. 'originals').
+            extension: An optional file extension, including the leading dot.
+            content_type: The MIME type of the blob.
+
+        Returns:
+            The key of the stored blob.
+        """
+        key = content_key(data, prefix, extension)
+        if not self.has_recent(key):
+            self.put(key, data, content_type)
+        return key
+
+
+class S3BlobStorage(BlobStorage):
+    """
+    Blob storage backed by S3 or an S3-compatible service such as MinIO.
+    """
+    def __init__(self, bucket: str, endpoint_url: str | None = None, region_name: str | None = None,
+                 access_key_id: str | None = None, secret_access_key: str | None = None,
+                 public_base_url: str | None = None, url_expires_seconds: int = 3600):
+        self.bucket = bucket
+        self.public_base_url = public_base_url
+        self.url_expires_seconds = url_expires_seconds
+        self._client_options = {
+            "endpoint_url": endpoint_url,
+            "region_name": region_name,
+            "aws_access_key_id": access_key_id,
+            "aws_secret_access_key": secret_access_key,
+        }
+        self._client = None
+        self._transfer_config = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> None:
+        # boto3 takes a while to import, so it is only loaded once S3 is used.
+        if self._client is not None:
+            return
+        with self._lock:
+            if self._client is None:
+                import boto3
+                from boto3.s3.transfer import TransferConfig
+
+                # Streams above 8 MB are sent as a multipart upload.
+                self._transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                                       multipart_chunksize=8 * 1024 * 1024)
+                self._client = boto3.client("s3", **self._client_options)
+
+    @property
+    def client(self):
+        self.connect()
+        return self._client
+
+    @property
+    def transfer_config(self):
+        self.connect()
+        return self._transfer_config
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream",
+            cache_control: str | None = None) -> None:
+        extra = {"CacheControl": cache_control} if cache_control else {}
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type, **extra)
+
+    def put_stream(self, key: str, stream: BinaryIO, content_type: str = "application/octet-stream",
+                   cache_control: str | None = None) -> None:
+        extra_args = {"ContentType": content_type}
+        if cache_control:
+            extra_args["CacheControl"] = cache_control
+        self.client.upload_fileobj(stream, self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config)
+
+    def get(self, key: str) -> bytes:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                raise KeyError(key) from e
+            raise
+        return response["Body"].read()
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound"):
+                return False
+            raise
+        return True
+
+    def last_modified(self, key: str) -> float | None:
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound"):
+                return None
+            raise
+        return response["LastModified"].timestamp()
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list(self, prefix: str) -> Iterator[tuple[str, float]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"], item["LastModified"].timestamp()
+
+    def url(self, key: str) -> str:
+        if self.public_base_url:
+            return f"{self.public_base_url.rstrip('/')}/{quote(key)}"
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=self.url_expires_seconds,
+        )
+
+
+class LocalBlobStorage(BlobStorage):
+    """
+    Blob storage backed by a local directory. Intended for tests and local development.
+    """
+    def __init__(self, root_dir: str, public_base_url: str | None = None):
+        self.root_dir = os.path.abspath(root_dir)
+        self.public_base_url = public_base_url
+
+    def _path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root_dir, key))
+        if not path.startswith(self.root_dir + os.sep):
+            raise ValueError(f"Invalid blob key: {key}")
+        return path
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream",
+            cache_control: str | None = None) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial blob. Its name is
+        # unique per thread, since threads of one process may write the same blob at once.
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put_stream(self, key: str, stream: BinaryIO, content_type: str = "application/octet-stream",
+                   cache_control: str | None = None) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(stream, f)
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError as e:
+            raise KeyError(key) from e
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def last_modified(self, key: str) -> float | None:
+        try:
+            return os.path.getmtime(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix: str) -> Iterator[tuple[str, float]]:
+        for dir_path, _, file_names in os.walk(self.root_dir):
+            for file_name in file_names:
+                if file_name.endswith(".tmp"):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(path, self.root_dir).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    try:
+                        yield key, os.path.getmtime(path)
+                    except FileNotFoundError:
+                        pass
+
+    def url(self, key: str) -> str:
+        if self.public_base_url:
+            return f"{self.public_base_url.rstrip('/')}/{quote(key)}"
+        return f"file://{quote(self._path(key))}"
+
+
+def create_blob_storage() -> BlobStorage:
+    """
+    Creates the blob storage backend selected by BLOB_STORAGE_BACKEND.
+    """
+    if settings.BLOB_STORAGE_BACKEND == "local":
+        storage = LocalBlobStorage(settings.BLOB_STORAGE_LOCAL_DIR, settings.BLOB_PUBLIC_BASE_URL)
+    elif settings.BLOB_STORAGE_BACKEND == "s3":
+        storage = S3BlobStorage(
+            bucket=settings.S3_BUCKET_NAME,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            region_name=settings.S3_REGION_NAME,
+            access_key_id=settings.AWS_ACCESS_KEY_ID,
+            secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            public_base_url=settings.BLOB_PUBLIC_BASE_URL,
+            url_expires_seconds=settings.BLOB_URL_EXPIRES_SECONDS,
+        )
+    else:
+        raise ValueError(f"Unknown blob storage backend: {settings.BLOB_STORAGE_BACKEND}")
+    storage.refresh_after_seconds = settings.HOUSEKEEPING_BLOB_GRACE_SECONDS / 2
+    return storage
+
+_blob_storage: BlobStorage | None = None
+_blob_storage_lock = threading.Lock()
+
+def get_blob_storage() -> BlobStorage:
+    """
+    Returns the process-wide blob storage, creating it on first use. Its client is
+    created by connect(), which the API lifespan and worker_process_init call.
+    """
+    global _blob_storage
+    if _blob_storage is None:
+        with _blob_storage_lock:
+            if _blob_storage is None:
+                _blob_storage = create_blob_storage()
+    return _blob_storage
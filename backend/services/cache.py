@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from backend.core.metrics import CACHE_REQUESTS
+
+class LRUCache:
+    """
+    A small thread-safe in-process LRU cache.
+    If a name is given, lookups are counted in the cache metrics under that name.
+    """
+    def __init__(self, max_items: int, name: str | None = None):
+        self.max_items = max_items
+        self.name = name
+        self._items: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self._count("miss")
+                return None
+            self._items.move_to_end(key)
+            self._count("hit")
+            return value
+
+    def _count(self, result: str) -> None:
+        if self.name:
+            CACHE_REQUESTS.labels(self.name, result).inc()
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
@@ -1,58 +1,141 @@
-import replicate
-import requests
+import io
+import threading
+from typing import BinaryIO, Union
+
+import numpy as np
 from backend.core.config import settings
+from backend.core.metrics import stage_timer
+from backend.services.mask_codec import encode_png
+
+# Diffusion inputs can be passed as bytes or as any readable binary stream.
+ImageInput = Union[bytes, BinaryIO]
+# Masks can also be passed as boolean arrays; they are rasterized to PNG on upload.
+MaskInput = Union[ImageInput, np.ndarray]
 
 class DiffusionClient:
     """
     A client for interacting with the Replicate API for image generation.
     """
     def __init__(self, api_token: str):
+        import replicate
+
         self.client = replicate.Client(api_token=api_token)
 
+    def _upload(self, image: ImageInput, filename: str) -> str:
+        """Uploads an in-memory image or stream to Replicate and returns its URL."""
+        stream = io.BytesIO(image) if isinstance(image, (bytes, bytearray, memoryview)) else image
+        stream.seek(0)
+        return self.client.files.create(stream, filename=filename).urls["get"]
+
+    def upload_inputs(self, original_image: ImageInput, mask_image: MaskInput,
+                      wallpaper_image: ImageInput) -> dict:
+        """
+        Uploads the inputs of a wallpaper generation to Replicate.
+
+        Args:
+            original_image: The original interior image (JPEG), as bytes or a binary stream.
+            mask_image: The mask, as a boolean array or as a PNG in bytes or a binary stream.
+            wallpaper_image: The wallpaper pattern image, as bytes or a binary stream.
+
+        Returns:
+            The model input referencing the uploaded files, to pass to submit_wallpaper.
+        """
+        if isinstance(mask_image, np.ndarray):
+            mask_image = encode_png(mask_image)
+        with stage_timer("diffusion", "upload_inputs"):
+            return {
+                "image": self._upload(original_image, "original.jpg"),
+                "mask": self._upload(mask_image, "mask.png"),
+                "prompt": settings.DIFFUSION_PROMPT,
+                "control_image": self._upload(wallpaper_image, "wallpaper.jpg"),
+            }
+
+    @staticmethod
+    def parse_output(output) -> str:
+        """
+        Extracts the result URL from a prediction's output.
+
+        Raises:
+            Exception: If the output does not contain a result.
+        """
+        if not output or not isinstance(output, list) or not output[0]:
+            raise Exception("Invalid response from Replicate API.")
+        return str(output[0])
+
     def generate_wallpaper(
         self,
-        original_image_path: str,
-        mask_image_path: str,
-        wallpaper_image_path: str
+        original_image: ImageInput,
+        mask_image: MaskInput,
+        wallpaper_image: ImageInput
     ) -> str:
         """
         Calls the Replicate API to generate a new wallpaper by applying a pattern
-        to a masked area of an original image.
+        to a masked area of an original image, and waits for the result.
 
         Args:
-            original_image_path: Path to the original interior image.
-            mask_image_path: Path to the mask image.
-            wallpaper_image_path: Path to the wallpaper pattern image.
+            original_image: The original interior image (JPEG), as bytes or a binary stream.
+            mask_image: The mask, as a boolean array or as a PNG in bytes or a binary stream.
+            wallpaper_image: The wallpaper pattern image, as bytes or a binary stream.
 
         Returns:
             The URL of the generated image.
         """
         print("Starting wallpaper generation via Replicate API...")
-        
-        # Using a model suitable for inpainting with a pattern (ControlNet Tile)
-        model_version = "diffusers/controlnet-tile-sdxl-1.0:69958813b3d86c8837a5b6b2334a3e5013a5a0c8a39528774a9404e8504634d8"
-        
-        with open(original_image_path, "rb") as original_image, \
-             open(mask_image_path, "rb") as mask_image, \
-             open(wallpaper_image_path, "rb") as wallpaper_image:
-            
+
+        model_input = self.upload_inputs(original_image, mask_image, wallpaper_image)
+        # Includes the time the prediction waits in Replicate's queue.
+        with stage_timer("diffusion", "inference"):
             output = self.client.run(
-                model_version,
-                input={
-                    "image": original_image,
-                    "mask": mask_image,
-                    "prompt": "Applying a new wallpaper pattern to the specified wall area",
-                    "control_image": wallpaper_image,
-                }
+                settings.DIFFUSION_MODEL_VERSION,
+                input=model_input,
+                use_file_output=False
             )
-        
-        if not output or not isinstance(output, list) or not output[0]:
-            raise Exception("Invalid response from Replicate API.")
-            
-        result_url = output[0]
+        result_url = self.parse_output(output)
         print(f"Generation finished. Result URL: {result_url}")
 
         return result_url
 
-# Create a single instance of the client
-diffusion_client = DiffusionClient(api_token=settings.REPLICATE_API_TOKEN)
+    def submit_wallpaper(self, model_input: dict, webhook_url: str | None = None) -> str:
+        """
+        Creates a wallpaper generation prediction without waiting for it to finish.
+
+        Args:
+            model_input: The uploaded inputs, as returned by upload_inputs.
+            webhook_url: If given, Replicate calls it once the prediction has completed.
+
+        Returns:
+            The ID of the created prediction.
+        """
+        params = {}
+        if webhook_url:
+            params = {"webhook": webhook_url, "webhook_events_filter": ["completed"]}
+        with stage_timer("diffusion", "submit"):
+            prediction = self.client.predictions.create(
+                version=settings.DIFFUSION_MODEL_VERSION.split(":", 1)[1],
+                input=model_input,
+                **params
+            )
+        print(f"Submitted wallpaper generation. Prediction ID: {prediction.id}")
+        return prediction.id
+
+    def get_prediction(self, prediction_id: str):
+        """Fetches the current state of a prediction."""
+        return self.client.predictions.get(prediction_id)
+
+    def cancel_prediction(self, prediction_id: str):
+        """Cancels a running prediction."""
+        self.client.predictions.cancel(prediction_id)
+
+_diffusion_client: DiffusionClient | None = None
+_diffusion_client_lock = threading.Lock()
+
+def get_diffusion_client() -> DiffusionClient:
+    """
+    Returns the process-wide DiffusionClient, creating it on first use.
+    """
+    global _diffusion_client
+    if _diffusion_client is None:
+        with _diffusion_client_lock:
+            if _diffusion_client is None:
+                _diffusion_client = DiffusionClient(api_token=settings.REPLICATE_API_TOKEN)
+    return _diffusion_client
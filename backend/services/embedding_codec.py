@@ -0,0 +1,141 @@
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+# --- Binary Embedding Format ---
+# Little-endian layout:
+#   magic      4s   b"SEMB"
+#   version    B
+#   dtype      B    0 = float32, 1 = float16, 2 = int8 (affine, per tensor)
+#   compression B   0 = none, 1 = zstd
+#   ndim       B
+#   scale      f    int8 only: x = (q - zero_point) * scale
+#   zero_point f
+#   shape      ndim x I
+#   payload    the (possibly compressed) array in C order
+EMBEDDING_MAGIC = b"SEMB"
+EMBEDDING_FORMAT_VERSION = 1
+EMBEDDING_MEDIA_TYPE = "application/x-sam-embedding"
+
+_HEADER = struct.Struct("<4sBBBBff")
+
+DTYPES = {"float32": 0, "float16": 1, "int8": 2}
+COMPRESSIONS = {"none": 0, "zstd": 1}
+
+_NUMPY_DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2"), 2: np.dtype("i1")}
+
+
+class EmbeddingHeader(NamedTuple):
+    version: int
+    dtype: str
+    compression: str
+    shape: tuple[int, ...]
+    scale: float
+    zero_point: float
+    payload_offset: int
+
+
+def _quantize_int8(embedding: np.ndarray) -> tuple[np.ndarray, float, float]:
+    low, high = float(embedding.min()), float(embedding.max())
+    scale = (high - low) / 255 or 1.0
+    zero_point = -128 - low / scale
+    quantized = np.clip(np.rint(embedding / scale + zero_point), -128, 127).astype(np.int8)
+    return quantized, scale, zero_point
+
+
+def encode_embedding(embedding: np.ndarray, dtype: str = "float16", compression: str = "zstd",
+                     level: int = 3) -> bytes:
+    """
+    Serializes an embedding into the compact binary format.
+
+    Args:
+        embedding: The float32 embedding, e.g. of shape (1, 256, 64, 64).
+        dtype: The storage dtype: 'float32', 'float16' or 'int8'.
+        compression: 'zstd' or 'none'.
+        level: The zstd compression level.
+
+    Returns:
+        The encoded bytes, header included.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported embedding compression: {compression}")
+    if compression == "zstd" and zstandard is None:
+        raise RuntimeError("zstd compression requires the 'zstandard' package.")
+
+    scale, zero_point = 1.0, 0.0
+    if dtype == "int8":
+        payload, scale, zero_point = _quantize_int8(embedding)
+    else:
+        payload = embedding.astype(_NUMPY_DTYPES[DTYPES[dtype]], copy=False)
+    payload_bytes = np.ascontiguousarray(payload).tobytes()
+    if compression == "zstd":
+        payload_bytes = zstandard.ZstdCompressor(level=level).compress(payload_bytes)
+
+    header = _HEADER.pack(
+        EMBEDDING_MAGIC, EMBEDDING_FORMAT_VERSION, DTYPES[dtype], COMPRESSIONS[compression],
+        embedding.ndim, scale, zero_point
+    )
+    shape = struct.pack(f"<{embedding.ndim}I", *embedding.shape)
+    return header + shape + payload_bytes
+
+
+def read_embedding_header(data: bytes) -> EmbeddingHeader:
+    """
+    Parses and validates the header of an encoded embedding.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("Encoded embedding is truncated.")
+    magic, version, dtype_code, compression_code, ndim, scale, zero_point = _HEADER.unpack_from(data)
+    if magic != EMBEDDING_MAGIC:
+        raise ValueError("Not an encoded embedding.")
+    if version != EMBEDDING_FORMAT_VERSION:
+        raise ValueError(f"Unsupported embedding format version: {version}")
+    dtype = next((name for name, code in DTYPES.items() if code == dtype_code), None)
+    compression = next((name for name, code in COMPRESSIONS.items() if code == compression_code), None)
+    if dtype is None or compression is None:
+        raise ValueError("Unknown embedding dtype or compression.")
+    if len(data) < _HEADER.size + 4 * ndim:
+        raise ValueError("Encoded embedding is truncated.")
+    shape = struct.unpack_from(f"<{ndim}I", data, _HEADER.size)
+    return EmbeddingHeader(version, dtype, compression, shape, scale, zero_point,
+                           _HEADER.size + 4 * ndim)
+
+
+def decode_embedding(data: bytes) -> np.ndarray:
+    """
+    Deserializes an encoded embedding.
+
+    Args:
+        data: Bytes produced by encode_embedding.
+
+    Returns:
+        The embedding as a float32 array.
+
+    Raises:
+        ValueError: If the data is not a valid encoded embedding.
+    """
+    header = read_embedding_header(data)
+    payload = memoryview(data)[header.payload_offset:]
+    if header.compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Decoding a zstd embedding requires the 'zstandard' package.")
+        try:
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Corrupt embedding payload: {e}") from e
+
+    dtype = _NUMPY_DTYPES[DTYPES[header.dtype]]
+    if len(payload) != dtype.itemsize * int(np.prod(header.shape)):
+        raise ValueError("Embedding payload does not match its shape.")
+    array = np.frombuffer(payload, dtype=dtype).reshape(header.shape)
+    if header.dtype == "int8":
+        return ((array.astype(np.float32) - header.zero_point) * header.scale).astype(np.float32)
+    return array.astype(np.float32)
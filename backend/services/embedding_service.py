@@ -1,26 +1,173 @@
+import hashlib
+import io
+import threading
+from concurrent.futures import Future
+
 import numpy as np
-from segment_anything import sam_model_registry, SamPredictor
 from PIL import Image
-import io
+
+from backend.core.config import settings
+from backend.services.batching import MicroBatcher
+from backend.services.cache import LRUCache
+
+# SAM encoder input: the longest side is resized to 1024 and the rest is zero-padded.
+SAM_IMAGE_SIZE = 1024
+SAM_PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32).reshape(3, 1, 1)
+SAM_PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32).reshape(3, 1, 1)
+
+def preprocess_image(image_bytes: bytes) -> np.ndarray:
+    """
+    Converts an image into the normalized, padded tensor expected by the SAM image encoder.
+    Mirrors SamPredictor.set_image (ResizeLongestSide + Sam.preprocess).
+
+    Args:
+        image_bytes (bytes): The image in bytes.
+
+    Returns:
+        np.ndarray: A float32 array of shape (3, 1024, 1024).
+    """
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    scale = SAM_IMAGE_SIZE / max(image.width, image.height)
+    new_size = (int(image.width * scale + 0.5), int(image.height * scale + 0.5))
+    image = image.resize(new_size, Image.BILINEAR)
+
+    pixels = np.asarray(image, dtype=np.float32).transpose(2, 0, 1)
+    pixels = (pixels - SAM_PIXEL_MEAN) / SAM_PIXEL_STD
+
+    tensor = np.zeros((3, SAM_IMAGE_SIZE, SAM_IMAGE_SIZE), dtype=np.float32)
+    tensor[:, :pixels.shape[1], :pixels.shape[2]] = pixels
+    return tensor
+
+
+class TorchSamEncoder:
+    """
+    Runs the SAM image encoder with PyTorch on CPU.
+    """
+    def __init__(self, checkpoint_path: str, model_type: str, num_threads: int = 0):
+        import torch
+        from segment_anything import sam_model_registry
+
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        print(f"Loading SAM model from {checkpoint_path}...")
+        sam = sam_model_registry[model_type](checkpoint=checkpoint_path)
+        sam.to(device='cpu')  # Or 'cuda' if you have a GPU
+        sam.eval()
+        self.image_encoder = sam.image_encoder
+        self._torch = torch
+        print("SAM model loaded successfully.")
+
+    def encode(self, batch: np.ndarray) -> np.ndarray:
+        with self._torch.inference_mode():
+            return self.image_encoder(self._torch.from_numpy(batch)).numpy()
+
+
+class OnnxSamEncoder:
+    """
+    Runs an exported (optionally int8-quantized) SAM image encoder with ONNX Runtime on CPU.
+    See backend/scripts/export_sam_encoder.py for producing the model file.
+    """
+    def __init__(self, model_path: str, num_threads: int = 0):
+        import onnxruntime as ort
+
+        print(f"Loading ONNX SAM encoder from {model_path}...")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Exports with a fixed batch dimension can only run one image at a time.
+        self.supports_batching = not isinstance(model_input.shape[0], int) or model_input.shape[0] != 1
+        print("ONNX SAM encoder loaded successfully.")
+
+    def encode(self, batch: np.ndarray) -> np.ndarray:
+        if self.supports_batching:
+            return self.session.run(None, {self.input_name: batch})[0]
+        return np.concatenate([
+            self.session.run(None, {self.input_name: batch[i:i + 1]})[0]
+            for i in range(batch.shape[0])
+        ])
+
 
 class EmbeddingService:
-    def __init__(self, checkpoint_path: str, model_type: str):
+    """
+    Generates SAM image embeddings.
+
+    Concurrent requests are micro-batched into a single encoder pass, identical
+    images are coalesced, and results are cached by image content hash.
+    """
+    def __init__(self, encoder, max_batch_size: int = 4, max_batch_wait_ms: float = 10,
+                 cache_size: int = 32):
         """
         Initializes the EmbeddingService.
 
         Args:
-            checkpoint_path (str): Path to the SAM model checkpoint.
-            model_type (str): The type of the SAM model (e.g., 'vit_b').
+            encoder: A TorchSamEncoder or OnnxSamEncoder.
+            max_batch_size (int): The maximum number of images per encoder pass.
+            max_batch_wait_ms (float): How long to wait for a batch to fill up.
+            cache_size (int): The number of embeddings kept in the LRU cache.
         """
-        print(f"Loading SAM model from {checkpoint_path}...")
-        sam = sam_model_registry[model_type](checkpoint=checkpoint_path)
-        sam.to(device='cpu')  # Or 'cuda' if you have a GPU
-        self.predictor = SamPredictor(sam)
-        print("SAM model loaded successfully.")
+        self.encoder = encoder
+        self.cache = LRUCache(cache_size, name="sam_embedding")
+        self._batcher = MicroBatcher(self._encode_batch, max_batch_size, max_batch_wait_ms,
+                                     name="sam-embedding")
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def _encode_batch(self, tensors: list[np.ndarray]) -> list[np.ndarray]:
+        embeddings = self.encoder.encode(np.stack(tensors))
+        return [embeddings[i:i + 1] for i in range(len(tensors))]
+
+    def submit(self, image_bytes: bytes) -> Future:
+        """
+        Queues an image for embedding.
+
+        Args:
+            image_bytes (bytes): The image in bytes.
+
+        Returns:
+            Future: Resolves to the image embedding of shape (1, 256, 64, 64).
+        """
+        key = hashlib.sha256(image_bytes).hexdigest()
+        cached = self.cache.get(key)
+        if cached is not None:
+            future: Future = Future()
+            future.set_result(cached)
+            return future
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._in_flight[key] = future
+
+        def _finish(batch_future: Future):
+            with self._lock:
+                self._in_flight.pop(key, None)
+            if future.cancelled():
+                return
+            if batch_future.exception() is not None:
+                future.set_exception(batch_future.exception())
+                return
+            self.cache.put(key, batch_future.result())
+            future.set_result(batch_future.result())
+
+        try:
+            tensor = preprocess_image(image_bytes)
+        except Exception as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            return future
+        self._batcher.submit(tensor).add_done_callback(_finish)
+        return future
 
     def generate_embedding_from_bytes(self, image_bytes: bytes) -> np.ndarray:
         """
-        Generates an embedding for a given image.
+        Generates an embedding for a given image, blocking until it is ready.
 
         Args:
             image_bytes (bytes): The image in bytes.
@@ -28,25 +175,34 @@ class EmbeddingService:
         Returns:
             np.ndarray: The image embedding as a NumPy array.
         """
-        image = Image.open(io.BytesIO(image_bytes))
-        image = image.convert("RGB")
-        
-        # SAM expects a BGR image, but PIL opens in RGB.
-        # The predictor handles the conversion internally.
-        # No need to convert to numpy array and swap channels manually.
-        
-        print("Generating image embedding...")
-        self.predictor.set_image(np.array(image))
-        image_embedding = self.predictor.get_image_embedding().cpu().numpy()
-        print("Image embedding generated successfully.")
-        
-        return image_embedding
-
-# Example of how to initialize and use the service (for later use in main.py)
-#
-# from .config import settings
-#
-# embedding_service = EmbeddingService(
-#     checkpoint_path=settings.SAM_CHECKPOINT_PATH,
-#     model_type=settings.SAM_MODEL_TYPE
-# )
+        return self.submit(image_bytes).result()
+
+
+_embedding_service: EmbeddingService | None = None
+_embedding_service_lock = threading.Lock()
+
+def get_embedding_service() -> EmbeddingService:
+    """
+    Returns the process-wide EmbeddingService, loading the model on first use.
+    """
+    global _embedding_service
+    if _embedding_service is None:
+        with _embedding_service_lock:
+            if _embedding_service is None:
+                if settings.SAM_EMBEDDING_BACKEND == "onnx":
+                    encoder = OnnxSamEncoder(settings.SAM_ONNX_ENCODER_PATH, settings.SAM_ENCODER_THREADS)
+                elif settings.SAM_EMBEDDING_BACKEND == "torch":
+                    encoder = TorchSamEncoder(
+                        settings.SAM_CHECKPOINT_PATH,
+                        settings.SAM_MODEL_TYPE,
+                        settings.SAM_ENCODER_THREADS
+                    )
+                else:
+                    raise ValueError(f"Unknown SAM embedding backend: {settings.SAM_EMBEDDING_BACKEND}")
+                _embedding_service = EmbeddingService(
+                    encoder,
+                    max_batch_size=settings.SAM_EMBEDDING_BATCH_SIZE,
+                    max_batch_wait_ms=settings.SAM_EMBEDDING_BATCH_WAIT_MS,
+                    cache_size=settings.SAM_EMBEDDING_CACHE_SIZE,
+                )
+    return _embedding_service
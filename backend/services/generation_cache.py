@@ -0,0 +1,153 @@
+import hashlib
+import json
+import time
+
+from backend.core.config import settings
+from backend.core import constants
+from backend.services.redis_client import RedisScript
+
+# --- Lua Scripts ---
+# Each step runs atomically in Redis, so a waiter can never register after the
+# owner has already published its result (and would otherwise wait forever).
+
+# KEYS: result, in-flight, waiters, in-flight set, generation queue.
+# ARGV: session_id, in-flight TTL, cache key, now, max in flight, max queue depth.
+# Returns {"hit", result} | {"owner", ""} | {"waiter", ""} | {"busy", ""}.
+# Only a new generation needs capacity; hits and waiters are always admitted.
+_ADMIT_LUA = """
+local result = redis.call('GET', KEYS[1])
+if result then
+    return {'hit', result}
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    -- Drop slots of generations that never reported back (e.g. lost workers).
+    redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', tonumber(ARGV[4]) - tonumber(ARGV[2]))
+    if redis.call('ZCARD', KEYS[4]) >= tonumber(ARGV[5])
+            or redis.call('LLEN', KEYS[5]) >= tonumber(ARGV[6]) then
+        return {'busy', ''}
+    end
+    redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+    redis.call('ZADD', KEYS[4], ARGV[4], ARGV[3])
+    return {'owner', ''}
+end
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('EXPIRE', KEYS[3], ARGV[2])
+return {'waiter', ''}
+"""
+
+# KEYS: result, in-flight, waiters, in-flight set. ARGV: result, result TTL, cache key.
+# Stores the result, releases the in-flight marker and returns the waiting sessions.
+_STORE_LUA = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[4], ARGV[3])
+local waiters = redis.call('SMEMBERS', KEYS[3])
+redis.call('DEL', KEYS[3])
+return waiters
+"""
+
+# KEYS: in-flight, waiters, in-flight set. ARGV: cache key.
+# Releases the in-flight marker and returns the waiting sessions.
+_RELEASE_LUA = """
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+local waiters = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[2])
+return waiters
+"""
+
+_admit_script = RedisScript(_ADMIT_LUA, asynchronous=True)
+_store_script = RedisScript(_STORE_LUA)
+_release_script = RedisScript(_RELEASE_LUA)
+_release_script_async = RedisScript(_RELEASE_LUA, asynchronous=True)
+
+
+def generation_cache_key(image_key: str, mask_key: str, wallpaper_url: str) -> str:
+    """
+    Builds the cache key of a generation request.
+
+    The image and mask keys are already content-addressed. The wallpaper is identified
+    by its URL only, since the API never downloads it, so catalog URLs must not change
+    content; GENERATION_CACHE_VERSION invalidates every result if one did.
+    """
+    digest = hashlib.sha256()
+    for part in (
+        image_key,
+        mask_key,
+        wallpaper_url,
+        settings.DIFFUSION_MODEL_VERSION,
+        settings.DIFFUSION_PROMPT,
+        settings.GENERATION_CACHE_VERSION,
+    ):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+# Sorted set of the in-flight generations (by cache key), scored by admission time.
+INFLIGHT_SET_KEY = f"{constants.GENERATION_CACHE_KEY_PREFIX}inflight_set"
+
+def _keys(cache_key: str) -> tuple[str, str, str]:
+    prefix = constants.GENERATION_CACHE_KEY_PREFIX
+    return f"{prefix}result:{cache_key}", f"{prefix}inflight:{cache_key}", f"{prefix}waiters:{cache_key}"
+
+
+async def admit_generation(cache_key: str, session_id: str) -> tuple[str, dict | None]:
+    """
+    Decides how a generation request is served.
+
+    Returns:
+        ("hit", result_fields) if the result is cached,
+        ("owner", None) if the caller must run the generation,
+        ("waiter", None) if an identical generation is already in flight; the session
+        is completed or failed together with it,
+        ("busy", None) if a new generation would exceed GENERATION_MAX_IN_FLIGHT or
+        GENERATION_MAX_QUEUE_DEPTH.
+    """
+    outcome, result = await _admit_script(
+        keys=[*_keys(cache_key), INFLIGHT_SET_KEY, constants.GENERATION_QUEUE],
+        args=[
+            session_id,
+            settings.GENERATION_INFLIGHT_TTL_SECONDS,
+            cache_key,
+            time.time(),
+            settings.GENERATION_MAX_IN_FLIGHT,
+            settings.GENERATION_MAX_QUEUE_DEPTH,
+        ]
+    )
+    if outcome == "hit":
+        return outcome, json.loads(result)
+    return outcome, None
+
+
+def store_generation_result(cache_key: str, result_fields: dict) -> list[str]:
+    """
+    Caches the session fields of a completed generation.
+
+    Returns:
+        The IDs of the sessions that were waiting for this generation.
+    """
+    return _store_script(
+        keys=[*_keys(cache_key), INFLIGHT_SET_KEY],
+        args=[json.dumps(result_fields), settings.GENERATION_CACHE_TTL_SECONDS, cache_key]
+    )
+
+
+def release_generation(cache_key: str) -> list[str]:
+    """
+    Releases an in-flight generation that failed.
+
+    Returns:
+        The IDs of the sessions that were waiting for this generation.
+    """
+    _, inflight_key, waiters_key = _keys(cache_key)
+    return _release_script(keys=[inflight_key, waiters_key, INFLIGHT_SET_KEY], args=[cache_key])
+
+
+async def release_generation_async(cache_key: str) -> list[str]:
+    """
+    Async counterpart of release_generation, used by the API when a generation it
+    admitted could not be queued.
+    """
+    _, inflight_key, waiters_key = _keys(cache_key)
+    return await _release_script_async(keys=[inflight_key, waiters_key, INFLIGHT_SET_KEY], args=[cache_key])
@@ -0,0 +1,96 @@
+import io
+from typing import NamedTuple
+
+from fastapi import UploadFile, HTTPException
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from backend.core.config import settings
+from backend.core import constants
+
+# Decoded formats accepted for uploads (matches constants.ALLOWED_CONTENT_TYPES).
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG"}
+
+class IngestedImage(NamedTuple):
+    data: bytes
+    content_type: str
+    width: int
+    height: int
+    preview: bytes
+
+
+async def read_upload_limited(file: UploadFile, max_bytes: int,
+                              chunk_size: int = constants.UPLOAD_CHUNK_SIZE) -> bytearray:
+    """
+    Reads an upload in chunks into a single buffer and aborts as soon as it exceeds
+    max_bytes.
+
+    Raises:
+        HTTPException: 413 if the upload is larger than max_bytes.
+    """
+    too_large = HTTPException(
+        status_code=413,
+        detail=f"File is too large. Maximum size is {constants.MAX_FILE_SIZE_MB}MB."
+    )
+    if file.size is not None and file.size > max_bytes:
+        raise too_large
+
+    data = bytearray()
+    while chunk := await file.read(chunk_size):
+        if len(data) + len(chunk) > max_bytes:
+            raise too_large
+        data += chunk
+    return data
+
+
+def _encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    # Saving without exif/icc arguments drops all metadata.
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def normalize_image(image_bytes: bytes | bytearray) -> IngestedImage:
+    """
+    Decodes an uploaded image, applies its EXIF orientation, strips metadata and
+    downscales it so its long edge is at most MAX_IMAGE_LONG_EDGE. Also renders a
+    small preview. This is CPU-bound; run it in a thread pool.
+
+    Args:
+        image_bytes: The raw upload.
+
+    Returns:
+        IngestedImage: The normalized JPEG, its dimensions, and the preview JPEG.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=400, detail="The uploaded file is not a valid image.")
+    except Image.DecompressionBombError:
+        # Pillow refuses to open images declaring far more pixels than its own limit.
+        raise HTTPException(status_code=400, detail="Image dimensions are too large.")
+    if image.format not in ALLOWED_IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a JPG or PNG.")
+    if image.width * image.height > constants.MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=400, detail="Image dimensions are too large.")
+
+    max_edge = settings.MAX_IMAGE_LONG_EDGE
+    # Let the JPEG decoder downscale by a power of two while decoding, which is
+    # much cheaper than decoding the full-size photo and resizing it afterwards.
+    image.draft("RGB", (max_edge, max_edge))
+    try:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+    except (OSError, ValueError):
+        raise HTTPException(status_code=400, detail="The uploaded image could not be decoded.")
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    preview = image.copy()
+    preview.thumbnail((settings.PREVIEW_LONG_EDGE, settings.PREVIEW_LONG_EDGE), Image.LANCZOS)
+
+    return IngestedImage(
+        data=_encode_jpeg(image, settings.IMAGE_JPEG_QUALITY),
+        content_type="image/jpeg",
+        width=image.width,
+        height=image.height,
+        preview=_encode_jpeg(preview, settings.PREVIEW_JPEG_QUALITY),
+    )
@@ -0,0 +1,234 @@
+"""
+Compact encodings of binary masks.
+
+Masks are handled as boolean arrays of shape (height, width) and stored in the
+COCO run-length encoding, which takes a few hundred bytes for a typical wall mask.
+They are rasterized to PNG only when the diffusion model needs an image.
+
+Accepted payload formats:
+  - {"format": "rle", "size": [h, w], "counts": "<COCO string>" | [int, ...]}
+    Column-major run lengths, starting with a run of zeros (COCO/pycocotools layout).
+  - {"format": "bitpack", "size": [h, w], "data": "<base64>"}
+    Row-major pixels packed 8 per byte, most significant bit first (numpy.packbits).
+  - A base64 PNG string, optionally as a data URL. Kept for existing clients.
+"""
+import base64
+import binascii
+import io
+import json
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+from backend.core import constants
+
+MASK_STORAGE_CONTENT_TYPE = "application/json"
+
+# Legacy PNG masks drawn on a differently sized canvas are resampled to the image
+# size, as long as their aspect ratio matches within this relative tolerance.
+PNG_ASPECT_TOLERANCE = 0.02
+
+
+class MaskFormatError(ValueError):
+    """Raised when a mask payload is malformed or does not match its image."""
+
+
+# --- COCO RLE ---
+
+def rle_counts(mask: np.ndarray) -> np.ndarray:
+    """Returns the column-major run lengths of a mask, starting with a run of zeros."""
+    height, width = mask.shape
+    if mask.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Find the value changes in column-major order without copying the mask into
+    # that order: changes within a column, then changes between adjacent columns.
+    rows, cols = np.nonzero(mask[1:, :] != mask[:-1, :])
+    within = cols.astype(np.int64) * height + rows + 1
+    between = (np.flatnonzero(mask[-1, :-1] != mask[0, 1:]) + 1).astype(np.int64) * height
+    changes = np.sort(np.concatenate((within, between)))
+    counts = np.diff(np.concatenate(([0], changes, [mask.size])))
+    if mask[0, 0]:
+        counts = np.concatenate(([0], counts))
+    return counts
+
+
+def counts_to_string(counts) -> str:
+    """Compresses run lengths into the COCO string format (as pycocotools' rleToString)."""
+    counts = [int(c) for c in counts]
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def string_to_counts(counts: str) -> list[int]:
+    """Decompresses a COCO RLE string into run lengths (as pycocotools' rleFrString)."""
+    result = []
+    p = 0
+    while p < len(counts):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            if p >= len(counts):
+                raise MaskFormatError("Truncated RLE counts.")
+            c = ord(counts[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << (5 * k)
+        if len(result) > 2:
+            x += result[-2]
+        result.append(x)
+    return result
+
+
+def encode_rle(mask: np.ndarray) -> dict:
+    """Encodes a mask as a compressed COCO RLE payload."""
+    height, width = mask.shape
+    return {"format": "rle", "size": [height, width], "counts": counts_to_string(rle_counts(mask))}
+
+
+def decode_rle(payload: dict) -> np.ndarray:
+    """Decodes an RLE payload with either compressed or plain counts."""
+    height, width = _size(payload)
+    counts = payload.get("counts")
+    if isinstance(counts, str):
+        counts = string_to_counts(counts)
+    elif not isinstance(counts, list):
+        raise MaskFormatError("RLE counts must be a string or a list of integers.")
+    try:
+        counts = np.asarray(counts, dtype=np.int64)
+    except (TypeError, ValueError, OverflowError) as e:
+        raise MaskFormatError("RLE counts must be integers.") from e
+    if counts.ndim != 1 or not counts.size or counts.min() < 0 or counts.sum() != height * width:
+        raise MaskFormatError("RLE counts do not cover the mask size.")
+    values = np.arange(counts.size, dtype=np.int64) % 2 == 1
+    return np.repeat(values, counts).reshape((height, width), order="F")
+
+
+# --- Bit-packed ---
+
+def encode_bitpack(mask: np.ndarray) -> dict:
+    """Encodes a mask as row-major packed bits."""
+    height, width = mask.shape
+    data = base64.b64encode(np.packbits(mask.ravel()).tobytes()).decode("ascii")
+    return {"format": "bitpack", "size": [height, width], "data": data}
+
+
+def decode_bitpack(payload: dict) -> np.ndarray:
+    height, width = _size(payload)
+    packed = _b64decode(payload.get("data"))
+    if len(packed) != (height * width + 7) // 8:
+        raise MaskFormatError("Bit-packed data does not match the mask size.")
+    bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=height * width)
+    return bits.reshape((height, width)).astype(bool)
+
+
+# --- PNG ---
+
+def decode_png(mask: str) -> np.ndarray:
+    """Decodes a base64 PNG mask (optionally a data URL). Bright pixels are masked."""
+    if mask.startswith("data:"):
+        mask = mask.partition(",")[2]
+    try:
+        with Image.open(io.BytesIO(_b64decode(mask))) as image:
+            if image.width * image.height > constants.MAX_IMAGE_PIXELS:
+                raise MaskFormatError("Mask image is too large.")
+            if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+                # Transparent pixels are unmasked, as they are on the editor's canvas.
+                background = Image.new("RGBA", image.size, (0, 0, 0, 255))
+                image = Image.alpha_composite(background, image.convert("RGBA"))
+            return np.asarray(image.convert("L")) > 127
+    except Image.DecompressionBombError as e:
+        # Raised by Image.open for images declaring far more pixels than Pillow allows.
+        raise MaskFormatError("Mask image is too large.") from e
+    except (UnidentifiedImageError, OSError) as e:
+        raise MaskFormatError("Mask is not a valid PNG image.") from e
+
+
+def encode_png(mask: np.ndarray) -> bytes:
+    """Rasterizes a mask to a black and white PNG, as expected by the diffusion model."""
+    buffer = io.BytesIO()
+    Image.fromarray(mask.astype(np.uint8) * 255, mode="L").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# --- Payloads and storage ---
+
+def decode_mask_payload(payload, width: int, height: int) -> np.ndarray:
+    """
+    Decodes a client mask payload and validates it against the image size.
+    This is CPU-bound for large masks; run it in a thread pool.
+
+    Raises:
+        MaskFormatError: If the payload is malformed, empty or of the wrong size.
+    """
+    if isinstance(payload, str):
+        mask = decode_png(payload)
+        if mask.shape != (height, width):
+            mask = _resample(mask, width, height)
+    elif isinstance(payload, dict):
+        mask_format = payload.get("format")
+        if mask_format == "rle":
+            mask = decode_rle(payload)
+        elif mask_format == "bitpack":
+            mask = decode_bitpack(payload)
+        else:
+            raise MaskFormatError(f"Unknown mask format: {mask_format}")
+        if mask.shape != (height, width):
+            raise MaskFormatError(f"Mask size must be {height}x{width} (height x width).")
+    else:
+        raise MaskFormatError("Unsupported mask payload.")
+
+    if not mask.any():
+        raise MaskFormatError("Mask is empty.")
+    return mask
+
+
+def serialize_mask(mask: np.ndarray) -> bytes:
+    """Serializes a mask for storage. Equal masks serialize to equal bytes."""
+    return json.dumps(encode_rle(mask), separators=(",", ":")).encode("utf-8")
+
+
+def deserialize_mask(data: bytes) -> np.ndarray:
+    """Restores a mask stored by serialize_mask."""
+    return decode_rle(json.loads(data))
+
+
+def _size(payload: dict) -> tuple[int, int]:
+    size = payload.get("size")
+    if (not isinstance(size, list) or len(size) != 2
+            or not all(isinstance(v, int) and v > 0 for v in size)):
+        raise MaskFormatError("Mask size must be [height, width].")
+    if size[0] * size[1] > constants.MAX_IMAGE_PIXELS:
+        raise MaskFormatError("Mask is too large.")
+    return size[0], size[1]
+
+
+def _b64decode(data) -> bytes:
+    if not isinstance(data, str):
+        raise MaskFormatError("Mask data must be a base64 string.")
+    try:
+        return base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise MaskFormatError("Invalid mask encoding.") from e
+
+
+def _resample(mask: np.ndarray, width: int, height: int) -> np.ndarray:
+    mask_height, mask_width = mask.shape
+    if abs(mask_width / mask_height - width / height) > PNG_ASPECT_TOLERANCE * (width / height):
+        raise MaskFormatError(f"Mask aspect ratio does not match the {width}x{height} image.")
+    image = Image.fromarray(mask.astype(np.uint8) * 255, mode="L").resize((width, height), Image.Resampling.NEAREST)
+    return np.asarray(image) > 127
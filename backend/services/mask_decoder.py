@@ -0,0 +1,185 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from backend.core.config import settings
+from backend.services.batching import MicroBatcher
+from backend.services.cache import LRUCache
+from backend.services.embedding_service import SAM_IMAGE_SIZE
+
+# Size of the low-resolution mask prompt; it is unused, as requests carry only points.
+SAM_MASK_INPUT_SIZE = 256
+
+class OnnxSamDecoder:
+    """
+    Runs an exported SAM prompt encoder and mask decoder with ONNX Runtime on CPU.
+    See backend/scripts/export_sam_decoder.py for producing the model file.
+    """
+    def __init__(self, model_path: str, num_threads: int = 0):
+        import onnxruntime as ort
+
+        if not os.path.isfile(model_path):
+            raise FileNotFoundError(f"SAM decoder model not found: {model_path}")
+        print(f"Loading ONNX SAM decoder from {model_path}...")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        prompts = {i.name: i for i in self.session.get_inputs()}["point_coords"]
+        # The browser export has a fixed prompt dimension and decodes one prompt per call.
+        self.supports_batching = not isinstance(prompts.shape[0], int) or prompts.shape[0] != 1
+        print("ONNX SAM decoder loaded successfully.")
+
+    @staticmethod
+    def _scale_coords(coords: np.ndarray, height: int, width: int) -> np.ndarray:
+        """Maps pixel coordinates to the resized encoder input (ResizeLongestSide.apply_coords)."""
+        scale = SAM_IMAGE_SIZE / max(height, width)
+        new_height, new_width = int(height * scale + 0.5), int(width * scale + 0.5)
+        scaled = coords.astype(np.float32, copy=True)
+        scaled[..., 0] *= new_width / width
+        scaled[..., 1] *= new_height / height
+        return scaled
+
+    def decode(self, embedding: np.ndarray, coords: np.ndarray, labels: np.ndarray,
+               image_size: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Predicts one mask per prompt.
+
+        Args:
+            embedding: The image embedding of shape (1, 256, 64, 64).
+            coords: Point coordinates (x, y) in image pixels, of shape (prompts, points, 2).
+            labels: Point labels (1 = include, 0 = exclude), of shape (prompts, points).
+            image_size: The (height, width) of the image.
+
+        Returns:
+            Boolean masks of shape (prompts, height, width) and their predicted IoU scores.
+        """
+        height, width = image_size
+        # SAM appends a padding point to prompts without a box.
+        padding = np.zeros((coords.shape[0], 1, 2), dtype=np.float32)
+        feeds = {
+            "image_embeddings": embedding,
+            "point_coords": np.concatenate([self._scale_coords(coords, height, width), padding], axis=1),
+            "point_labels": np.concatenate(
+                [labels.astype(np.float32), -np.ones((labels.shape[0], 1), dtype=np.float32)], axis=1
+            ),
+            "mask_input": np.zeros((1, 1, SAM_MASK_INPUT_SIZE, SAM_MASK_INPUT_SIZE), dtype=np.float32),
+            "has_mask_input": np.zeros(1, dtype=np.float32),
+            "orig_im_size": np.array([height, width], dtype=np.float32),
+        }
+        if self.supports_batching:
+            masks, scores, _ = self.session.run(None, feeds)
+        else:
+            outputs = [
+                self.session.run(None, {**feeds, "point_coords": feeds["point_coords"][i:i + 1],
+                                        "point_labels": feeds["point_labels"][i:i + 1]})
+                for i in range(coords.shape[0])
+            ]
+            masks = np.concatenate([output[0] for output in outputs])
+            scores = np.concatenate([output[1] for output in outputs])
+        return masks[:, 0] > 0.0, scores[:, 0]
+
+
+class MaskDecoderService:
+    """
+    Predicts masks from point prompts and image embeddings.
+
+    Concurrent requests are queued onto a single decoder thread, so a burst of users
+    shares the CPU instead of contending for it. Prompts on the same image with the same
+    number of points are coalesced into one decoder call. Prompts on different images
+    are decoded one after another: the exported decoder takes a single image embedding
+    and image size per call, so requests of different sessions cannot be fused.
+    """
+    def __init__(self, decoder, max_batch_size: int = 8, max_batch_wait_ms: float = 2):
+        """
+        Initializes the MaskDecoderService.
+
+        Args:
+            decoder: An OnnxSamDecoder.
+            max_batch_size (int): The maximum number of prompts taken from the queue at once.
+            max_batch_wait_ms (float): How long to wait for more prompts to coalesce.
+        """
+        self.decoder = decoder
+        self._batcher = MicroBatcher(self._decode_batch, max_batch_size, max_batch_wait_ms,
+                                     name="sam-decoder")
+
+    def _decode_batch(self, items: list[tuple]) -> list[tuple[np.ndarray, float]]:
+        # One decoder call per image and number of points.
+        groups: dict[tuple, list[int]] = {}
+        for index, (key, _, coords, _, _) in enumerate(items):
+            groups.setdefault((key, len(coords)), []).append(index)
+
+        results = [None] * len(items)
+        for indexes in groups.values():
+            _, embedding, _, _, image_size = items[indexes[0]]
+            coords = np.stack([items[i][2] for i in indexes])
+            labels = np.stack([items[i][3] for i in indexes])
+            masks, scores = self.decoder.decode(embedding, coords, labels, image_size)
+            for position, i in enumerate(indexes):
+                results[i] = (masks[position], float(scores[position]))
+        return results
+
+    def submit(self, key: str, embedding: np.ndarray, coords: np.ndarray, labels: np.ndarray,
+               image_size: tuple[int, int]) -> Future:
+        """
+        Queues a prompt for decoding.
+
+        Args:
+            key: Identifies the embedding (e.g. the session ID); only prompts with the
+                same key are decoded together.
+            embedding: The image embedding of shape (1, 256, 64, 64), float32.
+            coords: Point coordinates (x, y) in image pixels, of shape (points, 2).
+            labels: Point labels (1 = include, 0 = exclude), of shape (points,).
+            image_size: The (height, width) of the image.
+
+        Returns:
+            Future: Resolves to the boolean mask of shape (height, width) and its IoU score.
+        """
+        return self._batcher.submit((key, embedding, coords, labels, image_size))
+
+    async def predict(self, key: str, embedding: np.ndarray, coords: np.ndarray, labels: np.ndarray,
+                      image_size: tuple[int, int]) -> tuple[np.ndarray, float]:
+        """
+        Predicts a mask without blocking the event loop. See submit for the arguments.
+        """
+        return await asyncio.wrap_future(self.submit(key, embedding, coords, labels, image_size))
+
+
+_decoded_embeddings: LRUCache | None = None
+_decoded_embeddings_lock = threading.Lock()
+
+def get_decoded_embedding_cache() -> LRUCache:
+    """
+    Returns the process-wide LRU cache of decoded embeddings, keyed by session ID, so
+    follow-up clicks on an image skip Redis and decoding.
+    """
+    global _decoded_embeddings
+    if _decoded_embeddings is None:
+        with _decoded_embeddings_lock:
+            if _decoded_embeddings is None:
+                _decoded_embeddings = LRUCache(settings.SAM_DECODER_EMBEDDING_CACHE_SIZE, name="decoded_embedding")
+    return _decoded_embeddings
+
+
+_mask_decoder_service: MaskDecoderService | None = None
+_mask_decoder_service_lock = threading.Lock()
+
+def get_mask_decoder_service() -> MaskDecoderService:
+    """
+    Returns the process-wide MaskDecoderService, loading the model on first use.
+    """
+    global _mask_decoder_service
+    if _mask_decoder_service is None:
+        with _mask_decoder_service_lock:
+            if _mask_decoder_service is None:
+                decoder = OnnxSamDecoder(settings.SAM_ONNX_DECODER_PATH, settings.SAM_DECODER_THREADS)
+                _mask_decoder_service = MaskDecoderService(
+                    decoder,
+                    max_batch_size=settings.SAM_DECODER_BATCH_SIZE,
+                    max_batch_wait_ms=settings.SAM_DECODER_BATCH_WAIT_MS,
+                )
+    return _mask_decoder_service
@@ -1,8 +1,73 @@
-import redis.asyncio as redis
+import threading
+
+import redis
+import redis.asyncio as aioredis
 from backend.core.config import settings
 
-# Asynchronous client for FastAPI
-async_redis_client = redis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
+# Clients are created on first use, not at import, so importing a module never loads
+# the settings. The API creates its clients in the lifespan hook, each Celery worker
+# process in worker_process_init.
+_clients: dict[str, redis.Redis | aioredis.Redis] = {}
+_clients_lock = threading.Lock()
+
+def _get_client(name: str, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory(settings.REDIS_URL)
+    return client
+
+def get_async_redis_client() -> aioredis.Redis:
+    """
+    Returns the asynchronous client for FastAPI, which decodes responses to str.
+    """
+    return _get_client("async", lambda url: aioredis.from_url(url, encoding="utf-8", decode_responses=True))
+
+def get_sync_redis_client() -> redis.Redis:
+    """
+    Returns the synchronous client for the Celery worker, which decodes responses to str.
+    """
+    return _get_client("sync", lambda url: redis.from_url(url, encoding="utf-8", decode_responses=True))
+
+def get_async_redis_binary_client() -> aioredis.Redis:
+    """
+    Returns an asynchronous client for raw byte values (e.g. encoded embeddings).
+    """
+    return _get_client("async_binary", lambda url: aioredis.from_url(url, decode_responses=False))
+
+def get_sync_redis_binary_client() -> redis.Redis:
+    """
+    Returns a synchronous client for raw byte values (e.g. encoded embeddings).
+    """
+    return _get_client("sync_binary", lambda url: redis.from_url(url, decode_responses=False))
+
+def use_redis_clients(async_client, sync_client, async_binary_client, sync_binary_client) -> None:
+    """
+    Replaces the shared clients, e.g. with fakeredis in the tests and the load test.
+    """
+    with _clients_lock:
+        _clients.update({
+            "async": async_client,
+            "sync": sync_client,
+            "async_binary": async_binary_client,
+            "sync_binary": sync_binary_client,
+        })
+
+class RedisScript:
+    """
+    A Lua script run on the shared text client. Unlike client.register_script, it can
+    be declared at module level: it is registered with the client on its first call.
+    """
+    def __init__(self, source: str, asynchronous: bool = False):
+        self.source = source
+        self.asynchronous = asynchronous
+        self._script = None
 
-# Synchronous client for Celery worker
-sync_redis_client = redis.from_url(settings.REDIS_URL, encoding="utf-8", decode_responses=True)
+    def __call__(self, keys: list, args: list):
+        client = get_async_redis_client() if self.asynchronous else get_sync_redis_client()
+        script = self._script
+        if script is None or script.registered_client is not client:
+            script = self._script = client.register_script(self.source)
+        return script(keys=keys, args=args)
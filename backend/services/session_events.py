@@ -0,0 +1,160 @@
+import asyncio
+import contextlib
+import json
+import logging
+
+from backend.core.config import settings
+from backend.core import constants
+from backend.services.redis_client import get_async_redis_client
+from backend.services.blob_storage import get_blob_storage
+
+logger = logging.getLogger(__name__)
+
+# Per-session pub/sub channels. They live in their own namespace so that
+# pattern subscriptions never overlap with the 'session:*' keyspace.
+SESSION_EVENTS_CHANNEL_PREFIX = "session_events:"
+
+def session_events_channel(session_id: str) -> str:
+    return f"{SESSION_EVENTS_CHANNEL_PREFIX}{session_id}"
+
+def session_ttl(status: constants.SessionStatus) -> int:
+    """Returns how long a session in the given state is kept without activity."""
+    if status == constants.SessionStatus.COMPLETED:
+        return settings.SESSION_TTL_COMPLETED_SECONDS
+    if status == constants.SessionStatus.FAILED:
+        return settings.SESSION_TTL_FAILED_SECONDS
+    if status.value in constants.BUSY_SESSION_STATUSES - {constants.SessionStatus.EMBEDDING.value}:
+        return settings.SESSION_TTL_ACTIVE_SECONDS
+    return settings.SESSION_TTL_NEW_SECONDS
+
+def session_embedding_key(session_id: str) -> str:
+    return f"{constants.SESSION_EMBEDDING_KEY_PREFIX}{session_id}"
+
+def decode_session_fields(fields: dict) -> dict:
+    """Decodes the session fields that are stored as JSON strings."""
+    for name in constants.JSON_SESSION_FIELDS:
+        if isinstance(fields.get(name), str):
+            fields[name] = json.loads(fields[name])
+    return fields
+
+def resolve_result_urls(fields: dict) -> dict:
+    """
+    Replaces the blob keys of a decoded generation result with download URLs.
+    Presigned URLs are signed here, on every read, so they stay valid for their full
+    lifetime however long ago the result was generated or cached.
+    """
+    blob_storage = get_blob_storage()
+    result_key = fields.pop(constants.SESSION_RESULT_KEY, None)
+    if result_key:
+        fields[constants.SESSION_RESULT_URL] = blob_storage.url(result_key)
+    thumbnail_key = fields.pop(constants.SESSION_RESULT_THUMBNAIL_KEY, None)
+    if thumbnail_key:
+        fields[constants.SESSION_RESULT_THUMBNAIL_URL] = blob_storage.url(thumbnail_key)
+    if fields.get(constants.SESSION_RESULT_VARIANTS):
+        fields[constants.SESSION_RESULT_VARIANTS] = [
+            {"width": variant["width"], "format": variant["format"], "url": blob_storage.url(variant["key"])}
+            for variant in fields[constants.SESSION_RESULT_VARIANTS]
+        ]
+    return fields
+
+
+class SessionEventBroker:
+    """
+    Fans out session status events to subscribers within one API process.
+    A single pattern subscription is shared by all SSE and WebSocket connections,
+    so the number of Redis connections does not grow with the number of clients.
+    """
+    RECONNECT_DELAY_SECONDS = 1.0
+    QUEUE_SIZE = 16
+
+    def __init__(self, redis_client=None):
+        """
+        Args:
+            redis_client: The async client to subscribe with. Defaults to the shared
+                client, looked up when the subscription starts.
+        """
+        self._redis = redis_client
+        self._subscribers: dict[str, set[asyncio.Queue]] = {}
+        self._listener: asyncio.Task | None = None
+
+    def _ensure_listening(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            pubsub = (self._redis or get_async_redis_client()).pubsub()
+            try:
+                await pubsub.psubscribe(f"{SESSION_EVENTS_CHANNEL_PREFIX}*")
+                async for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        self._dispatch(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Session event subscription lost, reconnecting: {e}")
+                await asyncio.sleep(self.RECONNECT_DELAY_SECONDS)
+            finally:
+                with contextlib.suppress(Exception):
+                    await pubsub.aclose()
+
+    def _dispatch(self, channel: str, data: str):
+        session_id = channel.removeprefix(SESSION_EVENTS_CHANNEL_PREFIX)
+        queues = self._subscribers.get(session_id)
+        if not queues:
+            return
+        try:
+            event = resolve_result_urls(decode_session_fields(json.loads(data)))
+        except ValueError:
+            logger.warning(f"Dropping malformed event on {channel}")
+            return
+        for queue in queues:
+            if queue.full():
+                # A slow consumer only needs the latest status; drop the oldest event.
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def register(self, session_id: str) -> asyncio.Queue:
+        """
+        Registers a subscriber for the status events of a session.
+
+        Returns:
+            An asyncio.Queue that receives each event as a dict.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        self._subscribers.setdefault(session_id, set()).add(queue)
+        self._ensure_listening()
+        return queue
+
+    def unregister(self, session_id: str, queue: asyncio.Queue):
+        """Removes a subscriber previously returned by register()."""
+        queues = self._subscribers.get(session_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[session_id]
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, session_id: str):
+        """
+        Subscribes to the status events of a session for the duration of the block.
+
+        Yields:
+            An asyncio.Queue that receives each event as a dict.
+        """
+        queue = self.register(session_id)
+        try:
+            yield queue
+        finally:
+            self.unregister(session_id, queue)
+
+    async def close(self):
+        """Stops the shared subscription."""
+        if self._listener is not None:
+            self._listener.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener = None
+
+# Create a single broker per API process
+session_event_broker = SessionEventBroker()
@@ -1,112 +1,349 @@
 import uuid
-import base64
-from fastapi import UploadFile, HTTPException
+import hashlib
+import json
+import logging
+import time
 import numpy as np
-import io
+from fastapi import UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
 
 from backend.core.config import settings
-from backend.services.redis_client import async_redis_client
+from backend.core.metrics import stage_timer, GENERATION_ADMISSIONS
+from backend.services.redis_client import get_async_redis_client, get_async_redis_binary_client
+from backend.services.embedding_codec import decode_embedding
+from backend.services.blob_storage import get_blob_storage
+from backend.services.image_ingest import read_upload_limited, normalize_image
+from backend.services.mask_codec import (
+    decode_mask_payload,
+    encode_rle,
+    serialize_mask,
+    MaskFormatError,
+    MASK_STORAGE_CONTENT_TYPE,
+)
+from backend.services.mask_decoder import get_decoded_embedding_cache, get_mask_decoder_service
+from backend.services.generation_cache import generation_cache_key, admit_generation, release_generation_async
+from backend.services.session_events import (
+    decode_session_fields,
+    resolve_result_urls,
+    session_embedding_key,
+    session_ttl,
+)
+from backend.services.session_state import (
+    reserve_generation,
+    cancel_reservation,
+    cancel_embedding,
+    complete_session_async,
+    fail_session_async,
+    start_embedding,
+    touch_session,
+)
 from backend.core.security import validate_wallpaper_url
 from backend.worker.celery_app import celery_app
 from backend.core import constants
-from backend.services.embedding_service import EmbeddingService
+
+logger = logging.getLogger(__name__)
 
 async def create_session_service(file: UploadFile):
     """
     Handles the business logic for creating a new session.
-    Validates the file, uploads it to S3, and creates a session record in Redis.
+    Validates and normalizes the image, stores it in blob storage, and creates a session record in Redis.
     """
     if file.content_type not in constants.ALLOWED_CONTENT_TYPES:
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a JPG or PNG.")
     
+    # Read the upload in chunks, aborting early once it exceeds the size cap,
+    # then normalize it off the event loop.
     max_size = constants.MAX_FILE_SIZE_MB * 1024 * 1024
-    if file.size > max_size:
-        raise HTTPException(status_code=413, detail=f"File is too large. Maximum size is {constants.MAX_FILE_SIZE_MB}MB.")
+    with stage_timer("create_session", "read_upload"):
+        upload_bytes = await read_upload_limited(file, max_size)
+    with stage_timer("create_session", "normalize_image"):
+        image = await run_in_threadpool(normalize_image, upload_bytes)
+    del upload_bytes
 
     session_id = str(uuid.uuid4())
-    
-    # Read image content and encode it in Base64
-    image_bytes = await file.read()
-    image_b64 = base64.b64encode(image_bytes).decode('utf-8')
 
-    # Session data is stored in a Redis hash.
+    # Store the images in blob storage. Blobs are content-addressed,
+    # so re-uploads of the same photo are stored only once.
+    with stage_timer("create_session", "store_images"):
+        image_key = await run_in_threadpool(
+            get_blob_storage().put_content_addressed,
+            image.data,
+            constants.BLOB_PREFIX_ORIGINALS,
+            ".jpg",
+            image.content_type
+        )
+        preview_key = await run_in_threadpool(
+            get_blob_storage().put_content_addressed,
+            image.preview,
+            constants.BLOB_PREFIX_PREVIEWS,
+            ".jpg",
+            image.content_type
+        )
+
+    # Session data is stored in a Redis hash and only keeps small metadata.
     session_data = {
         constants.SESSION_STATUS: constants.SessionStatus.NEW.value,
         constants.SESSION_ORIGINAL_FILENAME: file.filename,
-        constants.SESSION_ORIGINAL_IMAGE_B64: image_b64,
-        constants.SESSION_ATTEMPTS_LEFT: "10"
+        constants.SESSION_ORIGINAL_IMAGE_KEY: image_key,
+        constants.SESSION_ORIGINAL_CONTENT_TYPE: image.content_type,
+        constants.SESSION_IMAGE_WIDTH: image.width,
+        constants.SESSION_IMAGE_HEIGHT: image.height,
+        constants.SESSION_PREVIEW_IMAGE_KEY: preview_key,
+        constants.SESSION_ATTEMPTS_LEFT: "10",
+        constants.SESSION_TTL: session_ttl(constants.SessionStatus.NEW),
     }
-    await async_redis_client.hset(f"session:{session_id}", mapping=session_data)
-    
-    return {"session_id": session_id}
+    # Unused sessions expire; the TTL is refreshed on activity.
+    with stage_timer("create_session", "store_session"):
+        async with get_async_redis_client().pipeline(transaction=False) as pipe:
+            pipe.hset(f"session:{session_id}", mapping=session_data)
+            pipe.expire(f"session:{session_id}", session_data[constants.SESSION_TTL])
+            await pipe.execute()
 
-async def start_generation_service(session_id: str, mask: str, wallpaper_url: str):
+    return {"session_id": session_id, "width": image.width, "height": image.height}
+
+def _encode_mask(mask: str | dict, width: int, height: int) -> bytes:
+    """Validates a client mask against the image size and serializes it for storage."""
+    try:
+        return serialize_mask(decode_mask_payload(mask, width, height))
+    except MaskFormatError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid mask: {e}")
+
+async def start_generation_service(session_id: str, mask: str | dict, wallpaper_url: str):
     """
     Handles the business logic for starting the wallpaper generation.
-    Validates the session, checks attempts, and queues the Celery task.
+    Validates the session, reserves an attempt, and queues the Celery task.
     """
-    if not await async_redis_client.exists(f"session:{session_id}"):
+    with stage_timer("start_generation", "fetch_session"):
+        attempts_left, image_key, width, height = await get_async_redis_client().hmget(
+            f"session:{session_id}",
+            [
+                constants.SESSION_ATTEMPTS_LEFT,
+                constants.SESSION_ORIGINAL_IMAGE_KEY,
+                constants.SESSION_IMAGE_WIDTH,
+                constants.SESSION_IMAGE_HEIGHT,
+            ]
+        )
+    if image_key is None:
         raise HTTPException(status_code=404, detail="Session not found.")
 
-    attempts_left_bytes = await async_redis_client.hget(f"session:{session_id}", constants.SESSION_ATTEMPTS_LEFT)
-    if not attempts_left_bytes or int(attempts_left_bytes) <= 0:
+    if not attempts_left or int(attempts_left) <= 0:
         raise HTTPException(status_code=403, detail="No attempts left for this session.")
 
     validate_wallpaper_url(wallpaper_url)
 
-    # Queue the background task using Celery.
-    celery_app.send_task(
-        "process_wallpaper",
-        args=[session_id, mask, wallpaper_url]
-    )
-    
-    # Update session status to 'queued'
-    await async_redis_client.hset(
-        f"session:{session_id}", 
-        constants.SESSION_STATUS, 
-        constants.SessionStatus.QUEUED.value
-    )
-    
+    # The mask is validated against the image, stored in its compact RLE form and
+    # passed to the worker by key, which keeps task messages small in the broker.
+    with stage_timer("start_generation", "decode_mask"):
+        mask_data = await run_in_threadpool(_encode_mask, mask, int(width), int(height))
+    with stage_timer("start_generation", "store_mask"):
+        mask_key = await run_in_threadpool(
+            get_blob_storage().put_content_addressed,
+            mask_data,
+            constants.BLOB_PREFIX_MASKS,
+            ".json",
+            MASK_STORAGE_CONTENT_TYPE
+        )
+
+    # Reserve the attempt and mark the session as queued in one atomic step, so
+    # concurrent requests can never spend the same attempt twice.
+    cache_key = generation_cache_key(image_key, mask_key, wallpaper_url)
+    queued_at = time.time()
+    with stage_timer("start_generation", "reserve"):
+        reservation, previous = await reserve_generation(
+            session_id,
+            **{
+                constants.SESSION_GENERATION_CACHE_KEY: cache_key,
+                constants.SESSION_MASK_KEY: mask_key,
+                constants.SESSION_QUEUED_AT: queued_at,
+            }
+        )
+    if reservation == "missing":
+        raise HTTPException(status_code=404, detail="Session not found.")
+    if reservation == "busy":
+        raise HTTPException(status_code=409, detail="A generation is already in progress for this session.")
+    if reservation == "embedding":
+        raise HTTPException(status_code=409, detail="The embedding is still being generated. Try again once it has finished.")
+    if reservation == "no_attempts":
+        raise HTTPException(status_code=403, detail="No attempts left for this session.")
+
+    # Identical (image, mask, wallpaper) requests share one generation.
+    with stage_timer("start_generation", "admit"):
+        outcome, cached_result = await admit_generation(cache_key, session_id)
+    GENERATION_ADMISSIONS.labels(outcome).inc()
+    if outcome == "busy":
+        # Backpressure: keep the generation queue bounded during spikes.
+        await cancel_reservation(session_id, previous)
+        raise HTTPException(
+            status_code=429,
+            detail="Too many generations in progress. Please retry later.",
+            headers={"Retry-After": str(settings.GENERATION_RETRY_AFTER_SECONDS)},
+        )
+    if outcome == "hit":
+        # Shared results are free: the reserved attempt is refunded.
+        await complete_session_async(
+            session_id, charge=False, **cached_result, **{constants.SESSION_FINISHED_AT: time.time()}
+        )
+        return {
+            "status": constants.SessionStatus.COMPLETED.value,
+            "session_id": session_id,
+            **resolve_result_urls(decode_session_fields(dict(cached_result))),
+        }
+
+    if outcome == "owner":
+        # Queue the background task using Celery. The queue time identifies the attempt.
+        try:
+            with stage_timer("start_generation", "enqueue"):
+                celery_app.send_task(
+                    "process_wallpaper",
+                    args=[session_id, mask_key, wallpaper_url, queued_at]
+                )
+        except Exception as e:
+            # Nothing will run the generation: free its slot, give the attempt back, and
+            # fail the sessions that already joined it, so none of them waits for it.
+            logger.error(f"Could not queue the generation of session {session_id}: {e}", exc_info=True)
+            waiter_ids = await release_generation_async(cache_key)
+            await cancel_reservation(session_id, previous)
+            finished = {constants.SESSION_FINISHED_AT: time.time()}
+            for waiter_id in waiter_ids:
+                if waiter_id != session_id:
+                    await fail_session_async(waiter_id, "Generation could not be queued.", **finished)
+            raise HTTPException(
+                status_code=503,
+                detail="The generation could not be queued. Please retry later.",
+                headers={"Retry-After": str(settings.GENERATION_RETRY_AFTER_SECONDS)},
+            ) from e
+
+    # Waiters are completed or failed together with the in-flight generation they joined.
     return {"status": constants.SessionStatus.QUEUED.value, "session_id": session_id}
 
-async def get_session_status_service(session_id: str):
+async def get_session_status_service(session_id: str) -> dict:
+    """
+    Retrieves the status of a given session from Redis and refreshes its TTL.
+    Only the small status fields are fetched, never the session's blobs or embedding.
+    Results are returned as blob keys; see session_events.resolve_result_urls.
+    """
+    with stage_timer("get_session_status", "fetch_session"):
+        values = await touch_session(session_id, constants.SESSION_STATUS_FIELDS)
+    status_data = dict(zip(constants.SESSION_STATUS_FIELDS, values))
+    if status_data[constants.SESSION_STATUS] is None:
+        raise HTTPException(status_code=404, detail="Session not found.")
+    if status_data[constants.SESSION_ATTEMPTS_LEFT] is not None:
+        status_data[constants.SESSION_ATTEMPTS_LEFT] = int(status_data[constants.SESSION_ATTEMPTS_LEFT])
+
+    for name in (constants.SESSION_QUEUED_AT, constants.SESSION_STARTED_AT, constants.SESSION_FINISHED_AT):
+        if status_data[name] is not None:
+            status_data[name] = float(status_data[name])
+
+    return decode_session_fields(status_data)
+
+def compute_status_etag(status_data: dict) -> str:
+    """
+    Computes a weak ETag for a session status projection.
     """
-    Retrieves the status and data of a given session from Redis.
+    payload = json.dumps(status_data, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return f'W/"{hashlib.sha1(payload).hexdigest()}"'
+
+async def generate_embedding_service(session_id: str):
     """
-    session_data = await async_redis_client.hgetall(f"session:{session_id}")
-    if not session_data:
+    Queues the embedding generation for a session's image.
+    The embedding is computed by the 'generate_embedding' task on the dedicated
+    embedding queue; progress is reported through the session status.
+    """
+    # Refused while an embedding or a generation is in flight, atomically.
+    outcome, previous = await start_embedding(session_id)
+    if outcome == "missing":
         raise HTTPException(status_code=404, detail="Session not found.")
-        
-    return session_data
+    if outcome == "busy":
+        raise HTTPException(status_code=409, detail="The session is busy. Try again once it has finished.")
+
+    try:
+        # A task still queued at the embedding's deadline is dropped; the session is unlocked by then.
+        celery_app.send_task("generate_embedding", args=[session_id], expires=settings.EMBEDDING_TIMEOUT_SECONDS)
+    except Exception as e:
+        # Nothing will compute the embedding: give the session its previous state back.
+        logger.error(f"Could not queue the embedding of session {session_id}: {e}", exc_info=True)
+        await cancel_embedding(session_id, previous)
+        raise HTTPException(
+            status_code=503,
+            detail="The embedding could not be queued. Please retry later.",
+            headers={"Retry-After": str(settings.GENERATION_RETRY_AFTER_SECONDS)},
+        ) from e
+
+    return {"status": constants.SessionStatus.EMBEDDING.value, "session_id": session_id}
 
-async def generate_embedding_service(session_id: str, embedding_service: EmbeddingService):
+async def get_embedding_data_service(session_id: str, decode: bool) -> bytes:
     """
-    Generates, uploads, and links an embedding for a session's image.
+    Retrieves a session's stored embedding.
+
+    Args:
+        session_id: The ID of the session.
+        decode: If True, returns the embedding as raw little-endian float32 values
+            (ready for an ONNX Runtime tensor). Otherwise returns the stored encoded bytes.
     """
-    session_key = f"session:{session_id}"
-    if not await async_redis_client.exists(session_key):
+    status, = await touch_session(session_id, [constants.SESSION_STATUS])
+    if status is None:
         raise HTTPException(status_code=404, detail="Session not found.")
+    with stage_timer("get_embedding", "fetch_embedding"):
+        encoded = await get_async_redis_binary_client().get(session_embedding_key(session_id))
+    if encoded is None:
+        raise HTTPException(status_code=404, detail="Embedding has not been generated for this session.")
 
-    # 1. Download original image from Redis
-    image_b64 = await async_redis_client.hget(session_key, constants.SESSION_ORIGINAL_IMAGE_B64)
-    image_bytes = base64.b64decode(image_b64)
-
-    # 2. Generate embedding
-    embedding = embedding_service.generate_embedding_from_bytes(image_bytes)
-
-    # 3. Upload embedding to Redis
-    embedding_bytes = io.BytesIO()
-    np.save(embedding_bytes, embedding, allow_pickle=False)
-    embedding_bytes.seek(0)
-    embedding_b64 = base64.b64encode(embedding_bytes.read()).decode('utf-8')
-
-    # 4. Update session in Redis
-    await async_redis_client.hset(
-        session_key,
-        mapping={
-            constants.SESSION_EMBEDDING_B64: embedding_b64,
-            constants.SESSION_STATUS: constants.SessionStatus.EMBEDDING_COMPLETED.value
-        }
+    if not decode:
+        return encoded
+    with stage_timer("get_embedding", "decode_embedding"):
+        embedding = await run_in_threadpool(decode_embedding, encoded)
+    return embedding.astype("<f4", copy=False).tobytes()
+
+async def predict_mask_service(session_id: str, points: list[dict]) -> dict:
+    """
+    Predicts a mask for the session's image from point prompts, using its stored embedding.
+
+    Args:
+        session_id: The ID of the session.
+        points: Points in image pixels, each {"x", "y", "label"} with label 1 to include
+            the point's region and 0 to exclude it.
+
+    Returns:
+        The mask as a compact RLE payload of the image's size, ready to send to the
+        generate endpoint, and the decoder's predicted IoU score.
+    """
+    status, width, height = await touch_session(
+        session_id, [constants.SESSION_STATUS, constants.SESSION_IMAGE_WIDTH, constants.SESSION_IMAGE_HEIGHT]
     )
+    if status is None:
+        raise HTTPException(status_code=404, detail="Session not found.")
+    width, height = int(width), int(height)
+
+    if not 0 < len(points) <= constants.MAX_MASK_POINTS:
+        raise HTTPException(status_code=400, detail=f"Between 1 and {constants.MAX_MASK_POINTS} points are required.")
+    coords = np.array([[point["x"], point["y"]] for point in points], dtype=np.float32)
+    labels = np.array([point["label"] for point in points], dtype=np.float32)
+    if (coords < 0).any() or (coords[:, 0] >= width).any() or (coords[:, 1] >= height).any():
+        raise HTTPException(status_code=400, detail="Points must lie within the image.")
+
+    # The embedding is fetched first, so a session without one fails before the decoder
+    # is loaded. Decoded embeddings are cached per session, so follow-up clicks skip Redis.
+    embeddings = get_decoded_embedding_cache()
+    embedding = embeddings.get(session_id)
+    if embedding is None:
+        with stage_timer("predict_mask", "fetch_embedding"):
+            encoded = await get_async_redis_binary_client().get(session_embedding_key(session_id))
+        if encoded is None:
+            if status == constants.SessionStatus.EMBEDDING.value:
+                raise HTTPException(status_code=409, detail="The embedding is still being generated.")
+            raise HTTPException(status_code=404, detail="Embedding has not been generated for this session.")
+        with stage_timer("predict_mask", "decode_embedding"):
+            embedding = await run_in_threadpool(decode_embedding, encoded)
+        embeddings.put(session_id, embedding)
+
+    try:
+        service = await run_in_threadpool(get_mask_decoder_service)
+    except FileNotFoundError:
+        raise HTTPException(status_code=503, detail="Mask prediction is not available on this server.")
+
+    with stage_timer("predict_mask", "decode_mask"):
+        mask, score = await service.predict(session_id, embedding, coords, labels, (height, width))
+    with stage_timer("predict_mask", "encode_mask"):
+        rle = await run_in_threadpool(encode_rle, mask)
 
-    return {"status": "embedding_generated", "session_id": session_id}
+    return {"session_id": session_id, "mask": rle, "score": score}
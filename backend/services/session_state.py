@@ -0,0 +1,520 @@
+import json
+import time
+
+from backend.core.config import settings
+from backend.core import constants
+from backend.services.redis_client import RedisScript
+from backend.services.session_events import session_events_channel, session_embedding_key, session_ttl
+
+# --- Lua Scripts ---
+# Each transition of a session runs as one script: one round trip, and
+# no other client can observe or interleave with a half-applied transition.
+#
+# Attempts are reserved (decremented) when a generation is accepted. Completing the
+# generation commits the reservation; failing or cancelling it refunds the attempt.
+# A shared result (a cache hit, or a waiter on an identical generation) is free, so it
+# completes with a refund too. The reservation flag makes each refund happen at most once.
+# A generation cannot be reserved while the embedding is computed, and vice versa.
+# Every transition also applies the TTL of the new state to the session and its embedding.
+
+# KEYS: session, embedding. ARGV: channel, event, reserved field, attempts field, TTL,
+# status field, embedding status, embedding deadline field, now, number of fields to clear,
+# fields to clear..., field/value pairs...
+# Returns {"ok", previous status, previous field/value pairs...} | {"missing"} | {"busy"} |
+# {"embedding"} | {"no_attempts"}. The fields of the previous generation are cleared and
+# returned, so a cancelled reservation can restore them. An embedding past its deadline
+# no longer blocks the session.
+_RESERVE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {'missing'}
+end
+if redis.call('HEXISTS', KEYS[1], ARGV[3]) == 1 then
+    return {'busy'}
+end
+local status = redis.call('HGET', KEYS[1], ARGV[6])
+if status == ARGV[7] and tonumber(redis.call('HGET', KEYS[1], ARGV[8]) or '0') > tonumber(ARGV[9]) then
+    return {'embedding'}
+end
+local attempts = tonumber(redis.call('HGET', KEYS[1], ARGV[4]) or '0')
+if not attempts or attempts <= 0 then
+    return {'no_attempts'}
+end
+local cleared = tonumber(ARGV[10])
+local previous = {'ok', status or ''}
+if cleared > 0 then
+    local values = redis.call('HMGET', KEYS[1], unpack(ARGV, 11, 10 + cleared))
+    for i = 1, cleared do
+        if values[i] then
+            table.insert(previous, ARGV[10 + i])
+            table.insert(previous, values[i])
+        end
+    end
+    redis.call('HDEL', KEYS[1], unpack(ARGV, 11, 10 + cleared))
+end
+redis.call('HINCRBY', KEYS[1], ARGV[4], -1)
+redis.call('HSET', KEYS[1], ARGV[3], '1', unpack(ARGV, 11 + cleared))
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('PUBLISH', ARGV[1], ARGV[2])
+return previous
+"""
+
+# KEYS: session, embedding. ARGV: channel, event, reserved field, attempts field, TTL,
+# refund (0|1), number of fields to read, fields to read..., number of fields to delete,
+# fields to delete..., field/value pairs...
+# Returns the values the fields to read had before the transition; an empty list if the
+# session no longer exists.
+_SETTLE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {}
+end
+local read = tonumber(ARGV[7])
+local values = {}
+if read > 0 then
+    values = redis.call('HMGET', KEYS[1], unpack(ARGV, 8, 7 + read))
+end
+if redis.call('HDEL', KEYS[1], ARGV[3]) == 1 and ARGV[6] == '1' then
+    redis.call('HINCRBY', KEYS[1], ARGV[4], 1)
+end
+local offset = 8 + read
+local deleted = tonumber(ARGV[offset])
+if deleted > 0 then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, offset + 1, offset + deleted))
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, offset + 1 + deleted))
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('PUBLISH', ARGV[1], ARGV[2])
+return values
+"""
+
+# KEYS: session, embedding. ARGV: channel, event, reserved field, attempts field, TTL,
+# queued-at field, queued-at of the attempt, prediction field, submitted-at field,
+# field/value pairs...
+# Applies the new status only while the attempt that was queued at the given time holds
+# the reservation and has not begun submitting a prediction yet.
+# Returns "ok" | "stale" (the attempt was settled, or the session is missing) |
+# "submitted" (its prediction was recorded) | "submitting" (it began submitting a
+# prediction that was never recorded).
+_START_GENERATION_LUA = """
+if redis.call('HEXISTS', KEYS[1], ARGV[3]) == 0 or redis.call('HGET', KEYS[1], ARGV[6]) ~= ARGV[7] then
+    return 'stale'
+end
+if redis.call('HEXISTS', KEYS[1], ARGV[8]) == 1 then
+    return 'submitted'
+end
+if redis.call('HEXISTS', KEYS[1], ARGV[9]) == 1 then
+    return 'submitting'
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 10))
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('PUBLISH', ARGV[1], ARGV[2])
+return 'ok'
+"""
+
+# KEYS: session, embedding. ARGV: TTL field, fields to read...
+# Reads session fields and reapplies the TTL of the session's current state.
+_TOUCH_LUA = """
+local values = redis.call('HMGET', KEYS[1], unpack(ARGV))
+local ttl = values[1]
+if ttl then
+    redis.call('EXPIRE', KEYS[1], ttl)
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+table.remove(values, 1)
+return values
+"""
+
+# KEYS: session, embedding. ARGV: channel, event, reserved field, status field,
+# embedding status, error field, TTL, embedding deadline field, now, field/value pairs...
+# Returns {"ok", previous status, previous error} | {"missing"} | {"busy"}.
+# An embedding past its deadline (e.g. a lost task) no longer blocks a new one.
+_START_EMBEDDING_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {'missing'}
+end
+local status = redis.call('HGET', KEYS[1], ARGV[4])
+if redis.call('HEXISTS', KEYS[1], ARGV[3]) == 1 or (status == ARGV[5]
+        and tonumber(redis.call('HGET', KEYS[1], ARGV[8]) or '0') > tonumber(ARGV[9])) then
+    return {'busy'}
+end
+local error = redis.call('HGET', KEYS[1], ARGV[6])
+redis.call('HDEL', KEYS[1], ARGV[6])
+redis.call('HSET', KEYS[1], unpack(ARGV, 10))
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+redis.call('PUBLISH', ARGV[1], ARGV[2])
+return {'ok', status or '', error or ''}
+"""
+
+# KEYS: session, embedding. ARGV: channel, event, status field, embedding status, TTL,
+# embedding ('' on failure), embedding deadline field, now ('' to ignore the deadline),
+# field/value pairs...
+# Stores the embedding, and applies the new status only if the session is still embedding
+# (and, if now is given, only once the embedding's deadline has passed).
+# Returns 0 if the session no longer exists, 1 if the status was applied, 2 if not.
+_FINISH_EMBEDDING_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[6] ~= '' then
+    redis.call('SET', KEYS[2], ARGV[6])
+end
+local applies = redis.call('HGET', KEYS[1], ARGV[3]) == ARGV[4]
+if applies and ARGV[8] ~= '' then
+    applies = tonumber(redis.call('HGET', KEYS[1], ARGV[7]) or '0') <= tonumber(ARGV[8])
+end
+if not applies then
+    local ttl = redis.call('TTL', KEYS[1])
+    if ttl > 0 then
+        redis.call('EXPIRE', KEYS[2], ttl)
+    end
+    return 2
+end
+redis.call('HDEL', KEYS[1], ARGV[7])
+redis.call('HSET', KEYS[1], unpack(ARGV, 9))
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('PUBLISH', ARGV[1], ARGV[2])
+return 1
+"""
+
+# Session fields written by start_generation_service together with a reservation.
+RESERVATION_FIELDS = [
+    constants.SESSION_GENERATION_CACHE_KEY,
+    constants.SESSION_MASK_KEY,
+    constants.SESSION_QUEUED_AT,
+]
+
+# Session fields describing the latest generation. They are cleared when a new one is reserved.
+GENERATION_FIELDS = [
+    *RESERVATION_FIELDS,
+    constants.SESSION_PREDICTION_ID,
+    constants.SESSION_SUBMITTED_AT,
+    constants.SESSION_STARTED_AT,
+    constants.SESSION_FINISHED_AT,
+    constants.SESSION_RESULT_URL,
+    constants.SESSION_RESULT_KEY,
+    constants.SESSION_RESULT_VARIANTS,
+    constants.SESSION_RESULT_THUMBNAIL_KEY,
+    constants.SESSION_RESULT_THUMBNAIL_URL,
+    constants.SESSION_ERROR_MESSAGE,
+]
+
+_reserve_script = RedisScript(_RESERVE_LUA, asynchronous=True)
+_settle_script = RedisScript(_SETTLE_LUA)
+_settle_script_async = RedisScript(_SETTLE_LUA, asynchronous=True)
+_start_generation_script = RedisScript(_START_GENERATION_LUA)
+_touch_script = RedisScript(_TOUCH_LUA, asynchronous=True)
+_start_embedding_script = RedisScript(_START_EMBEDDING_LUA, asynchronous=True)
+_finish_embedding_script = RedisScript(_FINISH_EMBEDDING_LUA)
+_finish_embedding_script_async = RedisScript(_FINISH_EMBEDDING_LUA, asynchronous=True)
+
+
+def _keys(session_id: str) -> list[str]:
+    return [f"session:{session_id}", session_embedding_key(session_id)]
+
+
+def _event(status: constants.SessionStatus, fields: dict) -> str:
+    """
+    Builds the event published for a transition. Like the status endpoint, it only
+    carries SESSION_STATUS_FIELDS; internal fields (cache and blob keys) are never sent
+    to subscribers.
+    """
+    event = {constants.SESSION_STATUS: status.value}
+    event.update((name, value) for name, value in fields.items() if name in constants.SESSION_STATUS_FIELDS)
+    return json.dumps(event)
+
+
+def _transition_args(session_id: str, status: constants.SessionStatus, fields: dict) -> tuple[list, list]:
+    ttl = session_ttl(status)
+    stored = {constants.SESSION_STATUS: status.value, **fields}
+    flat = [item for pair in stored.items() for item in pair] + [constants.SESSION_TTL, ttl]
+    head = [
+        session_events_channel(session_id),
+        _event(status, fields),
+        constants.SESSION_ATTEMPT_RESERVED,
+        constants.SESSION_ATTEMPTS_LEFT,
+        ttl,
+    ]
+    return head, flat
+
+
+async def touch_session(session_id: str, fields: list[str]) -> list:
+    """
+    Reads session fields and refreshes the session's TTL, in one round trip.
+
+    Returns:
+        The values of the fields, None for missing fields or sessions.
+    """
+    return await _touch_script(keys=_keys(session_id), args=[constants.SESSION_TTL, *fields])
+
+
+async def reserve_generation(session_id: str, **fields: str) -> tuple[str, dict]:
+    """
+    Reserves one attempt and marks the session as queued, atomically.
+    At most one generation per session can hold a reservation, and none while the
+    session's embedding is being computed. The previous generation's fields (result,
+    error, timestamps) are cleared.
+
+    Args:
+        session_id: The ID of the session.
+        **fields: Extra session fields to store (e.g. the generation cache key).
+
+    Returns:
+        The outcome: "ok" if the attempt was reserved, "missing" if the session does not
+        exist, "busy" if a generation is already in progress, "embedding" if the embedding
+        is being computed, or "no_attempts". For "ok", also the session's previous state,
+        to pass to cancel_reservation; otherwise an empty dict.
+    """
+    head, flat = _transition_args(session_id, constants.SessionStatus.QUEUED, fields)
+    outcome, *previous = await _reserve_script(
+        keys=_keys(session_id),
+        args=[
+            *head,
+            constants.SESSION_STATUS,
+            constants.SessionStatus.EMBEDDING.value,
+            constants.SESSION_EMBEDDING_DEADLINE,
+            time.time(),
+            len(GENERATION_FIELDS),
+            *GENERATION_FIELDS,
+            *flat,
+        ]
+    )
+    if outcome != "ok":
+        return outcome, {}
+    status, *pairs = previous
+    return outcome, {constants.SESSION_STATUS: status, **dict(zip(pairs[::2], pairs[1::2]))}
+
+
+async def cancel_reservation(session_id: str, previous: dict) -> None:
+    """
+    Refunds a reserved attempt of a generation that was never started and restores
+    the session's previous state, as returned by reserve_generation. The fields written
+    by the reservation are removed, so the rejected generation leaves no timestamps or
+    blob references behind.
+    """
+    fields = dict(previous)
+    status = constants.SessionStatus(fields.pop(constants.SESSION_STATUS) or constants.SessionStatus.NEW.value)
+    head, flat = _transition_args(session_id, status, fields)
+    await _settle_script_async(
+        keys=_keys(session_id), args=[*head, "1", 0, len(GENERATION_FIELDS), *GENERATION_FIELDS, *flat]
+    )
+
+
+def _set_generation_status(session_id: str, queued_at, status: constants.SessionStatus, fields: dict) -> str:
+    head, flat = _transition_args(session_id, status, fields)
+    return _start_generation_script(
+        keys=_keys(session_id),
+        args=[
+            *head,
+            constants.SESSION_QUEUED_AT,
+            queued_at,
+            constants.SESSION_PREDICTION_ID,
+            constants.SESSION_SUBMITTED_AT,
+            *flat,
+        ]
+    )
+
+
+def start_generation(session_id: str, queued_at, **fields: str) -> str:
+    """
+    Marks a session as generating, if the attempt queued at `queued_at` still holds the
+    reservation and has not begun submitting a prediction. Used by the worker, so a
+    redelivered or duplicate task never restarts a settled generation or submits a
+    second prediction.
+
+    Returns:
+        "ok", "stale" if the attempt was already settled (or the session is missing),
+        "submitted" if its prediction was already submitted and recorded, or "submitting"
+        if an earlier delivery began submitting a prediction but never recorded it.
+    """
+    return _set_generation_status(session_id, queued_at, constants.SessionStatus.GENERATING, fields)
+
+
+def begin_submission(session_id: str, queued_at, submitted_at: float) -> str:
+    """
+    Records that the attempt is about to submit its prediction, with the same guard and
+    outcomes as start_generation. Once recorded, no delivery of the task submits again.
+    """
+    return _set_generation_status(
+        session_id, queued_at, constants.SessionStatus.GENERATING, {constants.SESSION_SUBMITTED_AT: submitted_at}
+    )
+
+
+def retry_generation(session_id: str, queued_at) -> str:
+    """
+    Marks a session as retrying, with the same guard and outcomes as start_generation.
+    """
+    return _set_generation_status(session_id, queued_at, constants.SessionStatus.RETRYING, {})
+
+
+# Session fields read by the worker when it settles a generation: they are returned
+# atomically with the settle, before a new reservation of the session can replace them.
+SETTLED_FIELDS = [
+    constants.SESSION_GENERATION_CACHE_KEY,
+    constants.SESSION_QUEUED_AT,
+]
+
+
+def _settle(session_id: str, status: constants.SessionStatus, refund: bool, fields: dict) -> dict:
+    head, flat = _transition_args(session_id, status, fields)
+    values = _settle_script(
+        keys=_keys(session_id), args=[*head, "1" if refund else "0", len(SETTLED_FIELDS), *SETTLED_FIELDS, 0, *flat]
+    )
+    return dict(zip(SETTLED_FIELDS, values or [None] * len(SETTLED_FIELDS)))
+
+
+def complete_session(session_id: str, *, charge: bool = True, **result_fields: str) -> dict:
+    """
+    Marks a session as completed and commits its reserved attempt. Used by the worker.
+    With charge=False (a waiter that shared another session's generation) the attempt
+    is refunded instead.
+
+    Returns:
+        The SETTLED_FIELDS of the generation, as they were before it was settled
+        (None for missing fields or sessions).
+    """
+    return _settle(session_id, constants.SessionStatus.COMPLETED, not charge, result_fields)
+
+
+async def complete_session_async(session_id: str, *, charge: bool = True, **result_fields: str) -> None:
+    """
+    Async counterpart of complete_session, used by the API for cached results.
+    """
+    head, flat = _transition_args(session_id, constants.SessionStatus.COMPLETED, result_fields)
+    await _settle_script_async(keys=_keys(session_id), args=[*head, "0" if charge else "1", 0, 0, *flat])
+
+
+def fail_session(session_id: str, error: str, **fields: str) -> dict:
+    """
+    Marks a session as failed and refunds its reserved attempt. Used by the worker.
+
+    Returns:
+        The SETTLED_FIELDS of the generation, as for complete_session.
+    """
+    return _settle(
+        session_id, constants.SessionStatus.FAILED, True, {constants.SESSION_ERROR_MESSAGE: error, **fields}
+    )
+
+
+async def fail_session_async(session_id: str, error: str, **fields: str) -> None:
+    """
+    Async counterpart of fail_session, used by the API for generations it could not queue.
+    """
+    head, flat = _transition_args(
+        session_id, constants.SessionStatus.FAILED, {constants.SESSION_ERROR_MESSAGE: error, **fields}
+    )
+    await _settle_script_async(keys=_keys(session_id), args=[*head, "1", 0, 0, *flat])
+
+
+async def start_embedding(session_id: str) -> tuple[str, dict]:
+    """
+    Marks the session as embedding until EMBEDDING_TIMEOUT_SECONDS from now, unless its
+    embedding is already being computed or a generation holds a reservation. Clears the
+    error of a previous failure. An embedding past its deadline does not count as being
+    computed, so a lost task cannot lock the session.
+
+    Returns:
+        The outcome: "ok", "missing" if the session does not exist, or "busy". For "ok",
+        also the session's previous state, to pass to cancel_embedding; otherwise an empty dict.
+    """
+    status = constants.SessionStatus.EMBEDDING
+    ttl = session_ttl(status)
+    now = time.time()
+    outcome, *previous = await _start_embedding_script(
+        keys=_keys(session_id),
+        args=[
+            session_events_channel(session_id),
+            _event(status, {}),
+            constants.SESSION_ATTEMPT_RESERVED,
+            constants.SESSION_STATUS,
+            status.value,
+            constants.SESSION_ERROR_MESSAGE,
+            ttl,
+            constants.SESSION_EMBEDDING_DEADLINE,
+            now,
+            constants.SESSION_STATUS, status.value,
+            constants.SESSION_TTL, ttl,
+            constants.SESSION_EMBEDDING_DEADLINE, now + settings.EMBEDDING_TIMEOUT_SECONDS,
+        ]
+    )
+    if outcome != "ok":
+        return outcome, {}
+    previous_status, error = previous
+    return outcome, {constants.SESSION_STATUS: previous_status, constants.SESSION_ERROR_MESSAGE: error}
+
+
+def _finish_embedding_args(session_id: str, status: constants.SessionStatus, embedding: bytes, fields: dict,
+                           now: float | None = None) -> dict:
+    ttl = session_ttl(status)
+    stored = {constants.SESSION_STATUS: status.value, **fields}
+    flat = [item for pair in stored.items() for item in pair] + [constants.SESSION_TTL, ttl]
+    return {
+        "keys": _keys(session_id),
+        "args": [
+            session_events_channel(session_id),
+            _event(status, fields),
+            constants.SESSION_STATUS,
+            constants.SessionStatus.EMBEDDING.value,
+            ttl,
+            embedding,
+            constants.SESSION_EMBEDDING_DEADLINE,
+            "" if now is None else now,
+            *flat,
+        ],
+    }
+
+
+def complete_embedding(session_id: str, embedding: bytes) -> bool:
+    """
+    Stores a session's encoded embedding and marks the session as embedding_completed,
+    if it is still embedding. Used by the embedding worker.
+
+    Returns:
+        False if the session no longer exists; the embedding is then not stored.
+    """
+    return _finish_embedding_script(
+        **_finish_embedding_args(session_id, constants.SessionStatus.EMBEDDING_COMPLETED, embedding, {})
+    ) != 0
+
+
+def fail_embedding(session_id: str, error: str) -> None:
+    """
+    Marks a session as embedding_failed, if it is still embedding. Used by the embedding worker.
+    """
+    _finish_embedding_script(**_finish_embedding_args(
+        session_id, constants.SessionStatus.EMBEDDING_FAILED, b"", {constants.SESSION_ERROR_MESSAGE: error}
+    ))
+
+
+def expire_embedding(session_id: str) -> bool:
+    """
+    Marks a session as embedding_failed if it is still embedding past its deadline.
+    Used by the housekeeping sweep.
+
+    Returns:
+        True if the session's embedding had expired.
+    """
+    return _finish_embedding_script(**_finish_embedding_args(
+        session_id, constants.SessionStatus.EMBEDDING_FAILED, b"",
+        {constants.SESSION_ERROR_MESSAGE: "Embedding generation timed out."}, now=time.time()
+    )) == 1
+
+
+async def cancel_embedding(session_id: str, previous: dict) -> None:
+    """
+    Restores the state a session had before start_embedding, if it is still embedding.
+    Used by the API when the embedding task could not be queued.
+    """
+    status = previous[constants.SESSION_STATUS] or constants.SessionStatus.NEW.value
+    if status == constants.SessionStatus.EMBEDDING.value:
+        # The previous embedding had expired: it never finished.
+        status = constants.SessionStatus.EMBEDDING_FAILED.value
+    fields = {}
+    if previous[constants.SESSION_ERROR_MESSAGE]:
+        fields[constants.SESSION_ERROR_MESSAGE] = previous[constants.SESSION_ERROR_MESSAGE]
+    await _finish_embedding_script_async(
+        **_finish_embedding_args(session_id, constants.SessionStatus(status), b"", fields)
+    )
@@ -0,0 +1,40 @@
+"""
+Test setup: the shared Redis clients are replaced by fakeredis before any test uses them.
+
+Run from the project root:
+    pip install -r backend/requirements-dev.txt
+    python -m pytest backend/tests
+"""
+import asyncio
+import os
+
+import fakeredis
+import pytest
+
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/15")
+os.environ.setdefault("REPLICATE_API_TOKEN", "test")
+
+from backend.services.redis_client import get_sync_redis_client, use_redis_clients
+
+_server = fakeredis.FakeServer()
+use_redis_clients(
+    fakeredis.FakeAsyncRedis(server=_server, decode_responses=True),
+    fakeredis.FakeRedis(server=_server, decode_responses=True),
+    fakeredis.FakeAsyncRedis(server=_server),
+    fakeredis.FakeRedis(server=_server),
+)
+
+# The async clients keep connections bound to one event loop, so all tests share it.
+_loop = asyncio.new_event_loop()
+
+@pytest.fixture
+def run():
+    """Runs a coroutine to completion on the shared event loop."""
+    return _loop.run_until_complete
+
+@pytest.fixture
+def redis():
+    """The synchronous fake Redis client, flushed before each test."""
+    client = get_sync_redis_client()
+    client.flushall()
+    return client
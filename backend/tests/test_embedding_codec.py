@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from backend.services.embedding_codec import decode_embedding, encode_embedding, read_embedding_header
+
+SHAPE = (1, 256, 8, 8)
+
+
+@pytest.fixture
+def embedding():
+    return np.random.default_rng(0).standard_normal(SHAPE).astype(np.float32)
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float32", 0), ("float16", 1e-2), ("int8", 5e-2)])
+@pytest.mark.parametrize("compression", ["none", "zstd"])
+def test_round_trip(embedding, dtype, tolerance, compression):
+    data = encode_embedding(embedding, dtype=dtype, compression=compression)
+    header = read_embedding_header(data)
+    assert (header.dtype, header.compression, header.shape) == (dtype, compression, SHAPE)
+
+    decoded = decode_embedding(data)
+    assert decoded.dtype == np.float32
+    assert decoded.shape == SHAPE
+    np.testing.assert_allclose(decoded, embedding, atol=tolerance * np.abs(embedding).max())
+
+
+def test_constant_embedding_round_trips_as_int8():
+    embedding = np.full(SHAPE, 0.5, dtype=np.float32)
+    np.testing.assert_allclose(decode_embedding(encode_embedding(embedding, dtype="int8")), embedding, atol=1e-6)
+
+
+def test_rejects_unknown_options(embedding):
+    with pytest.raises(ValueError):
+        encode_embedding(embedding, dtype="bfloat16")
+    with pytest.raises(ValueError):
+        encode_embedding(embedding, compression="gzip")
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda data: data[:10],                       # truncated header
+    lambda data: data[:18],                       # truncated shape
+    lambda data: b"NOPE" + data[4:],              # wrong magic
+    lambda data: data[:4] + b"\x09" + data[5:],   # unknown version
+    lambda data: data[:5] + b"\x07" + data[6:],   # unknown dtype
+    lambda data: data[:6] + b"\x07" + data[7:],   # unknown compression
+    lambda data: data[:-16],                      # truncated payload
+    lambda data: data[:32] + bytes(16) + data[48:],  # corrupt zstd frame
+])
+def test_rejects_corrupt_input(embedding, corrupt):
+    with pytest.raises(ValueError):
+        decode_embedding(corrupt(encode_embedding(embedding)))
+
+
+def test_rejects_payload_that_does_not_match_the_shape(embedding):
+    with pytest.raises(ValueError):
+        decode_embedding(encode_embedding(embedding, compression="none")[:-2])
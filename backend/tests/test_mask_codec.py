@@ -0,0 +1,109 @@
+import base64
+import io
+import struct
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from backend.services.mask_codec import (
+    MaskFormatError,
+    decode_bitpack,
+    decode_mask_payload,
+    decode_rle,
+    deserialize_mask,
+    encode_bitpack,
+    encode_rle,
+    rle_counts,
+    serialize_mask,
+)
+
+HEIGHT, WIDTH = 37, 53
+
+
+@pytest.fixture
+def mask():
+    mask = np.random.default_rng(0).random((HEIGHT, WIDTH)) > 0.7
+    mask[10:30, 5:40] = True
+    return mask
+
+
+def test_rle_round_trip(mask):
+    payload = encode_rle(mask)
+    assert payload["size"] == [HEIGHT, WIDTH]
+    np.testing.assert_array_equal(decode_rle(payload), mask)
+
+
+def test_rle_counts_are_column_major_and_start_with_zeros():
+    mask = np.array([[True, False], [True, True]])
+    assert rle_counts(mask).tolist() == [0, 2, 1, 1]
+    np.testing.assert_array_equal(decode_rle({"format": "rle", "size": [2, 2], "counts": [0, 2, 1, 1]}), mask)
+
+
+@pytest.mark.parametrize("fill", [False, True])
+def test_rle_round_trip_of_uniform_masks(fill):
+    mask = np.full((HEIGHT, WIDTH), fill)
+    np.testing.assert_array_equal(decode_rle(encode_rle(mask)), mask)
+
+
+def test_bitpack_round_trip(mask):
+    np.testing.assert_array_equal(decode_bitpack(encode_bitpack(mask)), mask)
+
+
+def test_storage_round_trip_is_deterministic(mask):
+    data = serialize_mask(mask)
+    assert serialize_mask(mask.copy()) == data
+    np.testing.assert_array_equal(deserialize_mask(data), mask)
+
+
+def test_png_payload_is_decoded_and_resampled(mask):
+    buffer = io.BytesIO()
+    image = Image.fromarray(mask.astype(np.uint8) * 255, mode="L").resize((WIDTH * 2, HEIGHT * 2), Image.NEAREST)
+    image.save(buffer, format="PNG")
+    payload = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+    np.testing.assert_array_equal(decode_mask_payload(payload, WIDTH, HEIGHT), mask)
+
+
+def _png_header(width: int, height: int) -> str:
+    """A tiny base64 PNG that declares the given size but holds no pixel data."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    png = (b"\x89PNG\r\n\x1a\n"
+           + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+           + chunk(b"IDAT", zlib.compress(b""))
+           + chunk(b"IEND", b""))
+    return base64.b64encode(png).decode("ascii")
+
+
+@pytest.mark.parametrize("payload", [
+    {"format": "rle", "size": [HEIGHT, WIDTH], "counts": [HEIGHT * WIDTH - 1]},  # too short
+    {"format": "rle", "size": [HEIGHT, WIDTH], "counts": [5, -5, HEIGHT * WIDTH]},  # negative run
+    {"format": "rle", "size": [HEIGHT, WIDTH], "counts": ["a", "b"]},
+    {"format": "rle", "size": [HEIGHT, WIDTH], "counts": "0a"},  # truncated string
+    {"format": "rle", "size": [HEIGHT, WIDTH], "counts": 12},
+    {"format": "rle", "size": [HEIGHT], "counts": [HEIGHT]},
+    {"format": "rle", "size": [0, WIDTH], "counts": []},
+    {"format": "rle", "size": [100000, 100000], "counts": [10 ** 10]},
+    {"format": "bitpack", "size": [HEIGHT, WIDTH], "data": "AAAA"},  # wrong length
+    {"format": "bitpack", "size": [HEIGHT, WIDTH], "data": "not base64!"},
+    {"format": "svg", "size": [HEIGHT, WIDTH]},
+    "bm90IGEgcG5n",  # base64, but not a PNG
+    _png_header(20000, 20000),  # decompression bomb
+    ["rle"],
+])
+def test_rejects_malformed_payloads(payload):
+    with pytest.raises(MaskFormatError):
+        decode_mask_payload(payload, WIDTH, HEIGHT)
+
+
+def test_rejects_payloads_of_the_wrong_size(mask):
+    with pytest.raises(MaskFormatError):
+        decode_mask_payload(encode_rle(mask), WIDTH + 1, HEIGHT)
+    with pytest.raises(MaskFormatError):
+        decode_mask_payload(encode_bitpack(mask.T), WIDTH, HEIGHT)
+
+
+def test_rejects_empty_masks():
+    with pytest.raises(MaskFormatError):
+        decode_mask_payload(encode_rle(np.zeros((HEIGHT, WIDTH), dtype=bool)), WIDTH, HEIGHT)
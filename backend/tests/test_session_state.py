@@ -0,0 +1,340 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from backend.core import constants
+from backend.services import session_state
+
+ATTEMPTS = 3
+
+
+def _create_session(redis, session_id: str, status: str = constants.SessionStatus.NEW.value, **fields):
+    redis.hset(f"session:{session_id}", mapping={
+        constants.SESSION_STATUS: status,
+        constants.SESSION_ATTEMPTS_LEFT: ATTEMPTS,
+        constants.SESSION_TTL: 7200,
+        **fields,
+    })
+    redis.expire(f"session:{session_id}", 7200)
+
+
+def _reserve(session_id: str):
+    return session_state.reserve_generation(session_id, **{
+        constants.SESSION_GENERATION_CACHE_KEY: "cache-key",
+        constants.SESSION_MASK_KEY: "masks/ab/mask.json",
+        constants.SESSION_QUEUED_AT: time.time(),
+    })
+
+
+def test_parallel_reserves_spend_one_attempt(run, redis):
+    _create_session(redis, "s1")
+
+    async def burst():
+        return await asyncio.gather(*(_reserve("s1") for _ in range(50)))
+
+    outcomes = [outcome for outcome, _ in run(burst())]
+    assert outcomes.count("ok") == 1
+    assert outcomes.count("busy") == 49
+    assert int(redis.hget("session:s1", constants.SESSION_ATTEMPTS_LEFT)) == ATTEMPTS - 1
+
+
+def test_parallel_reserves_across_generations_never_overspend(run, redis):
+    _create_session(redis, "s1")
+
+    async def generate():
+        outcome, _ = await _reserve("s1")
+        if outcome == "ok":
+            await asyncio.sleep(0)
+            await asyncio.to_thread(session_state.complete_session, "s1")
+        return outcome
+
+    async def burst():
+        return await asyncio.gather(*(generate() for _ in range(50)))
+
+    outcomes = run(burst())
+    assert outcomes.count("ok") <= ATTEMPTS
+    attempts_left = int(redis.hget("session:s1", constants.SESSION_ATTEMPTS_LEFT))
+    assert attempts_left == ATTEMPTS - outcomes.count("ok") >= 0
+
+
+def test_refund_happens_once(run, redis):
+    _create_session(redis, "s1")
+    outcome, previous = run(_reserve("s1"))
+    assert outcome == "ok"
+
+    session_state.fail_session("s1", "failed")
+    session_state.fail_session("s1", "failed")
+    run(session_state.cancel_reservation("s1", previous))
+    assert int(redis.hget("session:s1", constants.SESSION_ATTEMPTS_LEFT)) == ATTEMPTS
+
+
+def test_shared_result_is_free(run, redis):
+    _create_session(redis, "s1")
+    run(_reserve("s1"))
+    session_state.complete_session("s1", charge=False, **{constants.SESSION_RESULT_KEY: "results/ab/r.png"})
+    assert int(redis.hget("session:s1", constants.SESSION_ATTEMPTS_LEFT)) == ATTEMPTS
+
+
+def test_reserve_clears_previous_result_and_cancel_restores_it(run, redis):
+    previous_result = {
+        constants.SESSION_RESULT_KEY: "results/ab/old.png",
+        constants.SESSION_FINISHED_AT: "1700000000.0",
+    }
+    _create_session(redis, "s1", constants.SessionStatus.COMPLETED.value, **previous_result)
+
+    outcome, previous = run(_reserve("s1"))
+    assert outcome == "ok"
+    session = redis.hgetall("session:s1")
+    assert session[constants.SESSION_STATUS] == constants.SessionStatus.QUEUED.value
+    assert constants.SESSION_RESULT_KEY not in session
+    assert constants.SESSION_FINISHED_AT not in session
+
+    run(session_state.cancel_reservation("s1", previous))
+    session = redis.hgetall("session:s1")
+    assert session[constants.SESSION_STATUS] == constants.SessionStatus.COMPLETED.value
+    assert session[constants.SESSION_RESULT_KEY] == "results/ab/old.png"
+    assert constants.SESSION_QUEUED_AT not in session
+    assert constants.SESSION_MASK_KEY not in session
+    assert int(session[constants.SESSION_ATTEMPTS_LEFT]) == ATTEMPTS
+
+
+def test_embedding_and_generation_exclude_each_other(run, redis):
+    _create_session(redis, "s1")
+    assert run(session_state.start_embedding("s1"))[0] == "ok"
+    assert run(session_state.start_embedding("s1"))[0] == "busy"
+    assert run(_reserve("s1"))[0] == "embedding"
+
+    session_state.complete_embedding("s1", b"embedding")
+    assert run(_reserve("s1"))[0] == "ok"
+    assert run(session_state.start_embedding("s1"))[0] == "busy"
+
+
+def test_embedding_completion_does_not_overwrite_a_newer_status(run, redis):
+    _create_session(redis, "s1", constants.SessionStatus.QUEUED.value,
+                    **{constants.SESSION_TTL: 86400, constants.SESSION_ATTEMPT_RESERVED: "1"})
+    redis.expire("session:s1", 86400)
+
+    assert session_state.complete_embedding("s1", b"embedding")
+    assert redis.hget("session:s1", constants.SESSION_STATUS) == constants.SessionStatus.QUEUED.value
+    assert redis.ttl("session:s1") > 7200
+    assert redis.get(f"{constants.SESSION_EMBEDDING_KEY_PREFIX}s1") == "embedding"
+
+    assert not session_state.complete_embedding("missing", b"embedding")
+    assert not redis.exists(f"{constants.SESSION_EMBEDDING_KEY_PREFIX}missing")
+
+
+def test_start_generation_only_applies_to_the_reserved_attempt(run, redis):
+    _create_session(redis, "s1")
+    run(_reserve("s1"))
+    queued_at = redis.hget("session:s1", constants.SESSION_QUEUED_AT)
+
+    assert session_state.start_generation("s1", queued_at) == "ok"
+    assert session_state.start_generation("s1", "0.0") == "stale"
+    assert session_state.begin_submission("s1", queued_at, time.time()) == "ok"
+    assert session_state.start_generation("s1", queued_at) == "submitting"
+    assert session_state.begin_submission("s1", queued_at, time.time()) == "submitting"
+    redis.hset("session:s1", constants.SESSION_PREDICTION_ID, "prediction")
+    assert session_state.start_generation("s1", queued_at) == "submitted"
+
+    session_state.complete_session("s1")
+    assert session_state.start_generation("s1", queued_at) == "stale"
+    assert session_state.retry_generation("s1", queued_at) == "stale"
+    assert redis.hget("session:s1", constants.SESSION_STATUS) == constants.SessionStatus.COMPLETED.value
+
+
+def test_redelivered_generation_task_does_not_run_again(run, redis, monkeypatch):
+    from backend.worker import worker
+
+    class DiffusionClient:
+        calls = 0
+
+        def generate_wallpaper(self, *inputs):
+            self.calls += 1
+            return "https://replicate.delivery/result.png"
+
+    client = DiffusionClient()
+    monkeypatch.setattr(worker.settings, "DIFFUSION_COMPLETION_MODE", "blocking", raising=False)
+    monkeypatch.setattr(worker, "get_diffusion_client", lambda: client)
+    monkeypatch.setattr(worker, "_prepare_inputs", lambda *args: (b"image", None, b"wallpaper"))
+    monkeypatch.setattr(worker, "persist_result", lambda url: {constants.SESSION_RESULT_KEY: "results/ab/r.png"})
+
+    _create_session(redis, "s1")
+    run(_reserve("s1"))
+    queued_at = float(redis.hget("session:s1", constants.SESSION_QUEUED_AT))
+    args = ["s1", "masks/ab/mask.json", "https://example.com/wallpaper.png", queued_at]
+
+    assert worker.process_wallpaper.apply(args=args).get()["status"] == "done"
+    assert worker.process_wallpaper.apply(args=args).get()["status"] == "ignored"
+    assert client.calls == 1
+    assert redis.hget("session:s1", constants.SESSION_STATUS) == constants.SessionStatus.COMPLETED.value
+    assert int(redis.hget("session:s1", constants.SESSION_ATTEMPTS_LEFT)) == ATTEMPTS - 1
+
+
+def test_redelivered_prediction_task_polls_but_never_submits_again(run, redis, monkeypatch):
+    from backend.worker import worker
+
+    class DiffusionClient:
+        submitted = 0
+
+        def upload_inputs(self, *inputs):
+            return {}
+
+        def submit_wallpaper(self, model_input, webhook_url=None):
+            self.submitted += 1
+            return f"prediction-{self.submitted}"
+
+    client = DiffusionClient()
+    polls = []
+    monkeypatch.setattr(worker.settings, "DIFFUSION_COMPLETION_MODE", "poll", raising=False)
+    monkeypatch.setattr(worker, "get_diffusion_client", lambda: client)
+    monkeypatch.setattr(worker, "_prepare_inputs", lambda *args: (b"image", None, b"wallpaper"))
+    monkeypatch.setattr(worker.poll_prediction, "apply_async", lambda args, countdown: polls.append(args[0]))
+
+    def process(session_id):
+        _create_session(redis, session_id)
+        run(_reserve(session_id))
+        queued_at = float(redis.hget(f"session:{session_id}", constants.SESSION_QUEUED_AT))
+        args = [session_id, "masks/ab/mask.json", "https://example.com/wallpaper.png", queued_at]
+        return worker.process_wallpaper.apply(args=args).get()["status"], args
+
+    # Redelivered after the prediction was recorded: the poll is scheduled again.
+    status, args = process("s1")
+    assert status == "done"
+    assert worker.process_wallpaper.apply(args=args).get()["status"] == "resumed"
+    assert polls == ["prediction-1", "prediction-1"]
+
+    # The task fails between creating the prediction and recording it.
+    def track_prediction(session_id, prediction_id):
+        raise ConnectionError("redis unavailable")
+
+    monkeypatch.setattr(worker, "_track_prediction", track_prediction)
+    status, args = process("s2")
+    assert status == "failed"
+    assert worker.process_wallpaper.apply(args=args).get()["status"] == "ignored"
+    assert client.submitted == 2
+    session = redis.hgetall("session:s2")
+    assert session[constants.SESSION_STATUS] == constants.SessionStatus.FAILED.value
+    assert int(session[constants.SESSION_ATTEMPTS_LEFT]) == ATTEMPTS
+
+
+def test_settle_returns_the_settled_generation_fields(run, redis):
+    _create_session(redis, "s1")
+    run(_reserve("s1"))
+    queued_at = redis.hget("session:s1", constants.SESSION_QUEUED_AT)
+
+    settled = session_state.fail_session("s1", "failed")
+    assert settled == {constants.SESSION_GENERATION_CACHE_KEY: "cache-key", constants.SESSION_QUEUED_AT: queued_at}
+    assert session_state.complete_session("missing") == {
+        constants.SESSION_GENERATION_CACHE_KEY: None, constants.SESSION_QUEUED_AT: None,
+    }
+
+
+
+def test_failed_dispatch_releases_the_generation_and_its_reservation(run, redis, monkeypatch):
+    from fastapi import HTTPException
+    from backend.services import generation_cache, session_service
+
+    class BlobStorage:
+        def put_content_addressed(self, data, prefix, suffix, content_type):
+            return f"{prefix}ab/mask{suffix}"
+
+    def send_task(name, args):
+        # An identical request joined the generation before the broker failed.
+        cache_key = redis.hget("session:owner", constants.SESSION_GENERATION_CACHE_KEY)
+        redis.sadd(f"{constants.GENERATION_CACHE_KEY_PREFIX}waiters:{cache_key}", "waiter")
+        redis.hset("session:waiter", mapping={
+            constants.SESSION_STATUS: constants.SessionStatus.QUEUED.value,
+            constants.SESSION_ATTEMPT_RESERVED: "1",
+            constants.SESSION_ATTEMPTS_LEFT: ATTEMPTS - 1,
+        })
+        raise ConnectionError("broker unavailable")
+
+    monkeypatch.setattr(session_service, "get_blob_storage", lambda: BlobStorage())
+    monkeypatch.setattr(session_service, "_encode_mask", lambda mask, width, height: b"mask")
+    monkeypatch.setattr(session_service, "validate_wallpaper_url", lambda url: None)
+    monkeypatch.setattr(session_service.celery_app, "send_task", send_task)
+    _create_session(redis, "owner", **{
+        constants.SESSION_ORIGINAL_IMAGE_KEY: "originals/ab/image.jpg",
+        constants.SESSION_IMAGE_WIDTH: 4,
+        constants.SESSION_IMAGE_HEIGHT: 4,
+    })
+    _create_session(redis, "waiter")
+
+    with pytest.raises(HTTPException) as error:
+        run(session_service.start_generation_service("owner", "mask", "https://example.com/wallpaper.png"))
+    assert error.value.status_code == 503
+
+    owner = redis.hgetall("session:owner")
+    assert owner[constants.SESSION_STATUS] == constants.SessionStatus.NEW.value
+    assert int(owner[constants.SESSION_ATTEMPTS_LEFT]) == ATTEMPTS
+    assert constants.SESSION_ATTEMPT_RESERVED not in owner
+    waiter = redis.hgetall("session:waiter")
+    assert waiter[constants.SESSION_STATUS] == constants.SessionStatus.FAILED.value
+    assert int(waiter[constants.SESSION_ATTEMPTS_LEFT]) == ATTEMPTS
+    assert redis.zcard(generation_cache.INFLIGHT_SET_KEY) == 0
+    assert not redis.keys(f"{constants.GENERATION_CACHE_KEY_PREFIX}inflight:*")
+
+
+def test_embedding_past_its_deadline_no_longer_locks_the_session(run, redis):
+    _create_session(redis, "s1")
+    assert run(session_state.start_embedding("s1"))[0] == "ok"
+    assert not session_state.expire_embedding("s1")
+
+    # The task was lost: the deadline passes without a completion.
+    redis.hset("session:s1", constants.SESSION_EMBEDDING_DEADLINE, time.time() - 1)
+    assert run(session_state.start_embedding("s1"))[0] == "ok"
+    redis.hset("session:s1", constants.SESSION_EMBEDDING_DEADLINE, time.time() - 1)
+    assert session_state.expire_embedding("s1")
+    session = redis.hgetall("session:s1")
+    assert session[constants.SESSION_STATUS] == constants.SessionStatus.EMBEDDING_FAILED.value
+    assert constants.SESSION_EMBEDDING_DEADLINE not in session
+
+    assert run(session_state.start_embedding("s1"))[0] == "ok"
+    redis.hset("session:s1", constants.SESSION_EMBEDDING_DEADLINE, time.time() - 1)
+    assert run(_reserve("s1"))[0] == "ok"
+
+
+def test_failed_embedding_dispatch_restores_the_session(run, redis, monkeypatch):
+    from fastapi import HTTPException
+    from backend.services import session_service
+
+    def send_task(*args, **kwargs):
+        raise ConnectionError("broker unavailable")
+
+    monkeypatch.setattr(session_service.celery_app, "send_task", send_task)
+    _create_session(redis, "s1", constants.SessionStatus.EMBEDDING_FAILED.value,
+                    **{constants.SESSION_ERROR_MESSAGE: "Embedding generation failed."})
+
+    with pytest.raises(HTTPException) as error:
+        run(session_service.generate_embedding_service("s1"))
+    assert error.value.status_code == 503
+    assert "Retry-After" in error.value.headers
+
+    session = redis.hgetall("session:s1")
+    assert session[constants.SESSION_STATUS] == constants.SessionStatus.EMBEDDING_FAILED.value
+    assert session[constants.SESSION_ERROR_MESSAGE] == "Embedding generation failed."
+    assert run(session_state.start_embedding("s1"))[0] == "ok"
+
+
+def test_published_events_only_carry_status_fields(run, redis):
+    _create_session(redis, "s1")
+    pubsub = redis.pubsub()
+    pubsub.subscribe("session_events:s1")
+    assert pubsub.get_message()["type"] == "subscribe"
+
+    _, previous = run(_reserve("s1"))
+    run(session_state.cancel_reservation("s1", {**previous, constants.SESSION_RESULT_KEY: "results/ab/r.png"}))
+    session_state.complete_session("s1", **{constants.SESSION_RESULT_KEY: "results/ab/r.png"})
+
+    events = []
+    while message := pubsub.get_message():
+        events.append(json.loads(message["data"]))
+    assert [event[constants.SESSION_STATUS] for event in events] == [
+        constants.SessionStatus.QUEUED.value, constants.SessionStatus.NEW.value, constants.SessionStatus.COMPLETED.value,
+    ]
+    for event in events:
+        assert set(event) <= set(constants.SESSION_STATUS_FIELDS)
+    assert constants.SESSION_QUEUED_AT in events[0]
+    assert events[2][constants.SESSION_RESULT_KEY] == "results/ab/r.png"
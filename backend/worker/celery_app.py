@@ -4,12 +4,37 @@ import os
 # Add project root to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
-from celery import Celery
-from backend.core.config import settings
+from celery import Celery, signals
 
 celery_app = Celery(
     "worker",
-    broker=settings.REDIS_URL,
-    backend=settings.REDIS_URL,
-    include=['backend.worker.worker']  # Auto-discover tasks from worker.py
+    include=[
+        'backend.worker.worker',  # Auto-discover tasks from worker.py
+        'backend.worker.embedding_worker',
+        'backend.worker.housekeeping',
+        'backend.worker.monitoring',  # Task metrics and the worker's metrics exporter
+    ]
 )
+
+# Queues, routing, acknowledgement and result settings live in celeryconfig.py.
+celery_app.config_from_object("backend.worker.celeryconfig")
+
+@signals.worker_process_init.connect
+def _init_worker_process(**kwargs):
+    """
+    Loads the settings and creates the clients every task needs in each worker process,
+    after the fork of the prefork pool, so no process inherits another's connections.
+    Nothing is created at import. Other clients, such as the diffusion client and the
+    SAM model, are created on first use, as are all clients in pools without this signal.
+    """
+    from backend.core.config import get_settings
+    from backend.services.blob_storage import get_blob_storage
+    from backend.services.redis_client import get_sync_redis_client
+    from backend.worker.result_store import get_http_session
+    from backend.worker.wallpaper_cache import get_wallpaper_cache
+
+    get_settings()
+    get_sync_redis_client()
+    get_blob_storage().connect()
+    get_wallpaper_cache()
+    get_http_session()
@@ -0,0 +1,66 @@
+"""
+Celery configuration, loaded by celery_app with config_from_object. Celery imports
+this module when its configuration is first read (at worker or beat startup, or when
+the API sends its first task), not when celery_app is imported, so the settings it
+reads are loaded then.
+
+Workers subscribe to the queues they serve, for example:
+  celery -A backend.worker.celery_app worker -Q generation -c 4
+  celery -A backend.worker.celery_app worker -Q embedding -P threads -c 4
+  celery -A backend.worker.celery_app worker -Q housekeeping -c 1
+  celery -A backend.worker.celery_app beat
+"""
+from kombu import Queue
+
+from backend.core.config import settings
+from backend.core import constants
+
+broker_url = settings.REDIS_URL
+
+# --- Queues and routing ---
+task_queues = (
+    Queue(constants.GENERATION_QUEUE),
+    Queue(constants.EMBEDDING_QUEUE),
+    Queue(constants.HOUSEKEEPING_QUEUE),
+)
+task_default_queue = constants.GENERATION_QUEUE
+task_routes = {
+    "process_wallpaper": {"queue": constants.GENERATION_QUEUE},
+    "finalize_prediction": {"queue": constants.GENERATION_QUEUE},
+    "poll_prediction": {"queue": constants.GENERATION_QUEUE},
+    # Embedding is CPU-heavy and scales independently of generation. The threads pool
+    # lets one process share a single model and micro-batch concurrent tasks.
+    "generate_embedding": {"queue": constants.EMBEDDING_QUEUE},
+    "housekeeping.*": {"queue": constants.HOUSEKEEPING_QUEUE},
+}
+
+# --- Delivery ---
+# Tasks run for seconds to minutes, so each worker process reserves only the task it
+# is running. Otherwise an idle worker can sit next to a busy one holding a backlog.
+worker_prefetch_multiplier = 1
+# Acknowledge after the task finishes, so a crashed worker's task is redelivered.
+task_acks_late = True
+task_reject_on_worker_lost = True
+# With acks_late on Redis, a task not acknowledged within the visibility timeout is
+# redelivered. It must exceed the longest task, including countdowns of retries.
+broker_transport_options = {"visibility_timeout": 2 * 3600}
+
+# --- Results ---
+# Task state lives in the session hash; nobody reads Celery results.
+task_ignore_result = True
+result_backend = settings.REDIS_URL
+result_expires = 3600
+
+# --- Periodic tasks (Celery beat) ---
+beat_schedule = {
+    "housekeeping-sweep": {
+        "task": "housekeeping.sweep",
+        "schedule": settings.HOUSEKEEPING_INTERVAL_SECONDS,
+        # A sweep that could not run in time is skipped rather than piled up.
+        "options": {"expires": settings.HOUSEKEEPING_INTERVAL_SECONDS},
+    },
+}
+
+# --- Serialization ---
+task_serializer = "json"
+accept_content = ["json"]
@@ -0,0 +1,47 @@
+import logging
+
+from backend.core.config import settings
+from backend.services.redis_client import get_sync_redis_client
+from backend.services.blob_storage import get_blob_storage
+from backend.services.embedding_service import get_embedding_service
+from backend.services.embedding_codec import encode_embedding
+from backend.services.session_state import complete_embedding, fail_embedding
+from backend.core import constants
+from backend.worker.celery_app import celery_app
+
+# --- Logger ---
+logger = logging.getLogger(__name__)
+
+@celery_app.task(name="generate_embedding", bind=True, max_retries=2, default_retry_delay=10)
+def generate_embedding(self, session_id: str):
+    """
+    Celery task that computes the SAM embedding of a session's image.
+    Runs on the dedicated 'embedding' queue.
+    """
+    try:
+        image_key = get_sync_redis_client().hget(f"session:{session_id}", constants.SESSION_ORIGINAL_IMAGE_KEY)
+        if not image_key:
+            raise ValueError("Original image not found in session.")
+
+        image_bytes = get_blob_storage().get(image_key)
+        embedding = get_embedding_service().generate_embedding_from_bytes(image_bytes)
+
+        # Store the embedding as raw bytes in the compact binary format.
+        encoded = encode_embedding(
+            embedding,
+            dtype=settings.EMBEDDING_STORAGE_DTYPE,
+            compression=settings.EMBEDDING_COMPRESSION
+        )
+        # The embedding expires together with its session. The status only moves to
+        # 'embedding_completed' if the session is still embedding.
+        complete_embedding(session_id, encoded)
+
+    except Exception as e:
+        logger.error(f"Embedding failed for session {session_id}: {e}", exc_info=True)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+
+        # Not a terminal status: event streams stay open and the session can still generate.
+        fail_embedding(session_id, "Embedding generation failed.")
+
+    return {"status": "done", "session_id": session_id}
@@ -0,0 +1,168 @@
+import json
+import logging
+import time
+from collections import defaultdict
+
+from backend.core.config import settings
+from backend.core import constants
+from backend.services.redis_client import get_sync_redis_client
+from backend.services.blob_storage import get_blob_storage
+from backend.services.session_events import session_embedding_key, session_ttl
+from backend.services.session_state import expire_embedding
+from backend.worker.celery_app import celery_app
+
+# --- Logger ---
+logger = logging.getLogger(__name__)
+
+SCAN_BATCH_SIZE = 500
+
+# Blob namespaces owned by sessions. Blobs are content-addressed and shared between
+# sessions, so a blob is only deleted once no session or cached result refers to it.
+SESSION_BLOB_PREFIXES = [
+    constants.BLOB_PREFIX_ORIGINALS,
+    constants.BLOB_PREFIX_PREVIEWS,
+    constants.BLOB_PREFIX_MASKS,
+    constants.BLOB_PREFIX_RESULTS,
+]
+
+def _blob_stem(key: str) -> str:
+    """
+    Maps a blob key to the content-addressed key it belongs to, without extension.
+    'results/ab/<sha>.png' and its derivatives 'results/ab/<sha>/w960.webp' share a stem.
+    """
+    parts = key.split("/")
+    if len(parts) > 3:
+        return "/".join(parts[:3])
+    return key.rsplit(".", 1)[0]
+
+def _batches(pattern: str):
+    batch = []
+    for key in get_sync_redis_client().scan_iter(match=pattern, count=SCAN_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= SCAN_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _scan_sessions(referenced: set, report: dict):
+    """
+    Collects the blobs referenced by live sessions and the per-state key statistics.
+    Sessions (and embeddings) created before TTLs existed are given one, and sessions
+    still embedding past their deadline (a lost task) are marked embedding_failed.
+    """
+    states = defaultdict(lambda: {"sessions": 0, "session_bytes": 0, "embeddings": 0, "embedding_bytes": 0})
+    fields = [constants.SESSION_STATUS, constants.SESSION_EMBEDDING_DEADLINE, *constants.SESSION_BLOB_FIELDS]
+    now = time.time()
+    for keys in _batches("session:*"):
+        pipe = get_sync_redis_client().pipeline(transaction=False)
+        for key in keys:
+            session_id = key.removeprefix("session:")
+            pipe.hmget(key, fields)
+            pipe.ttl(key)
+            pipe.memory_usage(key)
+            pipe.memory_usage(session_embedding_key(session_id))
+        results = pipe.execute()
+
+        fix = get_sync_redis_client().pipeline(transaction=False)
+        for i, key in enumerate(keys):
+            values, ttl, session_bytes, embedding_bytes = results[4 * i:4 * i + 4]
+            status, embedding_deadline, *blob_keys = values
+            if status is None:
+                continue  # Expired since the scan.
+            referenced.update(_blob_stem(blob_key) for blob_key in blob_keys if blob_key)
+
+            if (status == constants.SessionStatus.EMBEDDING.value
+                    and float(embedding_deadline or 0) <= now
+                    and expire_embedding(key.removeprefix("session:"))):
+                report["embeddings_expired"] += 1
+
+            state = states[status]
+            state["sessions"] += 1
+            state["session_bytes"] += session_bytes or 0
+            if embedding_bytes:
+                state["embeddings"] += 1
+                state["embedding_bytes"] += embedding_bytes
+
+            if ttl == -1:
+                expiry = session_ttl(constants.SessionStatus(status))
+                fix.hset(key, constants.SESSION_TTL, expiry)
+                fix.expire(key, expiry)
+                fix.expire(session_embedding_key(key.removeprefix("session:")), expiry)
+                report["sessions_given_ttl"] += 1
+        fix.execute()
+    report["states"] = dict(states)
+
+def _scan_orphan_embeddings(report: dict):
+    """Deletes embeddings without a TTL whose session no longer exists."""
+    prefix = constants.SESSION_EMBEDDING_KEY_PREFIX
+    for keys in _batches(f"{prefix}*"):
+        pipe = get_sync_redis_client().pipeline(transaction=False)
+        for key in keys:
+            pipe.ttl(key)
+            pipe.exists(f"session:{key.removeprefix(prefix)}")
+        results = pipe.execute()
+        orphans = [key for i, key in enumerate(keys) if results[2 * i] == -1 and not results[2 * i + 1]]
+        if orphans:
+            get_sync_redis_client().delete(*orphans)
+            report["orphan_embeddings_deleted"] += len(orphans)
+
+def _scan_generation_cache(referenced: set, report: dict):
+    """Collects the result blobs referenced by cached generations."""
+    count = 0
+    size = 0
+    for keys in _batches(f"{constants.GENERATION_CACHE_KEY_PREFIX}result:*"):
+        pipe = get_sync_redis_client().pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.memory_usage(key)
+        results = pipe.execute()
+        for i in range(len(keys)):
+            value, key_bytes = results[2 * i], results[2 * i + 1]
+            if value is None:
+                continue
+            count += 1
+            size += key_bytes or 0
+            result_key = json.loads(value).get(constants.SESSION_RESULT_KEY)
+            if result_key:
+                referenced.add(_blob_stem(result_key))
+    report["generation_cache"] = {"entries": count, "bytes": size}
+
+def _sweep_blobs(referenced: set, report: dict):
+    """Deletes blobs that no session or cached result refers to, after a grace period."""
+    cutoff = time.time() - settings.HOUSEKEEPING_BLOB_GRACE_SECONDS
+    blob_storage = get_blob_storage()
+    for prefix in SESSION_BLOB_PREFIXES:
+        for key, last_modified in blob_storage.list(f"{prefix}/"):
+            # The grace period covers blobs uploaded just before their session was written.
+            if last_modified > cutoff or _blob_stem(key) in referenced:
+                continue
+            # Re-check right before deleting, in case the blob was rewritten meanwhile.
+            modified = blob_storage.last_modified(key)
+            if modified is None or modified > cutoff:
+                continue
+            blob_storage.delete(key)
+            report["blobs_deleted"] += 1
+
+@celery_app.task(name="housekeeping.sweep")
+def sweep():
+    """
+    Periodic housekeeping task (scheduled by Celery beat).
+    Reports Redis key counts and bytes per session state, gives TTL-less legacy
+    sessions a TTL, and deletes blobs of expired sessions.
+    """
+    started = time.monotonic()
+    report = defaultdict(int)
+    referenced = set()
+
+    # Mark: every blob still in use. Any Redis error aborts before blobs are deleted.
+    _scan_sessions(referenced, report)
+    _scan_orphan_embeddings(report)
+    _scan_generation_cache(referenced, report)
+
+    # Sweep
+    _sweep_blobs(referenced, report)
+
+    report["duration_seconds"] = round(time.monotonic() - started, 3)
+    logger.info(f"Housekeeping report: {json.dumps(report, sort_keys=True)}")
+    return dict(report)
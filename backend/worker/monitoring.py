@@ -0,0 +1,82 @@
+import logging
+import os
+import time
+
+from celery import signals
+from prometheus_client import multiprocess, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+from backend.core.config import settings
+from backend.core import constants
+from backend.core.metrics import collector_registry, TASK_SECONDS, TASK_RETRIES
+from backend.services.redis_client import get_sync_redis_client
+from backend.services.generation_cache import INFLIGHT_SET_KEY
+
+# --- Logger ---
+logger = logging.getLogger(__name__)
+
+# Start times of the tasks running in this process, by task ID.
+_task_started: dict[str, float] = {}
+
+class QueueCollector(Collector):
+    """
+    Reports the broker queue depths and in-flight generations, read from Redis on each scrape.
+    """
+    QUEUES = [constants.GENERATION_QUEUE, constants.EMBEDDING_QUEUE, constants.HOUSEKEEPING_QUEUE]
+
+    def collect(self):
+        depth = GaugeMetricFamily("wallpaper_queue_depth", "Tasks waiting in a Celery queue.", labels=["queue"])
+        in_flight = GaugeMetricFamily("wallpaper_generations_in_flight", "Generations admitted and not yet finished.")
+        try:
+            pipe = get_sync_redis_client().pipeline(transaction=False)
+            for queue in self.QUEUES:
+                pipe.llen(queue)
+            pipe.zcard(INFLIGHT_SET_KEY)
+            *lengths, running = pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not read queue metrics: {e}")
+            return
+        for queue, length in zip(self.QUEUES, lengths):
+            depth.add_metric([queue], length)
+        in_flight.add_metric([], running)
+        yield depth
+        yield in_flight
+
+@signals.task_prerun.connect
+def _on_task_prerun(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+@signals.task_postrun.connect
+def _on_task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None and task is not None:
+        TASK_SECONDS.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+
+@signals.task_retry.connect
+def _on_task_retry(sender=None, **kwargs):
+    TASK_RETRIES.labels(sender.name).inc()
+
+@signals.worker_init.connect
+def _start_exporter(**kwargs):
+    """
+    Serves the worker's metrics on WORKER_METRICS_PORT (0 disables the exporter).
+    With the prefork pool, tasks run in child processes: set PROMETHEUS_MULTIPROC_DIR so
+    the exporter in the main process aggregates them.
+    """
+    if not settings.WORKER_METRICS_PORT:
+        return
+    registry = collector_registry()
+    registry.register(QueueCollector())
+    try:
+        start_http_server(settings.WORKER_METRICS_PORT, registry=registry)
+    except OSError as e:
+        # E.g. a second worker on the same host; give each worker its own port.
+        logger.warning(f"Metrics exporter not started on port {settings.WORKER_METRICS_PORT}: {e}")
+        return
+    logger.info(f"Serving worker metrics on port {settings.WORKER_METRICS_PORT}.")
+
+@signals.worker_process_shutdown.connect
+def _mark_process_dead(pid=None, **kwargs):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
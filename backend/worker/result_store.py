@@ -0,0 +1,133 @@
+import hashlib
+import io
+import json
+import logging
+import tempfile
+import threading
+
+import requests
+from PIL import Image, features
+
+from backend.core.config import settings
+from backend.core import constants
+from backend.services.blob_storage import get_blob_storage, digest_key, IMMUTABLE_CACHE_CONTROL
+from backend.worker.wallpaper_cache import create_http_session
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# Encoder options and MIME types of the derivative formats.
+_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "avif": ("AVIF", "image/avif", {"quality": 60, "speed": 6}),
+}
+_EXTENSIONS = {"JPEG": (".jpg", "image/jpeg"), "PNG": (".png", "image/png"), "WEBP": (".webp", "image/webp")}
+
+_http_session: requests.Session | None = None
+_http_session_lock = threading.Lock()
+
+def get_http_session() -> requests.Session:
+    """
+    Returns the HTTP session shared by all tasks of a worker process, so result
+    downloads reuse connections. It is created on first use.
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                _http_session = create_http_session()
+    return _http_session
+
+
+class ResultTooLargeError(ValueError):
+    """Raised when a generated result exceeds RESULT_MAX_DOWNLOAD_BYTES."""
+
+
+def _available_formats() -> list[str]:
+    formats = []
+    for name in settings.RESULT_VARIANT_FORMATS:
+        if name not in _FORMATS:
+            raise ValueError(f"Unknown result variant format: {name}")
+        if name == "avif" and not features.check("avif"):
+            logger.warning("Pillow was built without AVIF support; skipping AVIF variants.")
+            continue
+        formats.append(name)
+    return formats
+
+
+def _download(url: str, spool) -> str:
+    """Streams a result into spool while hashing it. Returns the SHA-256 hex digest."""
+    digest = hashlib.sha256()
+    total = 0
+    with get_http_session().get(url, stream=True, timeout=settings.RESULT_DOWNLOAD_TIMEOUT_SECONDS) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            total += len(chunk)
+            if total > settings.RESULT_MAX_DOWNLOAD_BYTES:
+                raise ResultTooLargeError(f"Result is larger than {settings.RESULT_MAX_DOWNLOAD_BYTES} bytes.")
+            digest.update(chunk)
+            spool.write(chunk)
+    spool.seek(0)
+    return digest.hexdigest()
+
+
+def _encode(image: Image.Image, width: int, format_name: str) -> tuple[bytes, str]:
+    pil_format, content_type, options = _FORMATS[format_name]
+    resized = image.copy()
+    resized.thumbnail((width, width * image.height // image.width or 1), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    resized.save(buffer, format=pil_format, **options)
+    return buffer.getvalue(), content_type
+
+
+def persist_result(result_url: str) -> dict:
+    """
+    Copies a generated result from the provider's temporary URL into blob storage,
+    together with right-sized derivatives, and returns the session fields describing them.
+
+    All keys derive from the result's content hash, so a result that is already stored
+    is not encoded again. The full-size image is written last and marks a complete set.
+
+    Returns:
+        The session fields: result_key, result_variants (JSON) and result_thumbnail_key.
+        They hold blob keys only; download URLs are built when the session is read.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=settings.WORKER_SPILL_THRESHOLD_BYTES) as spool:
+        digest = _download(result_url, spool)
+        with Image.open(spool) as image:
+            extension, content_type = _EXTENSIONS.get(image.format, (".png", "image/png"))
+            key = digest_key(digest, constants.BLOB_PREFIX_RESULTS, extension)
+            variant_dir = digest_key(digest, constants.BLOB_PREFIX_RESULTS)
+            formats = _available_formats()
+
+            variants = []
+            for width in sorted(settings.RESULT_VARIANT_WIDTHS):
+                if width >= image.width:
+                    continue
+                for format_name in formats:
+                    variants.append((width, format_name, f"{variant_dir}/w{width}.{format_name}"))
+            thumbnail_key = f"{variant_dir}/thumb.webp"
+
+            blob_storage = get_blob_storage()
+            if not blob_storage.has_recent(key):
+                image.load()
+                rgb = image if image.mode in ("RGB", "RGBA") else image.convert("RGB")
+                for width, format_name, variant_key in variants:
+                    data, variant_type = _encode(rgb, width, format_name)
+                    blob_storage.put(variant_key, data, variant_type, cache_control=IMMUTABLE_CACHE_CONTROL)
+                data, _ = _encode(rgb, min(settings.RESULT_THUMBNAIL_WIDTH, image.width), "webp")
+                blob_storage.put(thumbnail_key, data, "image/webp", cache_control=IMMUTABLE_CACHE_CONTROL)
+
+                spool.seek(0)
+                blob_storage.put_stream(key, spool, content_type, cache_control=IMMUTABLE_CACHE_CONTROL)
+                logger.info(f"Stored result {key} with {len(variants)} variants.")
+
+    return {
+        constants.SESSION_RESULT_KEY: key,
+        constants.SESSION_RESULT_VARIANTS: json.dumps([
+            {"width": width, "format": format_name, "key": variant_key}
+            for width, format_name, variant_key in variants
+        ]),
+        constants.SESSION_RESULT_THUMBNAIL_KEY: thumbnail_key,
+    }
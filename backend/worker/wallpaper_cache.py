@@ -0,0 +1,196 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from backend.core.config import settings
+from backend.core.metrics import CACHE_REQUESTS, CACHE_EVICTIONS
+
+logger = logging.getLogger(__name__)
+
+class WallpaperTooLargeError(ValueError):
+    """Raised when a wallpaper download exceeds the configured size cap."""
+
+
+def create_http_session(pool_size: int = 10) -> requests.Session:
+    """
+    Creates a pooled requests.Session that is reused across tasks, so repeated
+    downloads from the same catalog host skip the TCP/TLS handshake.
+    """
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class WallpaperCache:
+    """
+    A disk-backed LRU cache of wallpaper pattern downloads, keyed by URL.
+
+    Cached entries are revalidated with If-None-Match / If-Modified-Since on every
+    use, so a 304 costs one small round trip instead of a full download. All state
+    lives in the cache directory (one data file and one metadata file per URL),
+    which keeps it consistent between the processes of a prefork worker.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_download_bytes: int,
+                 timeout: float, session: requests.Session | None = None):
+        """
+        Args:
+            cache_dir: The directory holding cached wallpapers.
+            max_bytes: The byte budget of the cache; least recently used entries are evicted.
+            max_download_bytes: Downloads larger than this are aborted.
+            timeout: The HTTP timeout in seconds.
+            session: The HTTP session to use. A pooled session is created if omitted.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_download_bytes = max_download_bytes
+        self.timeout = timeout
+        self.session = session or create_http_session()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return f"{base}.bin", f"{base}.json"
+
+    def _load_entry(self, url: str) -> tuple[dict, str] | None:
+        data_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or not os.path.isfile(data_path):
+            return None
+        return meta, data_path
+
+    def _read_limited(self, response: requests.Response) -> bytes:
+        content_length = response.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_download_bytes:
+            raise WallpaperTooLargeError(f"Wallpaper is larger than {self.max_download_bytes} bytes.")
+
+        chunks = []
+        total = 0
+        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+            total += len(chunk)
+            if total > self.max_download_bytes:
+                raise WallpaperTooLargeError(f"Wallpaper is larger than {self.max_download_bytes} bytes.")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _store(self, url: str, data: bytes, response: requests.Response):
+        if "no-store" in response.headers.get("Cache-Control", ""):
+            return
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            # Without validators the entry could never be revalidated.
+            return
+        if len(data) > self.max_bytes:
+            return
+
+        data_path, meta_path = self._paths(url)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(data_path + suffix, "wb") as f:
+            f.write(data)
+        with open(meta_path + suffix, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "size": len(data)}, f)
+        os.replace(data_path + suffix, data_path)
+        os.replace(meta_path + suffix, meta_path)
+        self._evict()
+
+    def _evict(self):
+        """Deletes least recently used entries until the cache fits its byte budget."""
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".bin"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        for _, size, data_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for path in (data_path, data_path[:-len(".bin")] + ".json"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            CACHE_EVICTIONS.labels("wallpaper").inc()
+
+    def get(self, url: str) -> bytes:
+        """
+        Returns the wallpaper at url, from the cache when it is still valid.
+
+        Raises:
+            WallpaperTooLargeError: If the download exceeds the size cap.
+            requests.HTTPError: If the server returns an error status.
+        """
+        cached = self._load_entry(url)
+        headers = {}
+        if cached is not None:
+            meta, _ = cached
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 304:
+                return self._accept(url, response)
+            if cached is not None:
+                data = self._read_cached(cached[1])
+                if data is not None:
+                    CACHE_REQUESTS.labels("wallpaper", "hit").inc()
+                    return data
+
+        # A 304 without a usable cached copy (e.g. evicted by another process): download in full.
+        with self.session.get(url, stream=True, timeout=self.timeout) as response:
+            return self._accept(url, response)
+
+    def _read_cached(self, data_path: str) -> bytes | None:
+        try:
+            with open(data_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(data_path)  # Mark as recently used.
+        return data
+
+    def _accept(self, url: str, response: requests.Response) -> bytes:
+        response.raise_for_status()
+        data = self._read_limited(response)
+        CACHE_REQUESTS.labels("wallpaper", "miss").inc()
+        self._store(url, data, response)
+        return data
+
+_wallpaper_cache: WallpaperCache | None = None
+_wallpaper_cache_lock = threading.Lock()
+
+def get_wallpaper_cache() -> WallpaperCache:
+    """
+    Returns the worker process's WallpaperCache, creating it (and its directory) on first use.
+    """
+    global _wallpaper_cache
+    if _wallpaper_cache is None:
+        with _wallpaper_cache_lock:
+            if _wallpaper_cache is None:
+                _wallpaper_cache = WallpaperCache(
+                    cache_dir=settings.WALLPAPER_CACHE_DIR,
+                    max_bytes=settings.WALLPAPER_CACHE_MAX_BYTES,
+                    max_download_bytes=settings.WALLPAPER_MAX_DOWNLOAD_BYTES,
+                    timeout=settings.WALLPAPER_DOWNLOAD_TIMEOUT_SECONDS,
+                )
+    return _wallpaper_cache
@@ -1,83 +1,311 @@
-import os
 import logging
 import tempfile
-import requests
-import base64
-from io import BytesIO
+import time
+from contextlib import ExitStack
 
 from backend.core.config import settings
-from backend.services.redis_client import sync_redis_client
-from backend.services.diffusion_client import diffusion_client
+from backend.core.metrics import (
+    stage_timer,
+    observe_since,
+    GENERATION_QUEUE_WAIT_SECONDS,
+    GENERATION_SECONDS,
+)
+from backend.services.redis_client import get_sync_redis_client
+from backend.services.blob_storage import get_blob_storage
+from backend.services.session_state import (
+    complete_session,
+    fail_session,
+    start_generation,
+    begin_submission,
+    retry_generation,
+)
+from backend.services.diffusion_client import DiffusionClient, get_diffusion_client
+from backend.services.mask_codec import deserialize_mask
+from backend.services.generation_cache import store_generation_result, release_generation
 from backend.core import constants
 from backend.worker.celery_app import celery_app
+from backend.worker.wallpaper_cache import get_wallpaper_cache
+from backend.worker.result_store import persist_result
 
 # --- Logger ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def _prepare_input_files(session_id: str, mask_b64: str, wallpaper_url: str, tmpdir: str):
-    """Downloads and prepares all necessary files for the diffusion model."""
-    original_image_path = os.path.join(tmpdir, "original.jpg")
-    wallpaper_image_path = os.path.join(tmpdir, "wallpaper.jpg")
-    mask_image_path = os.path.join(tmpdir, "mask.png")
+def _spill_if_large(data: bytes, stack: ExitStack):
+    """
+    Keeps an input in memory, unless it exceeds WORKER_SPILL_THRESHOLD_BYTES,
+    in which case it is moved to an anonymous temporary file.
+    """
+    if len(data) <= settings.WORKER_SPILL_THRESHOLD_BYTES:
+        return data
+    spill_file = stack.enter_context(tempfile.TemporaryFile())
+    spill_file.write(data)
+    spill_file.seek(0)
+    return spill_file
 
-    # 1. Fetch original image from Redis
-    image_b64 = sync_redis_client.hget(f"session:{session_id}", constants.SESSION_ORIGINAL_IMAGE_B64)
-    if not image_b64:
+def _prepare_inputs(session_id: str, mask_key: str, wallpaper_url: str, stack: ExitStack):
+    """Fetches and decodes all inputs for the diffusion model, in memory."""
+    # 1. Fetch original image from blob storage
+    with stage_timer("process_wallpaper", "fetch_session"):
+        image_key = get_sync_redis_client().hget(f"session:{session_id}", constants.SESSION_ORIGINAL_IMAGE_KEY)
+    if not image_key:
         raise ValueError("Original image not found in session.")
-    
-    with open(original_image_path, "wb") as f:
-        f.write(base64.b64decode(image_b64))
-
-    # 2. Download wallpaper image from URL
-    response = requests.get(wallpaper_url, timeout=15)
-    response.raise_for_status()
-    with open(wallpaper_image_path, "wb") as f:
-        f.write(response.content)
-    
-    # 3. Decode mask from Base64
-    with open(mask_image_path, "wb") as f:
-        f.write(base64.b64decode(mask_b64))
-        
-    return original_image_path, mask_image_path, wallpaper_image_path
+    with stage_timer("process_wallpaper", "fetch_original"):
+        original_image = _spill_if_large(get_blob_storage().get(image_key), stack)
+
+    # 2. Download wallpaper image from URL (cached and revalidated across tasks)
+    with stage_timer("process_wallpaper", "fetch_wallpaper"):
+        wallpaper_image = _spill_if_large(get_wallpaper_cache().get(wallpaper_url), stack)
+
+    # 3. Fetch the compact mask; it is rasterized by the diffusion client
+    with stage_timer("process_wallpaper", "fetch_mask"):
+        mask_data = get_blob_storage().get(mask_key)
+    with stage_timer("process_wallpaper", "decode_mask"):
+        mask_image = deserialize_mask(mask_data)
+
+    return original_image, mask_image, wallpaper_image
+
+def _complete_generation(session_id: str, result_url: str):
+    """
+    Copies the result into our blob storage, marks the session as completed and
+    commits its reserved attempt. The result is cached, and sessions waiting on an
+    identical generation are completed too, free of charge.
+    """
+    try:
+        with stage_timer("process_wallpaper", "persist_result"):
+            result_fields = persist_result(result_url)
+        persisted = True
+    except Exception as e:
+        # The provider's URL is short-lived, but still better than failing a finished generation.
+        logger.error(f"Could not persist result for session {session_id}: {e}", exc_info=True)
+        result_fields = {constants.SESSION_RESULT_URL: result_url}
+        persisted = False
+    finished = {constants.SESSION_FINISHED_AT: time.time()}
+    # The generation's fields are read by the settle itself: once the reservation is
+    # released, a new generation of the session may replace them.
+    settled = complete_session(session_id, **result_fields, **finished)
+    cache_key = settled[constants.SESSION_GENERATION_CACHE_KEY]
+    observe_since(GENERATION_SECONDS, settled[constants.SESSION_QUEUED_AT], "completed")
+    if cache_key:
+        # The provider's URL expires long before a cached result would, so it is never cached.
+        if persisted:
+            waiter_ids = store_generation_result(cache_key, result_fields)
+        else:
+            waiter_ids = release_generation(cache_key)
+        for waiter_id in waiter_ids:
+            if waiter_id != session_id:
+                # Waiters shared this generation, so their reserved attempts are refunded.
+                complete_session(waiter_id, charge=False, **result_fields, **finished)
+
+def _fail_generation(session_id: str, error: str):
+    """
+    Marks a session, and the sessions waiting on the same generation, as failed.
+    Their reserved attempts are refunded.
+    """
+    finished = {constants.SESSION_FINISHED_AT: time.time()}
+    settled = fail_session(session_id, error, **finished)
+    cache_key = settled[constants.SESSION_GENERATION_CACHE_KEY]
+    observe_since(GENERATION_SECONDS, settled[constants.SESSION_QUEUED_AT], "failed")
+    if cache_key:
+        for waiter_id in release_generation(cache_key):
+            if waiter_id != session_id:
+                fail_session(waiter_id, error, **finished)
+
+def _track_prediction(session_id: str, prediction_id: str):
+    """Links a submitted prediction to its session so the completion can be finalized later."""
+    pipe = get_sync_redis_client().pipeline(transaction=False)
+    pipe.set(
+        f"{constants.PREDICTION_KEY_PREFIX}{prediction_id}",
+        session_id,
+        ex=settings.DIFFUSION_POLL_TIMEOUT_SECONDS * 2
+    )
+    pipe.hset(f"session:{session_id}", constants.SESSION_PREDICTION_ID, prediction_id)
+    pipe.execute()
+
+def _schedule_poll(prediction_id: str, submitted_at: float):
+    """
+    Schedules the first check of a submitted prediction. A webhook can be lost or
+    rejected, so webhook mode also polls once, at the deadline: the poll settles or
+    cancels the prediction, or does nothing if the webhook already finalized it.
+    """
+    if settings.DIFFUSION_COMPLETION_MODE == "poll":
+        countdown = settings.DIFFUSION_POLL_INTERVAL_SECONDS
+    else:
+        countdown = max(submitted_at + settings.DIFFUSION_POLL_TIMEOUT_SECONDS - time.time(), 0)
+    poll_prediction.apply_async(args=[prediction_id, submitted_at], countdown=countdown)
+
+def _resume_prediction(session_id: str) -> dict:
+    """
+    Schedules the poll of a prediction submitted by an earlier delivery of the task, which
+    may have stopped before scheduling it. Polling a prediction twice is harmless, since
+    it is finalized at most once.
+    """
+    redis_client = get_sync_redis_client()
+    prediction_id, submitted_at = redis_client.hmget(
+        f"session:{session_id}", constants.SESSION_PREDICTION_ID, constants.SESSION_SUBMITTED_AT
+    )
+    if not redis_client.exists(f"{constants.PREDICTION_KEY_PREFIX}{prediction_id}"):
+        # Already finalized; nothing left to poll.
+        return {"status": "ignored", "session_id": session_id}
+    logger.info(f"Resuming prediction {prediction_id} of session {session_id}.")
+    _schedule_poll(prediction_id, float(submitted_at))
+    return {"status": "resumed", "session_id": session_id}
 
 @celery_app.task(name="process_wallpaper", bind=True, max_retries=3, default_retry_delay=30)
-def process_wallpaper(self, session_id: str, mask_b64: str, wallpaper_url: str):
+def process_wallpaper(self, session_id: str, mask_key: str, wallpaper_url: str, queued_at: float):
     """
     Celery task to process wallpaper generation.
     Orchestrates file downloads, diffusion model execution, and result uploads.
+
+    With DIFFUSION_COMPLETION_MODE 'webhook' or 'poll' the task only submits the
+    prediction and returns, freeing the worker slot; the session is finalized by
+    'finalize_prediction' or 'poll_prediction' once the prediction completes.
+
+    `queued_at` identifies the attempt. Tasks are acknowledged late, so a message can be
+    delivered again; the task then does nothing if its attempt was already settled, and
+    only schedules the poll if its prediction was already submitted. The submission is
+    recorded before the prediction is created, so no delivery or retry ever creates a
+    second one: if an earlier delivery stopped before the prediction ID was recorded,
+    whether the prediction exists is unknown, and the generation is failed instead.
     """
     try:
-        # Set status to 'generating'
-        sync_redis_client.hset(f"session:{session_id}", constants.SESSION_STATUS, constants.SessionStatus.GENERATING.value)
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Prepare all input files
-            original_path, mask_path, wallpaper_path = _prepare_input_files(session_id, mask_b64, wallpaper_url, tmpdir)
+        # Set status to 'generating', unless this attempt no longer holds the reservation
+        started_at = time.time()
+        outcome = start_generation(session_id, queued_at, **{constants.SESSION_STARTED_AT: started_at})
+        if outcome == "submitted":
+            return _resume_prediction(session_id)
+        if outcome == "submitting":
+            logger.error(f"Generation for session {session_id} was interrupted while submitting its prediction.")
+            _fail_generation(session_id, "Generation was interrupted.")
+            return {"status": "failed", "session_id": session_id}
+        if outcome != "ok":
+            logger.info(f"Skipping generation for session {session_id}: attempt is {outcome}.")
+            return {"status": "ignored", "session_id": session_id}
+        if self.request.retries == 0:
+            GENERATION_QUEUE_WAIT_SECONDS.observe(max(started_at - float(queued_at), 0.0))
 
-            # Generate wallpaper using the diffusion client
-            result_url = diffusion_client.generate_wallpaper(original_path, mask_path, wallpaper_path)
+        with ExitStack() as stack:
+            # Prepare all inputs in memory
+            original_image, mask_image, wallpaper_image = _prepare_inputs(session_id, mask_key, wallpaper_url, stack)
 
-            # Update session in Redis on success
-            final_data = {
-                constants.SESSION_STATUS: constants.SessionStatus.COMPLETED.value,
-                constants.SESSION_RESULT_URL: result_url
-            }
-            sync_redis_client.hset(f"session:{session_id}", mapping=final_data)
-            sync_redis_client.hincrby(f"session:{session_id}", constants.SESSION_ATTEMPTS_LEFT, -1)
+            mode = settings.DIFFUSION_COMPLETION_MODE
+            if mode == "blocking":
+                # Generate wallpaper using the diffusion client
+                result_url = get_diffusion_client().generate_wallpaper(original_image, mask_image, wallpaper_image)
+                _complete_generation(session_id, result_url)
+            else:
+                # 'webhook' or 'poll'; the settings reject any other mode.
+                client = get_diffusion_client()
+                model_input = client.upload_inputs(original_image, mask_image, wallpaper_image)
+                submitted_at = time.time()
+                if begin_submission(session_id, queued_at, submitted_at) != "ok":
+                    logger.info(f"Not submitting generation for session {session_id}: attempt was settled.")
+                    return {"status": "ignored", "session_id": session_id}
+                prediction_id = client.submit_wallpaper(
+                    model_input, webhook_url=settings.DIFFUSION_WEBHOOK_URL if mode == "webhook" else None
+                )
+                _track_prediction(session_id, prediction_id)
+                _schedule_poll(prediction_id, submitted_at)
 
     except Exception as e:
         logger.error(f"Task failed for session {session_id}: {e}", exc_info=True)
-        try:
-            # Retry with exponential backoff
-            countdown = self.default_retry_delay * (2 ** self.request.retries)
-            self.retry(exc=e, countdown=countdown)
-        except self.MaxRetriesExceededError:
-            # If all retries fail, mark the session as failed
-            failure_data = {
-                constants.SESSION_STATUS: constants.SessionStatus.FAILED.value,
-                constants.SESSION_ERROR_MESSAGE: "Generation failed after multiple retries."
-            }
-            sync_redis_client.hset(f"session:{session_id}", mapping=failure_data)
+        if self.request.retries < self.max_retries:
+            # Retry with exponential backoff, unless the attempt was settled meanwhile. The
+            # retry of a recorded prediction only schedules its poll.
+            outcome = retry_generation(session_id, queued_at)
+            if outcome == "stale":
+                return {"status": "ignored", "session_id": session_id}
+            if outcome != "submitting":
+                countdown = self.default_retry_delay * (2 ** self.request.retries)
+                raise self.retry(exc=e, countdown=countdown)
+            # Submitting failed, but the prediction may have been created all the same;
+            # a retry could create a second one.
+            _fail_generation(session_id, "Generation failed.")
+            return {"status": "failed", "session_id": session_id}
+
+        # If all retries fail, mark the session as failed
+        _fail_generation(session_id, "Generation failed after multiple retries.")
+
+    return {"status": "done", "session_id": session_id}
+
+def _finalize(prediction_id: str, status: str, output=None, error: str | None = None) -> dict:
+    """
+    Settles the session of a completed prediction, at most once per prediction.
+    If settling fails, the prediction is given back so a retry can finalize it.
+    """
+    # GETDEL claims the prediction atomically, so duplicate deliveries are ignored.
+    prediction_key = f"{constants.PREDICTION_KEY_PREFIX}{prediction_id}"
+    session_id = get_sync_redis_client().getdel(prediction_key)
+    if session_id is None:
+        logger.info(f"Prediction {prediction_id} is unknown or already finalized.")
+        return {"status": "ignored", "prediction_id": prediction_id}
+
+    try:
+        if status == "succeeded":
+            try:
+                result_url = DiffusionClient.parse_output(output)
+            except Exception as e:
+                logger.error(f"Prediction {prediction_id} returned no result: {e}")
+                _fail_generation(session_id, "Generation returned no result.")
+            else:
+                _complete_generation(session_id, result_url)
+        else:
+            logger.error(f"Prediction {prediction_id} for session {session_id} {status}: {error}")
+            _fail_generation(session_id, "Generation failed.")
+    except Exception:
+        # Give the claim back; NX keeps a claim that was restored concurrently.
+        get_sync_redis_client().set(prediction_key, session_id, ex=settings.DIFFUSION_POLL_TIMEOUT_SECONDS * 2, nx=True)
+        raise
 
     return {"status": "done", "session_id": session_id}
+
+@celery_app.task(name="finalize_prediction", bind=True, max_retries=3, default_retry_delay=30)
+def finalize_prediction(self, prediction_id: str, status: str, output=None, error: str | None = None):
+    """
+    Celery task that finalizes the session of a completed prediction.
+    Called by the Replicate webhook endpoint. Each prediction is finalized at most
+    once, even if it is also reported by 'poll_prediction'.
+    """
+    try:
+        return _finalize(prediction_id, status, output, error)
+    except Exception as e:
+        logger.error(f"Finalizing prediction {prediction_id} failed: {e}", exc_info=True)
+        countdown = self.default_retry_delay * (2 ** self.request.retries)
+        raise self.retry(exc=e, countdown=countdown)
+
+@celery_app.task(name="poll_prediction", bind=True, max_retries=None)
+def poll_prediction(self, prediction_id: str, submitted_at: float):
+    """
+    Celery task that checks a prediction once and reschedules itself until it completes.
+    Each check is a short API call, so polling never holds a worker slot for long.
+
+    Errors (e.g. a Replicate outage) are retried until DIFFUSION_POLL_TIMEOUT_SECONDS
+    has passed; the generation is then failed, so the session never stays 'generating'.
+    In webhook mode it runs once, at the deadline, as a fallback for a lost webhook.
+    """
+    if not get_sync_redis_client().exists(f"{constants.PREDICTION_KEY_PREFIX}{prediction_id}"):
+        # Already finalized (e.g. by the webhook); nothing left to check.
+        return {"status": "ignored", "prediction_id": prediction_id}
+    deadline = submitted_at + settings.DIFFUSION_POLL_TIMEOUT_SECONDS
+    try:
+        prediction = get_diffusion_client().get_prediction(prediction_id)
+        if prediction.status in constants.TERMINAL_PREDICTION_STATUSES:
+            return _finalize(prediction_id, prediction.status, prediction.output, prediction.error)
+    except Exception as e:
+        if time.time() < deadline:
+            logger.warning(f"Checking prediction {prediction_id} failed, retrying: {e}")
+            raise self.retry(countdown=settings.DIFFUSION_POLL_INTERVAL_SECONDS)
+        logger.error(f"Prediction {prediction_id} could not be checked before its deadline: {e}")
+        _finalize(prediction_id, "failed", error=str(e))
+        return {"status": "failed", "prediction_id": prediction_id}
+
+    if time.time() > deadline:
+        logger.error(f"Prediction {prediction_id} timed out; cancelling it.")
+        try:
+            get_diffusion_client().cancel_prediction(prediction_id)
+        except Exception as e:
+            logger.warning(f"Could not cancel prediction {prediction_id}: {e}")
+        _finalize(prediction_id, "canceled", error="Timed out.")
+        return {"status": "timeout", "prediction_id": prediction_id}
+
+    raise self.retry(countdown=settings.DIFFUSION_POLL_INTERVAL_SECONDS)